@@ -1,19 +1,43 @@
+import startup_profile
+import argparse
 import tkinter as tk
+from tkinter import filedialog
 from tkinter import messagebox
 from tkinter import ttk
 import customtkinter as ctk
-import pyodbc
-from tksheet import Sheet
 from datetime import datetime
 import logging
 from dotenv import load_dotenv
 import os
-from ldap3 import Server, Connection, ALL, NTLM, SUBTREE
-from cryptography.fernet import Fernet, InvalidToken
-
-# Configure logging
-logging.basicConfig(filename='app.log', level=logging.ERROR)
-logging.basicConfig(filename='auth.log', level=logging.INFO)
+import queue
+import threading
+import time
+# pyodbc, tksheet, ldap3 and cryptography are imported on first use (startup_profile.lazy_import)
+import analytics
+import backends
+import db
+import grid_export
+import metrics
+import save_journal
+from db import LoadCancelled, SaveConflict
+from search_index import SearchIndex, parse_query
+from sort_index import GROUP_COLUMNS, SortIndex
+from save_journal import PENDING_FP_ID
+from grid_view import GridView
+from row_store import COLUMN_COUNT, ProductionStore, child_row, join_children
+import snapshot
+
+startup_profile.mark("imports")
+
+# Configure logging: errors of the whole app go to app.log, login activity (logger "auth") to auth.log
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+app_log_handler = logging.FileHandler('app.log')
+app_log_handler.setLevel(logging.ERROR)
+logging.basicConfig(level=logging.ERROR, format=LOG_FORMAT, handlers=[app_log_handler])
+auth_log_handler = logging.FileHandler('auth.log')
+auth_log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+logging.getLogger('auth').setLevel(logging.INFO)
+logging.getLogger('auth').addHandler(auth_log_handler)
 
 # Check if .env file exists in the current directory
 env_file_path = '.env' if os.path.isfile('.env') else '_internal/.env'
@@ -30,12 +54,126 @@ ALLOWED_GROUPS = os.getenv('ALLOWED_GROUPS')
 ALLOWED_USERS = os.getenv('ALLOWED_USERS')
 # Retrieve the encryption key from the .env file
 ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')
-fernet = Fernet(ENCRYPTION_KEY)
 
 # Ensure the encryption key is loaded
 if ENCRYPTION_KEY is None:
     raise ValueError("No encryption key found in environment variables.")
 
+# Built on first use: cryptography and ldap3 are only needed once the login window is up
+_fernet = None
+_authorizer = None
+
+
+def get_fernet():
+    global _fernet
+    if _fernet is None:
+        _fernet = startup_profile.lazy_import("cryptography.fernet").Fernet(ENCRYPTION_KEY)
+    return _fernet
+
+
+def get_authorizer():
+    # Binds every login, caches group membership per user (AD_AUTH_CACHE_SECONDS)
+    global _authorizer
+    if _authorizer is None:
+        _authorizer = startup_profile.lazy_import("auth").authorizer_from_settings(os.environ)
+    return _authorizer
+
+
+# Database timeouts (seconds). Login timeout for pyodbc.connect and query timeout per statement.
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '15'))
+DB_QUERY_TIMEOUT = int(os.getenv('DB_QUERY_TIMEOUT', '60'))
+# Rows fetched per round trip by the background loader
+DB_FETCH_SIZE = int(os.getenv('DB_FETCH_SIZE', '1000'))
+# OPs per page in paged mode (0 loads every active OP at once)
+GRID_PAGE_SIZE = int(os.getenv('GRID_PAGE_SIZE', '0'))
+# Tree mode: one row per OP; its FP_PROGRES records are fetched when the OP is selected
+GRID_TREE = os.getenv('GRID_TREE', '0') == '1'
+if GRID_TREE and GRID_PAGE_SIZE > 0:
+    raise ValueError("GRID_TREE cannot be combined with GRID_PAGE_SIZE.")
+# Companies and ERP states loaded, e.g. "01:EF,PE,EE;02:EF,PE,EE"; every scope is queried in
+# parallel and refreshed on its own
+GRID_SCOPES = db.parse_scopes(os.getenv('GRID_SCOPES', ''))
+if len(GRID_SCOPES) > 1 and GRID_PAGE_SIZE > 0:
+    raise ValueError("Several GRID_SCOPES cannot be combined with GRID_PAGE_SIZE.")
+# Plants offered by the record dialogs
+GRID_PLANTS = [plant.strip() for plant in os.getenv('GRID_PLANTS', '01,02').split(',') if plant.strip()]
+# Larger selections (e.g. select all) do not fetch records until an action needs them
+TREE_SELECTION_FETCH_LIMIT = 500
+# Row index width (pixels) while the grid is grouped; it shows the group names
+GROUP_INDEX_WIDTH = 200
+# Delay after the last keystroke before the filter is applied
+FILTER_DEBOUNCE_MS = int(os.getenv('FILTER_DEBOUNCE_MS', '200'))
+# Seconds between automatic incremental refreshes (0 disables the timer)
+AUTO_REFRESH_SECONDS = int(os.getenv('AUTO_REFRESH_SECONDS', '60'))
+# Optional rowversion / last-modified column on FP_PROGRES used as high-water mark
+FP_PROGRES_VERSION_COLUMN = os.getenv('FP_PROGRES_VERSION_COLUMN', '')
+if FP_PROGRES_VERSION_COLUMN and not FP_PROGRES_VERSION_COLUMN.isidentifier():
+    raise ValueError("FP_PROGRES_VERSION_COLUMN must be a plain column name.")
+# Read the ERP columns from the SIIAPP mirror kept by erp_mirror.py instead of ssf_genericos
+ERP_MIRROR = os.getenv('ERP_MIRROR', '0') == '1'
+if ERP_MIRROR:
+    db.use_erp_mirror()
+# Phase times: "0" updates FP_TIMES, "1" logs phase changes in FP_PHASE_EVENTS and reads them
+# through its view, "dual" writes both and still reads FP_TIMES (while migrating)
+PHASE_EVENTS = os.getenv('PHASE_EVENTS', '0')
+if PHASE_EVENTS not in ("0", "dual", "1"):
+    raise ValueError("PHASE_EVENTS must be 0, dual or 1.")
+if PHASE_EVENTS != "0":
+    db.use_phase_events(dual=PHASE_EVENTS == "dual")
+# Optional production cache service (service.py); empty queries SQL Server directly
+SERVICE_URL = os.getenv('SERVICE_URL', '')
+SERVICE_TIMEOUT = int(os.getenv('SERVICE_TIMEOUT', '30'))
+SERVICE_TOKEN = os.getenv('SERVICE_TOKEN', '')
+if SERVICE_URL and (GRID_TREE or GRID_PAGE_SIZE > 0):
+    raise ValueError("SERVICE_URL cannot be combined with GRID_TREE or GRID_PAGE_SIZE.")
+
+# Shared connection pools (one per database)
+db.configure_pools(
+    connect_timeout=DB_CONNECT_TIMEOUT,
+    query_timeout=DB_QUERY_TIMEOUT,
+    max_size=int(os.getenv('DB_POOL_SIZE', '5')),
+    timeout=int(os.getenv('DB_POOL_TIMEOUT', '30')),
+    max_idle=int(os.getenv('DB_POOL_MAX_IDLE', '300')),
+)
+
+# Write-ahead journal of record saves: create/edit return at once and are sent to SIIAPP in the
+# background (empty keeps saves synchronous). Requires the FP_SAVE_KEYS table (see README).
+SAVE_JOURNAL_FILE = os.getenv('SAVE_JOURNAL_FILE', '')
+SAVE_JOURNAL_MAX_BACKOFF = int(os.getenv('SAVE_JOURNAL_MAX_BACKOFF', '60'))
+
+# Local snapshot of the last loaded grid, shown at startup while the database is queried
+SNAPSHOT_FILE = os.getenv('SNAPSHOT_FILE', 'grid_snapshot.json.gz')
+SNAPSHOT_MAX_AGE_HOURS = float(os.getenv('SNAPSHOT_MAX_AGE_HOURS', '72'))
+SNAPSHOT_KEY = snapshot.snapshot_key(
+    db.PARENT_QUERY if GRID_TREE else db.PRODUCTION_QUERY, GRID_SCOPES, db.OP_SIGNATURE_QUERY, db.FP_SIGNATURE_QUERY,
+    FP_PROGRES_VERSION_COLUMN, os.getenv('DB1_SERVER'), os.getenv('DB2_DATABASE'), SERVICE_URL)
+
+# Performance telemetry (see metrics.py): rotating JSON lines file and UI stall threshold
+metrics.configure(
+    os.getenv('METRICS_FILE', 'metrics.jsonl'),
+    max_bytes=int(os.getenv('METRICS_MAX_BYTES', '1000000')),
+    backups=int(os.getenv('METRICS_BACKUPS', '3')),
+)
+UI_LAG_THRESHOLD_MS = int(os.getenv('UI_LAG_THRESHOLD_MS', '200'))
+
+# Phase analytics (see analytics.py): local cache of the daily phase time aggregates
+ANALYTICS_CACHE_FILE = os.getenv('ANALYTICS_CACHE_FILE', 'analytics_cache.json.gz')
+ANALYTICS_HISTORY_DAYS = int(os.getenv('ANALYTICS_HISTORY_DAYS', '180'))
+# Recent days re-aggregated on every refresh (late or corrected phase times)
+ANALYTICS_REFRESH_DAYS = int(os.getenv('ANALYTICS_REFRESH_DAYS', '2'))
+# OPs expected to finish less than this many hours before FECHA REQUERIDA count as at risk
+ANALYTICS_RISK_MARGIN_HOURS = float(os.getenv('ANALYTICS_RISK_MARGIN_HOURS', '24'))
+ANALYTICS_KEY = snapshot.snapshot_key(
+    analytics.cycle_time_query()[0], os.getenv('DB1_SERVER'), os.getenv('DB1_DATABASE'))
+
+startup_profile.mark("configuration")
+
+# Load the grid in the background while the login screen is shown (0 waits for the login)
+PREFETCH_ON_LOGIN = os.getenv('PREFETCH_ON_LOGIN', '1') != '0'
+
+# Priority used to merge load requests: a pending full load absorbs a delta or a page load
+LOAD_PRIORITY = {"page": 0, "delta": 1, "snapshot": 2, "full": 3}
+
 
 class ScrollableFrame(ctk.CTkScrollableFrame):
     def __init__(self, master, **kwargs):
@@ -43,27 +181,32 @@ class ScrollableFrame(ctk.CTkScrollableFrame):
 
 
 class MyFrame(ctk.CTkFrame):
-    def __init__(self, master, **kwargs):
+    def __init__(self, master, prefetch=False, backend=None, **kwargs):
         super().__init__(master, **kwargs)
+        # Where the grid is read from and saves are sent to (see backends.py)
+        if backend is None:
+            if SERVICE_URL:
+                backend = backends.ServiceBackend(SERVICE_URL, SERVICE_TIMEOUT, DB_FETCH_SIZE,
+                                                  SERVICE_TOKEN)
+            else:
+                backend = backends.DirectBackend(DB_FETCH_SIZE, FP_PROGRES_VERSION_COLUMN, GRID_TREE,
+                                                 GRID_SCOPES)
+        self.backend = backend
+        # Prefetch: built and loading behind the login screen, shown by reveal() after login
+        self._hidden = prefetch
+        self._hidden_error = None
+        # Logged in user, recorded with the phase changes (set by App.show_app_frame)
+        self.user = None
 
         # Create Tksheet widget
+        Sheet = startup_profile.lazy_import("tksheet").Sheet
         self.sheet = Sheet(self)
         self.sheet.pack(fill="both", expand=True)
 
         # fases_produccion
-        self.fases = [
-            "Dispensacion",
-            "Pesaje",
-            "Fabricacion",
-            "Microbiologia",
-            "Envasado",
-            "Acondicionamiento",
-            "Embalaje",
-            "Despacho",
-            "Reproceso"
-        ]
+        self.fases = list(analytics.PHASES)
         # plantas de produccion
-        self.plantas = ["01", "02"]
+        self.plantas = list(GRID_PLANTS)
 
         # Configure column headers
         headers = [
@@ -83,10 +226,12 @@ class MyFrame(ctk.CTkFrame):
             "PLANTA",
             "COMENTARIOS/OBSERVACIONES"
         ]
+        self.headers = headers
         self.sheet.headers(headers)
 
-        # Enable row selection
-        self.sheet.enable_bindings(("single_select", "row_select"))
+        # Enable row selection (Ctrl+click / drag to select several OPs)
+        self.sheet.enable_bindings(
+            ("single_select", "row_select", "drag_select", "ctrl_select", "select_all"))
 
         # Create a scrollable frame
         self.scrollable_frame = ScrollableFrame(self)
@@ -94,9 +239,11 @@ class MyFrame(ctk.CTkFrame):
 
         # Create filter entry
         self.filter_entry = ctk.CTkEntry(
-            self.scrollable_frame, placeholder_text="Filtrar por #OP, #PEDIDO o CODIGO ITEM")
+            self.scrollable_frame,
+            placeholder_text="Filtrar por #OP, #PEDIDO o CODIGO ITEM (ej: PT1234 fase:envasado estado:proceso planta:01)")
         self.filter_entry.pack(padx=10, pady=10, fill="x")
         self.filter_entry.bind("<Return>", self.filter_data)
+        self.filter_entry.bind("<KeyRelease>", self._schedule_filter)
 
         # Create buttons
         self.button_frame = ctk.CTkFrame(self.scrollable_frame)
@@ -110,119 +257,895 @@ class MyFrame(ctk.CTkFrame):
             self.button_frame, text="Editar Registro", command=self.edit_child_record)
         self.edit_child_button.pack(side="left", padx=5)
 
+        self.bulk_phase_button = ctk.CTkButton(
+            self.button_frame, text="Mover Fase (seleccion)", command=self.bulk_phase_records)
+        self.bulk_phase_button.pack(side="left", padx=5)
+
         self.hot_reload_button = ctk.CTkButton(
             self.button_frame, text="Refrescar", command=self.reload_data)
         self.hot_reload_button.pack(side="left", padx=5)
-        # Load data from the database
-        self.load_data()
 
-    def load_data(self):
+        self.cancel_load_button = ctk.CTkButton(
+            self.button_frame, text="Cancelar", command=self.cancel_load, state="disabled")
+        self.cancel_load_button.pack(side="left", padx=5)
+
+        self.analytics_button = ctk.CTkButton(
+            self.button_frame, text="Analitica", command=self.show_analytics)
+        self.analytics_button.pack(side="left", padx=5)
+
+        self.export_button = ctk.CTkButton(
+            self.button_frame, text="Exportar", command=self.export_view)
+        self.export_button.pack(side="left", padx=5)
+
+        # Group by ESTADO OP / FASE / PLANTA (not in paged mode: only part of the data is loaded)
+        self._group_choices = {"Sin agrupar": None}
+        self._group_choices.update(
+            (f"Agrupar: {headers[col]}", col) for col in GROUP_COLUMNS)
+        if GRID_PAGE_SIZE <= 0:
+            self.group_menu = ctk.CTkOptionMenu(
+                self.button_frame, values=list(self._group_choices), command=self._set_group)
+            self.group_menu.pack(side="left", padx=5)
+        # Company selector: shows the cached rows of one company, nothing is fetched again
+        self._company = None
+        self._company_choices = {"Compania: Todas": None}
+        companies = list(dict.fromkeys(company for company, _ in GRID_SCOPES))
+        self._company_choices.update((f"Compania: {company}", company) for company in companies)
+        if len(companies) > 1:
+            self.company_menu = ctk.CTkOptionMenu(
+                self.button_frame, values=list(self._company_choices), command=self._set_company)
+            self.company_menu.pack(side="left", padx=5)
+        # Export progress, shown while an export runs
+        self.export_progress = ctk.CTkProgressBar(
+            self.button_frame, mode="determinate", width=120)
+        self.export_status_label = ctk.CTkLabel(self.button_frame, text="")
+        self._export_thread = None
+        self._export_queue = queue.Queue()
+        self._export_cancel = threading.Event()
+
+        # Save journal: pending saves are shown in the grid and counted next to the buttons
+        self.save_journal = None
+        self._journal_flusher = None
+        self._journal_queue = queue.Queue()
+        self._journal_started = False
+        self._journal_retry = None
+        self.journal_label = ctk.CTkLabel(self.button_frame, text="", text_color="orange")
+        if SAVE_JOURNAL_FILE:
+            self.save_journal = save_journal.SaveJournal(SAVE_JOURNAL_FILE)
+            self._journal_flusher = save_journal.JournalFlusher(
+                self.save_journal, self.backend,
+                lambda kind, entry, detail: self._journal_queue.put((kind, entry, detail)),
+                max_backoff=SAVE_JOURNAL_MAX_BACKOFF)
+
+        # Loading state
+        self.load_progress = ctk.CTkProgressBar(
+            self.button_frame, mode="indeterminate", width=120)
+        self.load_status_label = ctk.CTkLabel(self.button_frame, text="")
+        self.load_status_label.pack(side="left", padx=5)
+        self._status_text_color = self.load_status_label.cget("text_color")
+
+        # Background loader state
+        # Grid rows are RowView objects backed by the typed columnar store of the last full load
+        self.original_data = []
+        self.row_store = None
+        self.search_index = SearchIndex()
+        # Header click sorting (Shift+click adds a column) and grouping over typed keys
+        self.sort_index = SortIndex()
+        self._sort_spec = []
+        self._group_column = None
+        self._header_press = None
+        self._filter_job = None
+        self.sync_state = None
+        self._active_filter = ""
+        self._load_thread = None
+        self._load_queue = queue.Queue()
+        self._load_cancel = None
+        self._load_started = None
+        self._load_cursor = None
+        self._load_cursor_lock = threading.Lock()
+        self._reload_pending = None
+        # OPs whose rows must be refetched by the next delta even if SIIAPP did not change them
+        self._refetch_ops = set()
+        self._auto_refresh_job = None
+        # Paged mode: last OP loaded (keyset) and whether the server has more pages
+        self._page_after = None
+        self._page_exhausted = True
+        self.column_widths = [120, 120, 120, 500, 140,
+                              140, 140, 120, 120, 120, 120, 220, 200, 120, 600]
+        # Column widths and the FP_PROGRES highlight are set once; loads keep them
+        self.sheet.set_column_widths(self.column_widths)
+        for i in range(10, 15):
+            self.sheet.highlight_columns(
+                columns=[i], bg="lightgray", fg="black")
+        # Rows shown while a full load is still streaming in (None: not streaming)
+        self._stream_rows = None
+        self._stream_count = 0
+        # Rows on the sheet; refreshes, filters and sorts are applied as row edits (grid_view.py)
+        self.grid_view = GridView(self.sheet, GROUP_INDEX_WIDTH)
+        # Tree mode: child rows per OP ({op: [RowView]}), phase times per FP_ID, expanded OPs
+        # and the OPs waiting for the background child fetch
+        self.child_store = ProductionStore()
+        self._children = {}
+        self._child_times = {}
+        self._expanded = set()
+        self._child_pending = set()
+        self._child_thread = None
+        self._child_queue = queue.Queue()
+        self._child_cancel = threading.Event()
+        self._select_job = None
+        if GRID_TREE:
+            self.sheet.extra_bindings("all_select_events", self._on_select)
+            self.sheet.bind("<Double-Button-1>", self._toggle_children)
+        if GRID_PAGE_SIZE <= 0:
+            # Added after tksheet's own handlers, which tell a click from a column resize
+            self.sheet.CH.bind("<ButtonPress-1>", self._on_header_press, add="+")
+            self.sheet.CH.bind("<ButtonRelease-1>", self._on_header_release, add="+")
+        # Phase analytics: aggregate cache kept for the session, loaded on first use
+        self.analytics_cache = None
+        self.analytics_window = None
+
+        # The snapshot only makes sense when the whole dataset is held locally
+        self._snapshot_writer = None
+        self._stale = False
+        if SNAPSHOT_FILE and GRID_PAGE_SIZE <= 0:
+            self._snapshot_writer = snapshot.SnapshotWriter(SNAPSHOT_FILE, SNAPSHOT_KEY)
+
+        # Show the last snapshot right away, then load from the database
+        self.load_data("snapshot" if self._snapshot_writer else "full")
+        self._schedule_auto_refresh()
+        if GRID_PAGE_SIZE > 0:
+            self._watch_scroll()
+        # Behind the login screen the journal waits for reveal()
+        if not self._hidden:
+            self._start_journal()
+
+    def load_data(self, mode="full"):
+        # Merge requests that arrive while a load is already running; the strongest one wins
+        if self._load_thread is not None and self._load_thread.is_alive():
+            if self._reload_pending is None or LOAD_PRIORITY[mode] > LOAD_PRIORITY[self._reload_pending]:
+                self._reload_pending = mode
+            return
+
+        if mode == "delta" and self._refetch_ops:
+            self.sync_state = db.forget_ops(self.sync_state, self._refetch_ops)
+            self._refetch_ops = set()
+        if mode == "delta" and self.sync_state is None:
+            mode = "full"
+        if mode == "page" and self._page_exhausted:
+            return
+        # In paged mode the filter is pushed into the SQL WHERE clause
+        terms = parse_query(self._active_filter) if GRID_PAGE_SIZE > 0 else ()
+        after_op = self._page_after if mode == "page" else None
+        self._reload_pending = None
+        # Stream the first load into an empty grid; otherwise keep showing the current rows
+        # until the new dataset is complete
+        streaming = (mode == "full" and GRID_PAGE_SIZE <= 0
+                     and not self.original_data and not self._narrowed())
+        self._stream_rows = [] if streaming else None
+        self._stream_count = 0
+        self._load_cancel = threading.Event()
+        self._load_started = time.monotonic()
+        self._load_queue = queue.Queue()
+        self._set_loading_state(True)
+
+        self._load_thread = threading.Thread(
+            target=self._load_worker,
+            args=(mode, terms, after_op, self._load_cancel, self._load_queue), daemon=True)
+        self._load_thread.start()
+        self.after(100, self._poll_load)
+
+    def _load_worker(self, mode, terms, after_op, cancel_event, result_queue):
+        def on_cursor(cursor):
+            with self._load_cursor_lock:
+                self._load_cursor = cursor
+
         try:
-            # Connect to the database
-            conn_str = (
-                f"DRIVER={os.getenv('DB1_DRIVER')};"
-                f"SERVER={os.getenv('DB1_SERVER')};"
-                f"DATABASE={os.getenv('DB2_DATABASE')};"
-                f"UID={os.getenv('DB1_UID')};"
-                f"PWD={os.getenv('DB1_PWD')}"
-            )
-            conn = pyodbc.connect(conn_str)
-            cursor = conn.cursor()
-
-            # Fetch data from the database using parameterized query
-            query = """
-                SELECT
-                    pd_ordenproceso.orpconsecutivo AS [# OP]
-                    ,pd_ordenproceso.orpconspedi AS [# PEDIDO]
-                    ,pd_ordenproceso.orpcodiitem AS [CODIGO ITEM]
-                    ,in_items.itedesclarg AS [DESCRIPCION ITEM]
-                    ,pd_ordenproceso.orpfecharequ AS [FECHA REQUERIDA]
-                    ,pd_ordenproceso.orpfechaentrega AS [FECHA ENTREGA PLANTA]
-                    ,pd_ordenproceso.orpfechestifin AS [FECHA ESTIMADO FIN]
-                    ,pd_ordenproceso.orpcantrequump AS [CANTIDAD PEDIDA]
-                    ,pd_ordenproceso.eobnombre AS [ESTADO OP]
-                    ,pd_ordenproceso.orpcompania
-                    ,FP_PROGRES.FP_ID
-                    ,FP_PROGRES.CANTIDAD_FP AS [CANTIDAD EN PRODUCCION]
-                    ,FP_PROGRES.FASE_PODUCC AS [FASE DE PRODUCCION]
-                    ,FP_PROGRES.PLANTA AS PLANTA
-                    ,FP_PROGRES.COMENTARIES AS [COMENTARIOS/OBSERVACIONES]
-                    FROM ssf_genericos.dbo.pd_ordenproceso
-                    INNER JOIN ssf_genericos.dbo.in_items
-                    ON pd_ordenproceso.orpcodiitem = in_items.itecodigo
-                        AND pd_ordenproceso.orpcompania = in_items.itecompania
-                    LEFT OUTER JOIN SIIAPP.dbo.FP_PROGRES
-                    ON pd_ordenproceso.orpconsecutivo = FP_PROGRES.orpconsecutivo COLLATE Latin1_General_CI_AS
-                    LEFT OUTER JOIN SIIAPP.dbo.FP_TIMES
-                    ON FP_TIMES.FP_ID = FP_PROGRES.FP_ID
-                    WHERE pd_ordenproceso.orpcompania = ?
-                    AND in_items.itecompania = ?
-                    AND pd_ordenproceso.eobcodigo IN (?, ?, ?)
-                    ORDER BY [# OP]
-            """
-            params = ('01', '01', 'EF', 'PE', 'EE')
-            cursor.execute(query, params)
-            data = cursor.fetchall()
-
-            # Insert data into the Tksheet
-            formatted_data = []
-            for row in data:
-                parent_row = [
-                    str(value) if value is not None else "" for value in row[:10]]
-                fp_progres_values = row[10:]
-
-                if any(fp_progres_values):
-                    parent_row.extend(
-                        str(value) if value is not None else "" for value in fp_progres_values)
+            if mode == "delta":
+                # Changed rows are appended to the current store; replaced rows are released later
+                delta = self.backend.fetch_delta(
+                    self.row_store, self.sync_state, cancel_event, on_cursor=on_cursor)
+                if delta is not None:
+                    result_queue.put(("delta", delta))
+                    return
+                # The service could not answer from its change log: reload everything
+                mode = "full"
+            if mode == "snapshot":
+                cached = snapshot.load_snapshot(
+                    SNAPSHOT_FILE, SNAPSHOT_KEY, SNAPSHOT_MAX_AGE_HOURS * 3600)
+                if cached is None:
+                    result_queue.put(("snapshot", None))
+                    return
+                exported, sync_state, taken_at = cached
+                with metrics.timer("snapshot", "format", rows=len(exported)):
+                    store = ProductionStore()
+                    rows = [store.append_exported(values) for values in exported]
+                with metrics.timer("snapshot", "index", rows=len(rows)):
+                    search_index = SearchIndex()
+                    search_index.rebuild(rows)
+                result_queue.put(("snapshot", (rows, store, sync_state, search_index, taken_at)))
+            elif mode == "page":
+                rows, last_op, exhausted, _ = self.backend.fetch_page(
+                    self.row_store, cancel_event, terms, after_op, GRID_PAGE_SIZE, on_cursor=on_cursor)
+                result_queue.put(("page", (rows, last_op, exhausted)))
+            else:
+                # A full load starts a fresh store, which also drops rows released by deltas
+                store = ProductionStore()
+                if GRID_PAGE_SIZE > 0:
+                    formatted_data, last_op, exhausted, sync_state = self.backend.fetch_page(
+                        store, cancel_event, terms, None, GRID_PAGE_SIZE, on_cursor=on_cursor,
+                        with_sync_state=True)
                 else:
-                    # Add empty cells for FP_PROGRES columns
-                    parent_row.extend([""] * 5)
-
-                formatted_data.append(parent_row)
+                    formatted_data, sync_state = self.backend.fetch_full(
+                        store, cancel_event, on_cursor=on_cursor,
+                        on_batch=lambda batch: result_queue.put(("batch", batch)))
+                    last_op, exhausted = None, True
+                # Build the search index off the main thread as well
+                with metrics.timer("full_load", "index", rows=len(formatted_data)):
+                    search_index = SearchIndex()
+                    search_index.rebuild(formatted_data)
+                result_queue.put(
+                    ("done", (formatted_data, store, sync_state, search_index, last_op, exhausted)))
+        except LoadCancelled:
+            result_queue.put(("cancelled", None))
+        except Exception as e:
+            result_queue.put(("error", e))
+
+    def _poll_load(self):
+        if not self.winfo_exists():
+            return
+        batches = []
+        try:
+            while True:
+                kind, payload = self._load_queue.get_nowait()
+                if kind == "batch":
+                    # Batches queued since the last tick are shown with a single sheet update
+                    batches.append(payload)
+                    continue
+                if batches:
+                    self._append_stream(batches)
+                self._finish_load(kind, payload)
+                return
+        except queue.Empty:
+            pass
+        if batches:
+            self._append_stream(batches)
+        if self._load_started is not None:
+            elapsed = time.monotonic() - self._load_started
+            if self.load_status_label.cget("text").startswith("Cargando datos"):
+                self.load_status_label.configure(
+                    text=f"Cargando datos... ({elapsed:.0f}s)")
+        self.after(100, self._poll_load)
+
+    def _append_stream(self, batches):
+        self._stream_count += sum(len(batch) for batch in batches)
+        elapsed = time.monotonic() - self._load_started
+        self.load_status_label.configure(
+            text=f"Cargando... {self._stream_count} filas ({elapsed:.0f}s)")
+        if self._stream_rows is None:
+            return
+        if self._narrowed() or self._custom_order():
+            # A filter or sort chosen while streaming: applied when the complete dataset arrives
+            self._stream_rows = None
+            return
+        rows = [row for batch in batches for row in batch]
+        with metrics.timer("full_load", "stream_render", rows=len(rows)):
+            if not self._stream_rows:
+                # First rows: the sheet keeps this list and grows it with every insert
+                self._stream_rows = rows
+                self.grid_view.show(self._stream_rows)
+                startup_profile.mark("first rows visible")
+            else:
+                self.grid_view.append(rows)
+
+    def _finish_load(self, kind, payload):
+        started = self._load_started
+        stream_rows = self._stream_rows
+        self._stream_rows = None
+        self._set_loading_state(False)
+        if kind == "snapshot":
+            if payload is None:
+                # No usable snapshot: fall back to a regular full load
+                self._reload_pending = None
+                self.load_data("full")
+                return
+            formatted_data, self.row_store, self.sync_state, self.search_index, taken_at = payload
+            self._stale = True
+            self._reset_children()
+            self.apply_data(formatted_data)
+            self._reapply_pending_saves()
+            taken = datetime.fromtimestamp(taken_at).strftime('%d/%m %H:%M')
+            self.load_status_label.configure(
+                text=f"{len(formatted_data)} filas de {taken} (desactualizado) - sincronizando...",
+                text_color="orange")
+            # Reconcile with the database: a delta from the snapshot's sync state, or a full load
+            if self._reload_pending != "full":
+                self._reload_pending = "delta" if self.sync_state is not None else "full"
+        elif kind == "done":
+            (formatted_data, self.row_store, self.sync_state, self.search_index,
+             self._page_after, self._page_exhausted) = payload
+            self._stale = False
+            self._reset_children()
+            # Scopes stream in parallel: their batches arrive interleaved, not in # OP order
+            streamed = (stream_rows is not None and not self._narrowed()
+                        and len(stream_rows) == len(formatted_data)
+                        and (len(GRID_SCOPES) == 1
+                             or all(a is b for a, b in zip(stream_rows, formatted_data))))
+            self.apply_data(formatted_data, streamed=streamed)
+            self._update_row_count()
+            self._save_snapshot()
+            self._reapply_pending_saves()
+        elif kind == "page":
+            rows, self._page_after, self._page_exhausted = payload
+            self.append_page(rows)
+            self._update_row_count()
+        elif kind == "delta":
+            touched, removed, changed_rows, self.sync_state = payload
+            self._stale = False
+            self.apply_delta(touched, removed, changed_rows)
+            self._update_row_count(f" ({len(touched | removed)} OP actualizadas)")
+            if touched or removed:
+                self._save_snapshot()
+                self._reapply_pending_saves(touched | removed)
+        elif kind == "cancelled":
+            self._discard_stream(stream_rows)
+            self.load_status_label.configure(text="Carga cancelada")
+        else:
+            self._discard_stream(stream_rows)
+            logging.error(f"An error occurred while loading data: {str(payload)}")
+            self.load_status_label.configure(text="Error al cargar")
+            if self._hidden:
+                # Do not interrupt the login screen; the error is reported once the grid is shown
+                self._hidden_error = payload
+            else:
+                messagebox.showerror(
+                    "Error", "An error occurred while loading data. Please check the logs for more information.")
 
-            self.original_data = formatted_data
-            self.sheet.set_sheet_data(formatted_data)
-            # Configure column widths
-            self.column_widths = [120, 120, 120, 500, 140,
-                                  140, 140, 120, 120, 120, 120, 220, 200, 120, 600]
+        if kind in ("snapshot", "done", "page", "delta") and started is not None:
+            # From the click (or timer) to the updated grid
+            metrics.record(kind, "total", time.monotonic() - started, rows=len(self.original_data))
 
-            for i, width in enumerate(self.column_widths):
-                self.sheet.column_width(column=i, width=width)
+        # Run the single merged refresh requested while this load was running
+        if self._reload_pending:
+            self.load_data(self._reload_pending)
 
-            # Highlight FP_PROGRES columns
-            for i in range(10, 15):
-                self.sheet.highlight_columns(
-                    columns=[i], bg="lightgray", fg="black")
+    def _discard_stream(self, stream_rows):
+        # An interrupted stream leaves partial rows on the sheet: go back to the loaded data
+        if stream_rows:
+            self.grid_view.show(list(self.original_data))
 
-        except pyodbc.Error as e:
-            logging.error(f"An error occurred while loading data: {str(e)}")
+    def reveal(self):
+        self._hidden = False
+        if self._hidden_error is not None:
+            self._hidden_error = None
             messagebox.showerror(
                 "Error", "An error occurred while loading data. Please check the logs for more information.")
-        finally:
-            # Close the database connection and cursor
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.close()
+        self._start_journal()
+
+    def discard(self):
+        # Drop a prefetched frame (failed login): stop timers and the running load
+        if self._auto_refresh_job is not None:
+            self.after_cancel(self._auto_refresh_job)
+            self._auto_refresh_job = None
+        if self._filter_job is not None:
+            self.after_cancel(self._filter_job)
+            self._filter_job = None
+        self.cancel_load()
+        self._child_cancel.set()
+        self._export_cancel.set()
+        if self._journal_flusher is not None:
+            self._journal_flusher.stop()
+            self.save_journal.close()
+        self.destroy()
+
+    def _update_row_count(self, detail=""):
+        more = "" if self._page_exhausted else " (desplace para cargar mas)"
+        missing = db.missing_scopes(GRID_SCOPES, self.sync_state)
+        if missing:
+            # Their rows are loaded by the next refresh
+            more += f" - sin datos de {', '.join(db.scope_key(scope) for scope in missing)}"
+        self.load_status_label.configure(
+            text=f"{len(self.original_data)} filas{detail}{more} - {datetime.now().strftime('%H:%M:%S')}",
+            text_color=self._status_text_color)
+
+    def _save_snapshot(self):
+        if self.save_journal is not None and self.save_journal.pending():
+            # The grid shows saves that are not in the database yet; write it once they are
+            return
+        if self._snapshot_writer is not None:
+            # Rows are replaced, never mutated, so a shallow copy is a consistent snapshot;
+            # the writer thread exports the typed values
+            self._snapshot_writer.submit(list(self.original_data), self.sync_state)
+
+    def _set_loading_state(self, loading):
+        if loading:
+            self.hot_reload_button.configure(state="disabled")
+            self.cancel_load_button.configure(state="normal")
+            if not self._stale:
+                # Keep the "desactualizado" notice visible while a snapshot is reconciled
+                self.load_status_label.configure(text="Cargando datos...")
+            self.load_progress.pack(side="left", padx=5, before=self.load_status_label)
+            self.load_progress.start()
+        else:
+            self.load_progress.stop()
+            self.load_progress.pack_forget()
+            self.hot_reload_button.configure(state="normal")
+            self.cancel_load_button.configure(state="disabled")
+            self._load_started = None
+
+    def cancel_load(self):
+        if self._load_cancel is None:
+            return
+        self._reload_pending = None
+        self._load_cancel.set()
+        with self._load_cursor_lock:
+            cursor = self._load_cursor
+        if cursor is not None:
+            try:
+                # Abort the statement currently running on the server
+                cursor.cancel()
+            except db.driver_error() as e:
+                logging.error(f"An error occurred while cancelling load: {str(e)}")
+
+    def _schedule_auto_refresh(self):
+        if AUTO_REFRESH_SECONDS > 0:
+            self._auto_refresh_job = self.after(
+                AUTO_REFRESH_SECONDS * 1000, self._auto_refresh)
+
+    def _auto_refresh(self):
+        if not self.winfo_exists():
+            return
+        self.load_data("delta")
+        self._schedule_auto_refresh()
+
+    def _watch_scroll(self):
+        # Paged mode: fetch the next page when the view gets close to the last loaded row
+        if not self.winfo_exists():
+            return
+        loading = self._load_thread is not None and self._load_thread.is_alive()
+        if not loading and not self._page_exhausted and self.original_data:
+            if self.sheet.get_yview()[1] >= 0.9:
+                self.load_data("page")
+        self.after(250, self._watch_scroll)
+
+    def apply_data(self, formatted_data, streamed=False):
+        startup_profile.mark("first grid data")
+        self.original_data = formatted_data
+        self.sort_index.rebuild(formatted_data)
+        if self._narrowed() or self._expanded or self._custom_order():
+            self._show_rows()
+        elif not streamed:
+            # The sheet gets its own row list so deltas can be mirrored row by row
+            # (a streamed load already built that list batch by batch). A reload only edits the
+            # rows that changed and keeps the selection and scroll position
+            with metrics.timer("grid", "render", rows=len(formatted_data)) as m:
+                m.update(self.grid_view.show(list(formatted_data)))
+
+    def append_page(self, rows):
+        # Rows of a new page come after everything loaded so far and already match the filter
+        if not rows:
+            return
+        self.original_data.extend(rows)
+        self.search_index.add_rows(rows)
+        with metrics.timer("page", "render", rows=len(rows)):
+            self.grid_view.append(rows)
+
+    def apply_delta(self, touched, removed, changed_rows):
+        if GRID_PAGE_SIZE > 0 and not self._page_exhausted and self._page_after is not None:
+            # Only patch OPs inside the pages already loaded; later pages are fetched fresh
+            limit = db.op_sort_key(self._page_after)
+            touched = {key for key in touched if db.op_sort_key(key[1]) <= limit}
+            fetched = len(changed_rows)
+            changed_rows = [row for row in changed_rows if db.op_key(row) in touched]
+            self.row_store.release(fetched - len(changed_rows))
+        if not touched and not removed:
+            return
+        with metrics.timer("delta", "patch", rows=len(changed_rows)):
+            deleted, inserted = db.apply_production_delta(
+                self.original_data, touched, removed, changed_rows)
+            self.row_store.release(len(deleted))
+            self.search_index.remove_ops(touched | removed)
+            self.search_index.add_rows(changed_rows)
+            self.sort_index.remove_ops(touched | removed)
+            self.sort_index.add_rows(changed_rows)
+        if self.row_store.needs_reload() and self._reload_pending is None:
+            # Mostly released rows: a full load rebuilds a compact store
+            self._reload_pending = "full"
+        if GRID_TREE:
+            self._invalidate_children(touched, removed)
+        if self._narrowed() or self._expanded or self._custom_order():
+            # Expanded children shift the sheet rows: rebuild the list instead of mirroring edits
+            self._show_rows()
+            return
+
+        # Mirror the same row edits on the sheet instead of reloading it
+        with metrics.timer("delta", "render", rows=len(deleted) + len(changed_rows)):
+            self.grid_view.apply(deleted, inserted)
+
+    def _schedule_filter(self, event):
+        # Debounce: filter once the user pauses typing
+        if event.keysym == "Return":
+            return
+        if self._filter_job is not None:
+            self.after_cancel(self._filter_job)
+        self._filter_job = self.after(FILTER_DEBOUNCE_MS, self._filter_if_changed)
+
+    def _filter_if_changed(self):
+        self._filter_job = None
+        if self.filter_entry.get().strip().lower() != self._active_filter:
+            self.filter_data(None)
 
     def filter_data(self, event):
-        self.column_widths = [120, 120, 120, 500, 140,
-                              140, 140, 120, 120, 120, 120, 220, 200, 120, 600]
-        op_filter = self.filter_entry.get().lower()
-        if op_filter:
-            filtered_data = [
-                row for row in self.original_data
-                if op_filter in str(row[0]).lower() or  # Search by "# OP"
-                op_filter in str(row[1]).lower() or  # Search by "# PEDIDO"
-                op_filter in str(row[2]).lower()  # Search by "Codigo Item"
-            ]
-            self.sheet.set_sheet_data(filtered_data)
-            for i, width in enumerate(self.column_widths):
-                self.sheet.column_width(column=i, width=width)
+        if self._filter_job is not None:
+            self.after_cancel(self._filter_job)
+            self._filter_job = None
+        self._active_filter = self.filter_entry.get().strip().lower()
+        if GRID_PAGE_SIZE > 0:
+            # Paged mode never holds the full result set: ask the server for the first filtered page
+            self.load_data("full")
+        else:
+            self._show_rows()
+
+    def _narrowed(self):
+        # Whether the filter box or the company selector hides rows
+        return bool(self._active_filter) or self._company is not None
+
+    def _set_company(self, choice):
+        self._company = self._company_choices[choice]
+        self._show_rows()
+
+    def _show_rows(self):
+        filtered_data = None
+        if self._narrowed():
+            query = self._active_filter
+            if self._company is not None:
+                query = f'{query} compania:"{self._company}"'
+            with metrics.timer("filter", "search") as m:
+                filtered_data = self.search_index.search(query)
+                m["rows"] = len(filtered_data or ())
+        if self._custom_order():
+            # Reuses the cached order of the whole dataset; only the first use of a sort sorts
+            with metrics.timer("sort", "order", columns=len(self._sort_spec)) as m:
+                filtered_data = self.sort_index.ordered(
+                    filtered_data, self._sort_spec, self._group_column)
+                m["rows"] = len(filtered_data)
+        if filtered_data is None:
+            filtered_data = list(self.original_data)
+        group_labels = None
+        if self._group_column is not None:
+            # Group names go in the row index, on the first row of every group
+            group_labels = {id(filtered_data[start]): f"{label or '(vacio)'} ({count})"
+                            for start, count, label in self.sort_index.groups(
+                                filtered_data, self._group_column)}
+        if self._expanded:
+            filtered_data = self._with_children(filtered_data)
+        # Only the rows that came and went are edited on the sheet
+        with metrics.timer("filter", "render", rows=len(filtered_data)) as m:
+            m.update(self.grid_view.show(filtered_data, group_labels))
+
+    def _custom_order(self):
+        return bool(self._sort_spec) or self._group_column is not None
+
+    def _on_header_press(self, event):
+        header = self.sheet.CH
+        self._header_press = (event.x, header.rsz_w is None and header.rsz_h is None)
+
+    def _on_header_release(self, event):
+        press, self._header_press = self._header_press, None
+        # Ignore column resizes and drags
+        if press is None or not press[1] or abs(event.x - press[0]) > 3:
+            return
+        col = self.sheet.identify_column(event, allow_end=False)
+        if col is not None:
+            # Shift+click adds the column as a further sort key
+            self._toggle_sort(col, add=bool(event.state & 0x0001))
+
+    def _toggle_sort(self, col, add=False):
+        # Each click on a sort column: ascending, descending, unsorted
+        columns = [c for c, _ in self._sort_spec]
+        if not add and columns != [col]:
+            self._sort_spec = [(col, False)]
+        elif col in columns:
+            index = columns.index(col)
+            if self._sort_spec[index][1]:
+                del self._sort_spec[index]
+            else:
+                self._sort_spec[index] = (col, True)
+        else:
+            self._sort_spec.append((col, False))
+        self._update_headers()
+        self._show_rows()
+
+    def _set_group(self, choice):
+        self._group_column = self._group_choices[choice]
+        self._show_rows()
+
+    def _update_headers(self):
+        labels = list(self.headers)
+        for position, (col, descending) in enumerate(self._sort_spec):
+            number = str(position + 1) if len(self._sort_spec) > 1 else ""
+            labels[col] = f"{labels[col]} {'▼' if descending else '▲'}{number}"
+        self.sheet.headers(labels)
+
+    def _with_children(self, rows):
+        # Tree mode: every expanded OP is followed by its cached progress records
+        result = []
+        for row in rows:
+            result.append(row)
+            if row[10] == "" and db.op_key(row) in self._expanded:
+                result.extend(self._children.get(db.op_key(row), ()))
+        return result
+
+    def _on_select(self, event=None):
+        # Tree mode: fetch the records of the selected OPs once the selection settles
+        if self._select_job is not None:
+            self.after_cancel(self._select_job)
+        self._select_job = self.after(150, self._selection_changed)
+
+    def _selection_changed(self):
+        self._select_job = None
+        rows = [self.grid_view.rows[r] for r in self.sheet.get_selected_rows(get_cells_as_rows=True)
+                if r < len(self.grid_view.rows)]
+        if len(rows) <= TREE_SELECTION_FETCH_LIMIT:
+            self._request_children(db.op_key(row) for row in rows if row[10] == "")
+        if len(rows) == 1:
+            self.load_status_label.configure(
+                text=self._describe_row(rows[0]), text_color=self._status_text_color)
+
+    def _describe_row(self, row):
+        op = row[0]
+        if row[10] != "":
+            # Child: current phase start and the time spent in the completed phases
+            times = self._child_times.get(row.value(10), {})
+            done = [f"{fase} {(end - start).total_seconds() / 3600:.1f} h"
+                    for fase, (start, end) in times.items()
+                    if isinstance(start, datetime) and isinstance(end, datetime) and fase != row[12]]
+            start = times.get(row[12], (None, None))[0]
+            since = f" desde {start.strftime('%d/%m %H:%M')}" if isinstance(start, datetime) else ""
+            return f"FP {row[10]}: {row[12]}{since}" + (f" | {', '.join(done)}" if done else "")
+        children = self._children.get(db.op_key(row))
+        if children is None:
+            return f"OP {op}: cargando registros..."
+        return f"OP {op}: {len(children)} registros (doble clic para expandir)"
+
+    def _toggle_children(self, event):
+        r = self.sheet.identify_row(event, allow_end=False)
+        if r is None or r >= len(self.grid_view.rows):
+            return
+        row = self.grid_view.rows[r]
+        key = db.op_key(row)
+        if row[10] != "":
+            return
+        if key in self._expanded:
+            self._expanded.discard(key)
+            count = len(self._children.get(key, ()))
+            if count and self.grid_view.index_shown:
+                # The group names in the row index would shift: rebuild the rows
+                self._show_rows()
+            elif count:
+                self.grid_view.apply(deleted=list(range(r + 1, r + 1 + count)))
+            return
+        self._expanded.add(key)
+        children = self._children.get(key)
+        if children is None:
+            # Shown by _store_children when the fetch completes
+            self._request_children([key])
+        elif children and self.grid_view.index_shown:
+            self._show_rows()
+        elif children:
+            self.grid_view.apply(inserted=[(r + 1, children)])
+
+    def _request_children(self, keys):
+        # Records of (company, # OP) keys, see db.op_key
+        self._child_pending.update(key for key in keys if key not in self._children)
+        if not self._child_pending or (self._child_thread is not None and self._child_thread.is_alive()):
+            return
+        keys = sorted(self._child_pending, key=lambda key: (db.op_sort_key(key[1]), key[0]))
+        self._child_pending.clear()
+        self._child_thread = threading.Thread(
+            target=self._children_worker, args=(keys, self._child_cancel, self._child_queue), daemon=True)
+        self._child_thread.start()
+        self.after(100, self._poll_children)
+
+    def _children_worker(self, keys, cancel_event, result_queue):
+        try:
+            result_queue.put(("children", db.fetch_fp_children(keys, cancel_event)))
+        except LoadCancelled:
+            pass
+        except Exception as e:
+            result_queue.put(("error", e))
+
+    def _poll_children(self):
+        if not self.winfo_exists():
+            return
+        try:
+            kind, payload = self._child_queue.get_nowait()
+        except queue.Empty:
+            self.after(100, self._poll_children)
+            return
+        if kind == "children":
+            self._store_children(*payload)
         else:
-            self.sheet.set_sheet_data(self.original_data)
-            for i, width in enumerate(self.column_widths):
-                self.sheet.column_width(column=i, width=width)
+            logging.error(f"An error occurred while loading progress records: {str(payload)}")
+            self.load_status_label.configure(text="Error al cargar registros", text_color="red")
+        # Selections made while this fetch was running
+        self._request_children(())
+
+    def _store_children(self, children, times):
+        # Cache the fetched records, then show the ones of expanded OPs under their parent
+        shown = {}
+        for key, records in children.items():
+            if key in self._children:
+                continue
+            self._children[key] = [child_row(self.child_store, key[1], record) for record in records]
+            self._reapply_pending_saves({key}, render=False)
+            if key in self._expanded and self._children[key]:
+                shown[key] = self._children[key]
+        self._child_times.update(times)
+        if shown and self.grid_view.index_shown:
+            self._show_rows()
+        elif shown:
+            positions = [(i, shown[db.op_key(row)]) for i, row in enumerate(self.grid_view.rows)
+                         if row[10] == "" and db.op_key(row) in shown]
+            # Ascending insert positions, shifted by the rows inserted before them
+            inserted = []
+            offset = 1
+            for idx, rows in positions:
+                inserted.append((idx + offset, rows))
+                offset += len(rows)
+            self.grid_view.apply(inserted=inserted)
+        self._selection_changed()
+
+    def _invalidate_children(self, touched, removed):
+        # Records of changed OPs are fetched again; expanded ones are re-shown on arrival
+        for key in touched | removed:
+            for row in self._children.pop(key, ()):
+                self._child_times.pop(row.value(10), None)
+        self._expanded -= removed
+        self._request_children(touched & self._expanded)
+
+    def _reset_children(self):
+        # A new dataset: drop every cached record, fetch the expanded ones again
+        self.child_store = ProductionStore()
+        self._children.clear()
+        self._child_times.clear()
+        self._request_children(list(self._expanded))
+
+    def _start_journal(self):
+        if self._journal_flusher is None or self._journal_started:
+            return
+        self._journal_started = True
+        self._journal_flusher.start()
+        self._update_journal_label()
+        # Failures of the previous session the user has not seen yet
+        self.after(250, self._poll_journal)
+
+    def _poll_journal(self):
+        if not self.winfo_exists():
+            return
+        settled = False
+        while True:
+            try:
+                kind, entry, detail = self._journal_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "retry":
+                self._journal_retry = detail
+            else:
+                self._journal_retry = None
+                settled = True
+                if kind == "failed":
+                    # SIIAPP still has the old rows, so the OP's checksum did not move
+                    self._refetch_ops.add(self._entry_key(entry))
+        if settled:
+            # Show what SIIAPP has now: saved records get their FP_ID, failed ones disappear
+            self.reload_data()
+        self._update_journal_label()
+        failures = self.save_journal.failures()
+        if failures:
+            self._show_save_failures(failures)
+        self.after(250, self._poll_journal)
+
+    def _update_journal_label(self):
+        pending = len(self.save_journal.pending())
+        if not pending:
+            self.journal_label.pack_forget()
+            return
+        retry = f" (sin conexion, reintento en {self._journal_retry}s)" if self._journal_retry else ""
+        self.journal_label.configure(text=f"{pending} cambios sin guardar{retry}")
+        self.journal_label.pack(side="left", padx=5, before=self.load_status_label)
+
+    def _show_save_failures(self, failures):
+        lines = []
+        for entry in failures:
+            values = entry["values"]
+            action = "Nuevo registro" if entry["kind"] == "create" else f"Registro {entry['fp_id']}"
+            reason = "modificado por otro usuario" if entry["conflict"] else "error al guardar"
+            lines.append(f"OP {entry['op']} - {action} ({values['fase']}, {values['planta']}, "
+                         f"{values['cantidad']}): {reason}")
+        messagebox.showwarning(
+            "Cambios no guardados",
+            "Los siguientes cambios no se pudieron guardar en SIIAPP:\n\n" + "\n".join(lines)
+            + "\n\nRevise los registros y vuelva a ingresarlos si es necesario.")
+        self.save_journal.acknowledge([entry["key"] for entry in failures])
+
+    def _queue_save(self, kind, op, company, fp_id, values, expected=None):
+        # Journal the save (fsync'd), show it in the grid at once and let the flusher send it
+        try:
+            entry = self.save_journal.append(kind, op, company, fp_id, values, expected, self.user)
+        except OSError as e:
+            logging.error(f"An error occurred while writing the save journal: {str(e)}")
+            messagebox.showerror(
+                "Error", "An error occurred while saving the record. Please check the logs for more information.")
+            return False
+        self._apply_optimistic([entry])
+        self._journal_flusher.wake()
+        self._update_journal_label()
+        return True
+
+    def _reapply_pending_saves(self, keys=None, render=True):
+        # Fresh rows from SIIAPP do not have the saves still in the journal: show them again
+        if self.save_journal is None:
+            return
+        entries = [entry for entry in self.save_journal.pending()
+                   if keys is None or self._entry_key(entry) in keys]
+        if entries:
+            self._apply_optimistic(entries, render)
+
+    @staticmethod
+    def _entry_key(entry):
+        # (company, # OP) of a journaled save, like db.op_key of its grid rows
+        return (str(entry["company"]), str(entry["op"]))
+
+    @staticmethod
+    def _journal_record(entry, company, fp_id):
+        # Progress columns 9-14 of a journaled save, as the production query returns them
+        values = entry["values"]
+        return (company, fp_id, values["cantidad"], values["fase"], values["planta"], values["comentarios"])
+
+    def _apply_optimistic(self, entries, render=True):
+        by_op = {}
+        for entry in entries:
+            by_op.setdefault(self._entry_key(entry), []).append(entry)
+        if GRID_TREE:
+            # Cached records only: the others are patched when they are fetched (_store_children)
+            shown = False
+            for key, op_entries in by_op.items():
+                children = self._children.get(key)
+                if children is None:
+                    continue
+                for entry in op_entries:
+                    if entry["kind"] == "create":
+                        children.append(child_row(self.child_store, key[1], self._journal_record(
+                            entry, entry["company"], PENDING_FP_ID)))
+                        continue
+                    for i, child in enumerate(children):
+                        if child.value(10) == entry["fp_id"]:
+                            children[i] = child_row(self.child_store, key[1], self._journal_record(
+                                entry, child.value(9), entry["fp_id"]))
+                shown = shown or key in self._expanded
+            if shown and render:
+                self._show_rows()
+            return
+
+        # Flat grid: replace the rows of each OP like a delta would
+        current = {}
+        for row in self.original_data:
+            if db.op_key(row) in by_op:
+                current.setdefault(db.op_key(row), []).append(
+                    tuple(row.value(col) for col in range(COLUMN_COUNT)))
+        changed_rows = []
+        for key, rows in current.items():
+            for entry in by_op[key]:
+                if entry["kind"] == "create":
+                    # The blank row of an OP without records becomes the new record
+                    head = rows[0][:9]
+                    rows = [row for row in rows if row[10] is not None]
+                    rows.append(head + self._journal_record(entry, entry["company"], PENDING_FP_ID))
+                else:
+                    rows = [row[:9] + self._journal_record(entry, row[9], row[10])
+                            if row[10] == entry["fp_id"] else row for row in rows]
+            changed_rows.extend(self.row_store.append_raw(row) for row in rows)
+        if current:
+            self.apply_delta(set(current), set(), changed_rows)
 
     def create_child_record(self):
         selected_rows = self.sheet.get_selected_rows()
@@ -278,64 +1201,31 @@ class MyFrame(ctk.CTkFrame):
                         "Error", "Por favor llene todos los campos antes de guardar el registro.")
                     return child_window.destroy()
 
-                # Define cursor variable outside try block
-                cursor = None
-                try:
+                if self.save_journal is not None:
+                    try:
+                        float(cantidad_fp)
+                    except ValueError:
+                        messagebox.showerror("Error", "La cantidad debe ser un numero.")
+                        return
+                    values = {"cantidad": cantidad_fp, "fase": fase_producc, "planta": planta,
+                              "comentarios": comentarios}
+                    if self._queue_save("create", op_value, it_comp, None, values):
+                        child_window.destroy()
+                    return
 
-                    # Insert the child record into the database using parameterized query
-                    conn_str = (
-                        f"DRIVER={os.getenv('DB1_DRIVER')};"
-                        f"SERVER={os.getenv('DB1_SERVER')};"
-                        f"DATABASE={os.getenv('DB1_DATABASE')};"
-                        f"UID={os.getenv('DB1_UID')};"
-                        f"PWD={os.getenv('DB1_PWD')}"
-                    )
-                    conn = pyodbc.connect(conn_str)
-                    cursor = conn.cursor()
-
-                    insert_query = """
-                        INSERT INTO FP_PROGRES (orpconsecutivo, orpcompania, CANTIDAD_FP, FASE_PODUCC, PLANTA, COMENTARIES)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    """
-                    params = (op_value, it_comp, cantidad_fp,
-                              fase_producc, planta, comentarios)
-                    cursor.execute(insert_query, params)
-                    conn.commit()
-
-                    # Get the last inserted FP_ID
-                    cursor.execute("SELECT @@IDENTITY")
-                    fp_id = cursor.fetchone()[0]
-
-                    # Insert data into FP_TIMES table for the corresponding phase with current datetime
-                    if fase_producc == "Despacho":
-                        insert_times_query = f"""
-                            INSERT INTO FP_TIMES (FP_ID, {fase_producc}_ST, {fase_producc}_ET)
-                            VALUES (?, ?, ?)
-                        """
-                        current_datetime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        cursor.execute(
-                            insert_times_query, (fp_id, current_datetime, current_datetime))
-                    else:
-                        insert_times_query = f"""
-                            INSERT INTO FP_TIMES (FP_ID, {fase_producc}_ST)
-                            VALUES (?, ?)
-                        """
-                        current_datetime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        cursor.execute(insert_times_query,
-                                       (fp_id, current_datetime))
-                    conn.commit()
-
-                except pyodbc.Error as e:
+                try:
+                    self.backend.create_record(op_value, it_comp, cantidad_fp,
+                                               fase_producc, planta, comentarios, user=self.user)
+                except SaveConflict as e:
+                    logging.error(
+                        f"An error occurred while saving child record: {str(e)}")
+                    messagebox.showerror(
+                        "Error", "El registro fue modificado por otro usuario. Actualice la tabla e intente de nuevo.")
+                except self.backend.errors + (ValueError,) as e:
                     logging.error(
                         f"An error occurred while saving child record: {str(e)}")
                     messagebox.showerror(
                         "Error", "An error occurred while saving the child record. Please check the logs for more information.")
-                finally:
-                    # Close the database connection and cursor
-                    if cursor:
-                        cursor.close()
-                    if conn:
-                        conn.close()
 
                 child_window.destroy()
                 self.reload_data()
@@ -355,11 +1245,23 @@ class MyFrame(ctk.CTkFrame):
             row_data = self.sheet.get_row_data(selected_row)
             op_value = row_data[0]  # Assuming '# OP' is at index 0
             fp_id = row_data[10]  # Assuming 'FP_ID' is at index 10
-
+            # What the dialog is opened on, taken now: refreshes while it is open move the grid
+            # rows. A journaled save is rejected by SIIAPP if someone changed the record since.
+            expected = {"cantidad": self.grid_view.rows[selected_row].value(11), "fase": row_data[12],
+                        "planta": row_data[13], "comentarios": row_data[14]}
+
+            if fp_id == "" and GRID_TREE and self._children.get(db.op_key(row_data)):
+                messagebox.showinfo(
+                    "Sin seleccion", "Elija uno de los registros de la OP (doble clic para expandir)")
+                return
             if fp_id == "":
                 messagebox.showerror(
                     "Error", "No se puede editar el registro porque no se ha creado.")
                 return
+            if fp_id == PENDING_FP_ID:
+                messagebox.showinfo(
+                    "Guardando", "El registro aun se esta guardando. Intente de nuevo en un momento.")
+                return
 
             # Create a new window for editing child record data
             edit_window = ctk.CTkToplevel(self)
@@ -405,80 +1307,34 @@ class MyFrame(ctk.CTkFrame):
             comentarios_entry.grid(row=3, column=1, padx=5, pady=5)
 
             def save_edited_child_record():
+                cantidad_fp = cantidad_fp_entry.get()
+                fase_producc = fase_producc_entry.get()
+                planta = planta_entry.get()
+                comentarios = comentarios_entry.get("0.0", "end")
+                if self.save_journal is not None:
+                    try:
+                        float(cantidad_fp)
+                    except ValueError:
+                        messagebox.showerror("Error", "La cantidad debe ser un numero.")
+                        return
+                    values = {"cantidad": cantidad_fp, "fase": fase_producc, "planta": planta,
+                              "comentarios": comentarios}
+                    if self._queue_save("update", op_value, row_data[9], int(fp_id), values, expected):
+                        edit_window.destroy()
+                    return
                 try:
-                    cantidad_fp = cantidad_fp_entry.get()
-                    fase_producc = fase_producc_entry.get()
-                    planta = planta_entry.get()
-                    comentarios = comentarios_entry.get("0.0", "end")
-
-                    # Update the child record in the database using parameterized query
-                    conn_str = (
-                        f"DRIVER={os.getenv('DB1_DRIVER')};"
-                        f"SERVER={os.getenv('DB1_SERVER')};"
-                        f"DATABASE={os.getenv('DB1_DATABASE')};"
-                        f"UID={os.getenv('DB1_UID')};"
-                        f"PWD={os.getenv('DB1_PWD')}"
-                    )
-                    conn = pyodbc.connect(conn_str)
-                    cursor = conn.cursor()
-
-                    select_query = """
-                        SELECT FASE_PODUCC
-                        FROM FP_PROGRES
-                        WHERE FP_ID = ?
-                    """
-                    cursor.execute(select_query, (fp_id,))
-                    existing_data = cursor.fetchone()
-                    if existing_data:
-                        prev_fase = existing_data[0]
-                    else:
-                        prev_fase = None
-
-                    update_query = """
-                        UPDATE FP_PROGRES
-                        SET CANTIDAD_FP = ?, FASE_PODUCC = ?, PLANTA = ?, COMENTARIES = ?
-                        WHERE FP_ID = ?
-                    """
-                    params = (cantidad_fp, fase_producc,
-                              planta, comentarios, fp_id)
-                    cursor.execute(update_query, params)
-                    conn.commit()
-
-                    # Update the corresponding phase start and end times in FP_TIMES table with current datetime
-                    if fase_producc == "Despacho":
-                        update_times_query = f"""
-                            UPDATE FP_TIMES
-                            SET {fase_producc}_ST = CASE WHEN {fase_producc}_ST IS NULL THEN ? ELSE {fase_producc}_ST END,
-                                {fase_producc}_ET = ?,
-                                {prev_fase}_ET = CASE WHEN {prev_fase}_ST IS NOT NULL THEN ? ELSE {prev_fase}_ET END
-                            WHERE FP_ID = ?
-                        """
-                        current_datetime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        cursor.execute(update_times_query,
-                                       (current_datetime, current_datetime, current_datetime, fp_id))
-                    else:
-                        update_times_query = f"""
-                            UPDATE FP_TIMES
-                            SET {fase_producc}_ST = CASE WHEN {fase_producc}_ST IS NULL THEN ? ELSE {fase_producc}_ST END,
-                                {prev_fase}_ET = CASE WHEN {prev_fase}_ST IS NOT NULL THEN ? ELSE {prev_fase}_ET END
-                            WHERE FP_ID = ?
-                        """
-                        current_datetime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        cursor.execute(update_times_query,
-                                       (current_datetime, current_datetime, fp_id))
-                    conn.commit()
-
-                except pyodbc.Error as e:
+                    self.backend.update_record(fp_id, cantidad_fp,
+                                               fase_producc, planta, comentarios, user=self.user)
+                except SaveConflict as e:
+                    logging.error(
+                        f"An error occurred while updating child record: {str(e)}")
+                    messagebox.showerror(
+                        "Error", "El registro fue modificado por otro usuario. Actualice la tabla e intente de nuevo.")
+                except self.backend.errors + (ValueError,) as e:
                     logging.error(
                         f"An error occurred while updating child record: {str(e)}")
                     messagebox.showerror(
                         "Error", "An error occurred while updating the child record. Please check the logs for more information.")
-                finally:
-                    # Close the database connection and cursor
-                    if cursor:
-                        cursor.close()
-                    if conn:
-                        conn.close()
                 edit_window.destroy()
                 self.reload_data()
 
@@ -489,12 +1345,201 @@ class MyFrame(ctk.CTkFrame):
             messagebox.showinfo(
                 "Sin seleccion", "Porfavor eliga una fila para editar un registro")
 
-    def reload_data(self):
-        # Clear existing data
-        self.sheet.set_sheet_data([])
+    def bulk_phase_records(self):
+        selected_rows = self.sheet.get_selected_rows()
+        if not selected_rows:
+            messagebox.showinfo(
+                "Sin seleccion", "Porfavor eliga una o mas filas para mover de fase")
+            return
+
+        creates = []
+        updates = []
+        seen_ops = set()
+        seen_records = set()
+        missing = []
+        for selected_row in sorted(selected_rows):
+            row_data = self.sheet.get_row_data(selected_row)
+            if row_data[10] == "" and GRID_TREE:
+                # Tree mode parent: move all of its records, or create one if it has none
+                children = self._children.get(db.op_key(row_data))
+                if children is None:
+                    missing.append(db.op_key(row_data))
+                    continue
+                if children:
+                    updates.extend(child for child in children if child[10] not in seen_records)
+                    seen_records.update(child[10] for child in children)
+                    continue
+            if row_data[10] == "":
+                # OP without a progress record: create one (once per OP)
+                if db.op_key(row_data) not in seen_ops:
+                    seen_ops.add(db.op_key(row_data))
+                    creates.append(row_data)
+            elif row_data[10] not in seen_records:
+                seen_records.add(row_data[10])
+                updates.append(row_data)
+        if any(row[10] == PENDING_FP_ID for row in updates):
+            messagebox.showinfo(
+                "Guardando", "Hay registros que aun se estan guardando. Intente de nuevo en un momento.")
+            return
+        if missing:
+            self._request_children(missing)
+            messagebox.showinfo(
+                "Cargando", "Cargando los registros de las OP seleccionadas. Intente de nuevo en un momento.")
+            return
+
+        bulk_window = ctk.CTkToplevel(self)
+        bulk_window.title("Mover fase de produccion (seleccion)")
+
+        summary_label = ctk.CTkLabel(
+            bulk_window,
+            text=f"{len(updates)} registros a mover, {len(creates)} registros nuevos")
+        summary_label.grid(row=0, column=0, columnspan=2, padx=5, pady=5)
+
+        fase_producc_entry = ctk.CTkComboBox(
+            bulk_window, values=self.fases, state="readonly")
+        planta_entry = ctk.CTkComboBox(
+            bulk_window, values=self.plantas, state="readonly")
+        cantidad_fp_entry = ctk.CTkEntry(
+            bulk_window, placeholder_text="Vacio = mantener / cantidad pedida")
+        comentarios_entry = ctk.CTkTextbox(
+            bulk_window, height=50, width=200)
+        comentarios_entry.configure(
+            border_color='blue', border_width=0.5)
+
+        fase_producc_label = ctk.CTkLabel(
+            bulk_window, text="Fase de Produccion:")
+        fase_producc_label.grid(row=1, column=0, padx=5, pady=5)
+        fase_producc_entry.grid(row=1, column=1, padx=5, pady=5)
+
+        planta_label = ctk.CTkLabel(bulk_window, text="Planta:")
+        planta_label.grid(row=2, column=0, padx=5, pady=5)
+        planta_entry.grid(row=2, column=1, padx=5, pady=5)
+
+        cantidad_fp_label = ctk.CTkLabel(
+            bulk_window, text="Cantidad en fase de produccion:")
+        cantidad_fp_label.grid(row=3, column=0, padx=5, pady=5)
+        cantidad_fp_entry.grid(row=3, column=1, padx=5, pady=5)
+
+        comentarios_label = ctk.CTkLabel(
+            bulk_window, text="Observaciones/Comentarios (vacio = mantener):")
+        comentarios_label.grid(row=4, column=0, padx=5, pady=5)
+        comentarios_entry.grid(row=4, column=1, padx=5, pady=5)
+
+        def save_bulk_records():
+            fase_producc = fase_producc_entry.get()
+            planta = planta_entry.get()
+            cantidad_fp = cantidad_fp_entry.get().strip() or None
+            comentarios = comentarios_entry.get("0.0", "end").strip() or None
+            if not all([fase_producc, planta]):
+                messagebox.showerror(
+                    "Error", "Por favor elija la fase y la planta antes de guardar.")
+                return
+
+            try:
+                # New records default to the ordered quantity (CANTIDAD PEDIDA)
+                self.backend.bulk_save(
+                    [(row[0], row[9], cantidad_fp or row[7]) for row in creates],
+                    [(row[10], cantidad_fp) for row in updates],
+                    fase_producc, planta, comentarios, user=self.user)
+            except self.backend.errors + (ValueError,) as e:
+                logging.error(
+                    f"An error occurred while saving bulk phase records: {str(e)}")
+                messagebox.showerror(
+                    "Error", "An error occurred while saving the records. No record was changed. Please check the logs for more information.")
+                return
+
+            bulk_window.destroy()
+            # One refresh for the whole batch
+            self.reload_data()
+
+        save_button = ctk.CTkButton(
+            bulk_window, text="Guardar", command=save_bulk_records)
+        save_button.grid(row=5, column=0, columnspan=2, pady=10)
+
+    def show_analytics(self):
+        if self.analytics_window is not None and self.analytics_window.winfo_exists():
+            self.analytics_window.focus()
+            return
+        self.analytics_window = AnalyticsWindow(self)
+
+    def export_view(self):
+        # Pressed again while exporting: cancel the running export
+        if self._export_thread is not None and self._export_thread.is_alive():
+            self._export_cancel.set()
+            return
+        # The current view in display order: the filtered rows and any expanded records
+        rows = list(self.grid_view.rows)
+        if not rows:
+            messagebox.showinfo("Exportar", "No hay filas para exportar.")
+            return
+        path = filedialog.asksaveasfilename(
+            parent=self, title="Exportar vista", defaultextension=".xlsx",
+            initialfile=f"produccion_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+            filetypes=[("Libro de Excel", "*.xlsx"), ("CSV", "*.csv")])
+        if not path:
+            return
+        if os.path.splitext(path)[1].lower() not in grid_export.EXPORT_FORMATS:
+            path += ".xlsx"
+        self._export_cancel = threading.Event()
+        self._export_queue = queue.Queue()
+        self.export_button.configure(text="Cancelar exportacion")
+        self.export_progress.set(0)
+        self.export_progress.pack(side="left", padx=5, before=self.load_status_label)
+        self.export_status_label.pack(side="left", padx=5, before=self.load_status_label)
+        self.export_status_label.configure(text=f"Exportando 0/{len(rows)}")
+        self._export_thread = threading.Thread(
+            target=self._export_worker,
+            args=(path, rows, self._export_cancel, self._export_queue), daemon=True)
+        self._export_thread.start()
+        self.after(100, self._poll_export)
+
+    def _export_worker(self, path, rows, cancel_event, result_queue):
+        try:
+            grid_export.export_rows(
+                path, self.headers, rows, cancel_event,
+                on_progress=lambda written, total: result_queue.put(("progress", (written, total))),
+                column_widths=self.column_widths)
+            result_queue.put(("done", (path, len(rows))))
+        except grid_export.ExportCancelled:
+            result_queue.put(("cancelled", None))
+        except Exception as e:
+            result_queue.put(("error", e))
+
+    def _poll_export(self):
+        if not self.winfo_exists():
+            return
+        try:
+            while True:
+                kind, payload = self._export_queue.get_nowait()
+                if kind == "progress":
+                    written, total = payload
+                    self.export_progress.set(written / total)
+                    self.export_status_label.configure(text=f"Exportando {written}/{total}")
+                    continue
+                self._finish_export(kind, payload)
+                return
+        except queue.Empty:
+            pass
+        self.after(100, self._poll_export)
+
+    def _finish_export(self, kind, payload):
+        self._export_thread = None
+        self.export_button.configure(text="Exportar")
+        self.export_progress.pack_forget()
+        self.export_status_label.pack_forget()
+        if kind == "done":
+            path, count = payload
+            self.load_status_label.configure(
+                text=f"{count} filas exportadas a {os.path.basename(path)}",
+                text_color=self._status_text_color)
+        elif kind == "error":
+            logging.error(f"An error occurred while exporting the grid: {str(payload)}")
+            messagebox.showerror(
+                "Error", "An error occurred while exporting the grid. Please check the logs for more information.")
 
-        # Load updated data from the database
-        self.load_data()
+    def reload_data(self):
+        # Only fetch the OPs that changed since the last sync; keep current rows on screen meanwhile
+        self.load_data("delta")
 
 
 class LoginFrame(ctk.CTkFrame):
@@ -519,6 +1564,7 @@ class LoginFrame(ctk.CTkFrame):
 
     def save_credentials(self):
         if self.remember_var.get():
+            fernet = get_fernet()
             encrypted_username = fernet.encrypt(
                 self.username_entry.get().encode())
             encrypted_password = fernet.encrypt(
@@ -531,13 +1577,14 @@ class LoginFrame(ctk.CTkFrame):
             with open("credentials.txt", "rb") as f:
                 data = f.read()
                 encrypted_username, encrypted_password = data.split(b",")
+                fernet = get_fernet()
                 self.username = fernet.decrypt(encrypted_username).decode()
                 self.password = fernet.decrypt(encrypted_password).decode()
                 self.username_entry.insert(0, self.username)
                 self.password_entry.insert(0, self.password)
         except FileNotFoundError:
             pass
-        except (ValueError, InvalidToken):
+        except (ValueError, startup_profile.lazy_import("cryptography.fernet").InvalidToken):
             messagebox.showerror(
                 "Error", "Unable to decrypt credentials. Please enter the correct password.")
 
@@ -546,57 +1593,197 @@ class LoginFrame(ctk.CTkFrame):
         password = self.password_entry.get()
 
         if authenticate_user(username, password):
+            startup_profile.mark("login")
             messagebox.showinfo("Login Exitoso", "Bienvenido!")
             self.save_credentials()  # Save credentials before showing the app frame
-            self.master.show_app_frame()
+            self.master.show_app_frame(username)
         else:
+            self.master.discard_prefetch()
             messagebox.showerror(
                 "Login Fallido", "Credenciales invalidas o acceso denegado.")
 
 
 def authenticate_user(username, password):
-    server = Server(os.getenv('AD_SERVER'), get_info=ALL)
-    user = f'{os.getenv("AD_DOMAIN")}\\{username}'
-
-    try:
-        conn = Connection(server, user=user, password=password,
-                          authentication='NTLM', auto_bind=True)
-        logging.info(f"LDAP bind successful for {username}.")
-
-        # Check if user is in allowed users
-        allowed_users = os.getenv('ALLOWED_USERS').split(',')
-        if username in allowed_users:
-            return True
-
-        # Search base is set to the root of the domain
-        search_base = f'DC={AD_DOMAIN.replace(".", ",DC=")}'
-
-        conn.search(
-            search_base,
-            f'(sAMAccountName={username})',
-            attributes=['memberOf'],
-            search_scope=SUBTREE
-        )
-
-        if not conn.entries:
-            logging.warning(f"User {username} not found in LDAP search.")
-            return False
-
-        user_groups = [entry.memberOf.values if isinstance(entry.memberOf, list) else [
-            entry.memberOf] for entry in conn.entries]
-        user_groups = [item for sublist in user_groups for item in sublist]
+    return get_authorizer().authenticate(username, password)
 
-        allowed_groups = os.getenv('ALLOWED_GROUPS').split(',')
 
-        for group in allowed_groups:
-            if any(group in str(user_group) for user_group in user_groups):
-                return True
-
-    except Exception as e:
-        logging.error(f"LDAP error for {username}: {e}")
+# Hidden diagnostics panel (Ctrl+Shift+D): recent timings per operation/stage and pool usage
+class DiagnosticsWindow(ctk.CTkToplevel):
+    def __init__(self, master, **kwargs):
+        super().__init__(master, **kwargs)
+        self.title("Diagnostico de rendimiento")
+        self.geometry("760x480")
+        self.textbox = ctk.CTkTextbox(self, font=("Courier New", 12), wrap="none")
+        self.textbox.pack(fill="both", expand=True, padx=5, pady=5)
+        self.refresh()
+
+    def refresh(self):
+        if not self.winfo_exists():
+            return
+        lines = [f"{'operacion':<12}{'etapa':<16}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'ult ms':>10}{'filas':>10}"]
+        for (operation, stage), stats in sorted(metrics.summary().items()):
+            lines.append(
+                f"{operation:<12}{stage:<16}{stats['count']:>6}{stats['p50_ms']:>10.1f}"
+                f"{stats['p95_ms']:>10.1f}{stats['max_ms']:>10.1f}{stats['last_ms']:>10.1f}{stats['rows']:>10}")
+        lines.append("")
+        for name, stats in db.pool_stats().items():
+            lines.append(
+                f"pool {name}: {stats['in_use']} en uso, {stats['idle']} libres, "
+                f"{stats['checkouts']} usos, espera media {stats['avg_wait'] * 1000:.1f} ms, "
+                f"{stats['timeouts']} timeouts, {stats['reconnects']} reconexiones")
+        self.textbox.delete("0.0", "end")
+        self.textbox.insert("0.0", "\n".join(lines))
+        self.after(1000, self.refresh)
+
+
+# Phase analytics: WIP per phase and plant, cycle times, daily throughput and OPs at risk.
+# The cached aggregates are shown first; only the recent days are re-queried in the background.
+class AnalyticsWindow(ctk.CTkToplevel):
+    def __init__(self, frame, **kwargs):
+        super().__init__(frame, **kwargs)
+        self.frame = frame
+        self.title("Analitica de fases")
+        self.geometry("960x540")
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+        top = ctk.CTkFrame(self)
+        top.pack(fill="x", padx=5, pady=5)
+        self.refresh_button = ctk.CTkButton(top, text="Actualizar", command=self.refresh)
+        self.refresh_button.pack(side="left", padx=5)
+        self.status_label = ctk.CTkLabel(top, text="")
+        self.status_label.pack(side="left", padx=5)
+
+        Sheet = startup_profile.lazy_import("tksheet").Sheet
+        tabview = ctk.CTkTabview(self)
+        tabview.pack(fill="both", expand=True, padx=5, pady=5)
+        self.sheets = {}
+        tables = [
+            ("WIP", ["FASE", "PLANTA", "REGISTROS", "CANTIDAD EN PRODUCCION"]),
+            ("Tiempos de ciclo", ["FASE", "INTERVALOS", "PROMEDIO (h)", "P50 (h)", "P90 (h)"]),
+            ("Throughput diario", ["DIA"] + analytics.FLOW_PHASES),
+            ("OPs en riesgo", ["# OP", "FP_ID", "DESCRIPCION ITEM", "FASE", "PLANTA",
+                               "FECHA REQUERIDA", "FIN ESTIMADO", "HOLGURA (dias)"]),
+        ]
+        for name, headers in tables:
+            sheet = Sheet(tabview.add(name))
+            sheet.pack(fill="both", expand=True)
+            sheet.headers(headers)
+            sheet.enable_bindings(("single_select", "row_select", "column_width_resize", "copy"))
+            self.sheets[name] = sheet
+        self.sheets["OPs en riesgo"].set_column_widths([100, 80, 380, 140, 80, 140, 140, 120])
+
+        self._thread = None
+        self._queue = queue.Queue()
+        self._cancel = None
+        self._cursor = None
+        self._cursor_lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._cancel = threading.Event()
+        self._queue = queue.Queue()
+        self.refresh_button.configure(state="disabled")
+        self.status_label.configure(text="Consultando tiempos de fase...")
+        # The worker reads a copy of the row list; the rows themselves are never modified
+        self._thread = threading.Thread(
+            target=self._worker,
+            args=(self.frame.analytics_cache, list(self.frame.original_data), self._cancel, self._queue),
+            daemon=True)
+        self._thread.start()
+        self.after(100, self._poll)
+
+    def _worker(self, cache, rows, cancel_event, result_queue):
+        def on_cursor(cursor):
+            with self._cursor_lock:
+                self._cursor = cursor
 
-    logging.warning(f"Access denied for {username}.")
-    return False
+        try:
+            if GRID_TREE:
+                # Parent rows carry no progress columns: join every FP_PROGRES record locally
+                children, _ = db.fetch_fp_children(None, cancel_event, on_cursor=on_cursor, with_times=False)
+                rows = join_children(rows, children)
+            if cache is None:
+                cache = analytics.load_cache(ANALYTICS_CACHE_FILE, ANALYTICS_KEY, ANALYTICS_HISTORY_DAYS)
+                if cache.days:
+                    result_queue.put(("cached", self._tables(cache, rows)))
+            analytics.refresh_cache(cache, cancel_event, on_cursor=on_cursor,
+                                    refresh_days=ANALYTICS_REFRESH_DAYS)
+            try:
+                analytics.save_cache(ANALYTICS_CACHE_FILE, cache)
+            except OSError as e:
+                logging.error(f"An error occurred while writing the analytics cache: {str(e)}")
+            result_queue.put(("done", self._tables(cache, rows)))
+        except LoadCancelled:
+            result_queue.put(("cancelled", None))
+        except Exception as e:
+            result_queue.put(("error", e))
+
+    def _tables(self, cache, rows):
+        # Everything is formatted here, off the main thread
+        with metrics.timer("analytics", "compute", rows=len(rows)):
+            order = {fase: i for i, fase in enumerate(analytics.PHASES)}
+            wip = sorted(analytics.work_in_progress(rows).items(),
+                         key=lambda item: (order.get(item[0][0], len(order)), item[0][1]))
+            stats = cache.phase_stats()
+            today = datetime.now().date()
+            at_risk = analytics.ops_at_risk(rows, stats, margin_hours=ANALYTICS_RISK_MARGIN_HOURS)
+            tables = {
+                "WIP": [[fase, planta, count, f"{quantity:,.0f}"]
+                        for (fase, planta), (count, quantity) in wip],
+                "Tiempos de ciclo": [
+                    [fase, stats[fase]["count"], f"{stats[fase]['avg_hours']:.1f}",
+                     f"{stats[fase]['p50_hours']:.1f}", f"{stats[fase]['p90_hours']:.1f}"]
+                    for fase in analytics.PHASES if fase in stats],
+                "Throughput diario": [[day] + [counts.get(fase, 0) for fase in analytics.FLOW_PHASES]
+                                      for day, counts in cache.throughput(today)],
+                "OPs en riesgo": [
+                    [row[0], row[10], row[3], row[12] or "Sin registro", row[13], row[4],
+                     expected.strftime('%Y-%m-%d %H:%M'), f"{slack / 24:.1f}"]
+                    for slack, row, expected in at_risk],
+            }
+        return cache, tables
+
+    def _poll(self):
+        if not self.winfo_exists():
+            return
+        try:
+            kind, payload = self._queue.get_nowait()
+        except queue.Empty:
+            self.after(100, self._poll)
+            return
+        if kind in ("cached", "done"):
+            cache, tables = payload
+            self.frame.analytics_cache = cache
+            for name, data in tables.items():
+                self.sheets[name].set_sheet_data(data, reset_col_positions=False)
+            refreshed = (datetime.fromtimestamp(cache.refreshed_at).strftime('%d/%m %H:%M')
+                         if cache.refreshed_at else "-")
+            if kind == "cached":
+                self.status_label.configure(text=f"Datos de {refreshed} - actualizando...")
+                self.after(100, self._poll)
+                return
+            self.status_label.configure(
+                text=f"Actualizado {refreshed} ({len(tables['OPs en riesgo'])} OP en riesgo)")
+        elif kind == "cancelled":
+            self.status_label.configure(text="Consulta cancelada")
+        else:
+            logging.error(f"An error occurred while loading analytics: {str(payload)}")
+            self.status_label.configure(text="Error al consultar tiempos de fase")
+        self.refresh_button.configure(state="normal")
+
+    def close(self):
+        if self._cancel is not None:
+            self._cancel.set()
+            with self._cursor_lock:
+                cursor = self._cursor
+            if cursor is not None:
+                try:
+                    cursor.cancel()
+                except db.driver_error() as e:
+                    logging.error(f"An error occurred while cancelling analytics: {str(e)}")
+        self.destroy()
 
 
 class App(ctk.CTk):
@@ -606,16 +1793,71 @@ class App(ctk.CTk):
         self.grid_rowconfigure(0, weight=1)  # configure grid system
         self.grid_columnconfigure(0, weight=1)
 
+        # Main-thread stall sampler and the hidden diagnostics panel
+        self.lag_monitor = metrics.LagMonitor(self, threshold_ms=UI_LAG_THRESHOLD_MS)
+        self.lag_monitor.start()
+        self.diagnostics_window = None
+        self.bind_all("<Control-Shift-D>", self.show_diagnostics)
+
         self.login_frame = LoginFrame(master=self)
         self.login_frame.grid(row=0, column=0, padx=20, pady=20, sticky="nsew")
-
-    def show_app_frame(self):
+        self.login_frame.bind(
+            "<Map>", lambda event: startup_profile.mark("login window shown"))
+
+        self.my_frame = None
+        if PREFETCH_ON_LOGIN:
+            # Let the login window draw before the grid widgets and modules are loaded
+            self.after(100, self.start_prefetch)
+
+    def start_prefetch(self):
+        # Open the connections and load the grid while the user logs in; the frame stays
+        # ungridded until authentication succeeds
+        if self.my_frame is not None:
+            return
+        if not SERVICE_URL:
+            threading.Thread(target=db.warm_pools, args=(("DB1",),), daemon=True).start()
+        self.my_frame = MyFrame(master=self, prefetch=True)
+
+    def discard_prefetch(self):
+        # Failed login: throw the prefetched data away and start over for the next attempt
+        if self.my_frame is not None:
+            self.my_frame.discard()
+            self.my_frame = None
+        if PREFETCH_ON_LOGIN:
+            self.start_prefetch()
+
+    def show_diagnostics(self, event=None):
+        if self.diagnostics_window is not None and self.diagnostics_window.winfo_exists():
+            self.diagnostics_window.focus()
+            return
+        self.diagnostics_window = DiagnosticsWindow(self)
+
+    def show_app_frame(self, username=None):
         self.login_frame.destroy()
         self.geometry("1000x600")
-        self.my_frame = MyFrame(master=self)
+        if self.my_frame is None:
+            self.my_frame = MyFrame(master=self)
+        self.my_frame.user = username
+        self.my_frame.reveal()
         self.my_frame.grid(row=0, column=0, padx=20, pady=20, sticky="nsew")
 
 
-app = App()
-app.title("SIIAPP FASES PRODUCCION")
-app.mainloop()
+def main():
+    parser = argparse.ArgumentParser(description="SIIAPP FASES PRODUCCION")
+    parser.add_argument(
+        "--profile-startup", nargs="?", const="startup_profile.txt", metavar="FILE",
+        help="write import and initialization timings to FILE on exit")
+    args, _ = parser.parse_known_args()
+
+    app = App()
+    app.title("SIIAPP FASES PRODUCCION")
+    startup_profile.mark("app created")
+    try:
+        app.mainloop()
+    finally:
+        if args.profile_startup:
+            startup_profile.write_report(args.profile_startup)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,52 @@
-# -*- mode: python ; coding: utf-8 -*-
-
-
-a = Analysis(
-    ['SIIAPP_FP.py'],
-    pathex=[],
-    binaries=[],
-    datas=[('.env', '.')],
-    hiddenimports=['tkinter', 'tkinter.messagebox', 'tkinter.ttk', 'customtkinter', 'pyodbc', 'tksheet', 'datetime', 'logging'],
-    hookspath=[],
-    hooksconfig={},
-    runtime_hooks=[],
-    excludes=[],
-    noarchive=False,
-    optimize=0,
-)
-pyz = PYZ(a.pure)
-
-exe = EXE(
-    pyz,
-    a.scripts,
-    [],
-    exclude_binaries=True,
-    name='SIIAPP_FP',
-    debug=False,
-    bootloader_ignore_signals=False,
-    strip=False,
-    upx=True,
-    console=False,
-    disable_windowed_traceback=False,
-    argv_emulation=False,
-    target_arch=None,
-    codesign_identity=None,
-    entitlements_file=None,
-)
-coll = COLLECT(
-    exe,
-    a.binaries,
-    a.datas,
-    strip=False,
-    upx=True,
-    upx_exclude=[],
-    name='SIIAPP_FP',
-)
+# -*- mode: python ; coding: utf-8 -*-
+
+
+a = Analysis(
+    ['SIIAPP_FP.py'],
+    pathex=[],
+    binaries=[],
+    datas=[('.env', '.')],
+    # Modules loaded with startup_profile.lazy_import are invisible to the import analysis
+    hiddenimports=['tkinter', 'tkinter.messagebox', 'tkinter.ttk', 'customtkinter', 'pyodbc', 'tksheet',
+                   'datetime', 'logging', 'auth', 'ldap3', 'cachetools', 'cryptography.fernet'],
+    hookspath=[],
+    hooksconfig={},
+    runtime_hooks=[],
+    # Installed in the old build environment (requirements.txt) but never used by the app
+    excludes=['fastapi', 'starlette', 'uvicorn', 'pydantic', 'pydantic_core', 'flask', 'werkzeug',
+              'jinja2', 'bottle', 'aiohttp', 'g4f', 'cefpython3', 'webview', 'clr', 'clr_loader',
+              'pythonnet', 'curl_cffi', 'duckduckgo_search', 'browser_cookie3', 'Crypto',
+              'Cryptodome', 'execjs', 'cairosvg', 'cairocffi', 'PIL.ImageQt', 'loguru', 'plyer',
+              'orjson', 'lz4', 'brotli', 'bs4', 'requests', 'numpy', 'pandas', 'matplotlib',
+              'IPython', 'test'],
+    noarchive=False,
+    optimize=0,
+)
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='SIIAPP_FP',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=True,
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=True,
+    upx_exclude=[],
+    name='SIIAPP_FP',
+)
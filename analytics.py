@@ -0,0 +1,272 @@
+import gzip
+import json
+import logging
+import time
+from datetime import date, datetime, timedelta
+
+import db
+import metrics
+import snapshot
+
+# Production phases in flow order; Reproceso is rework outside the normal flow
+PHASES = db.PHASES
+FLOW_PHASES = PHASES[:8]
+FINAL_PHASE = "Despacho"
+# Rework goes back through manufacturing before continuing with the flow
+REWORK_RESUMES_AT = "Fabricacion"
+
+# Upper edges (minutes) of the cycle time histogram buckets; the last bucket is open ended.
+# Percentiles are interpolated inside a bucket, so they are estimates, not exact values.
+BUCKET_EDGES_MINUTES = (10, 30, 60, 120, 240, 480, 720, 1440, 2880, 4320, 7200,
+                        10080, 14400, 20160, 30240, 43200, 86400)
+BUCKET_COUNT = len(BUCKET_EDGES_MINUTES) + 1
+
+# Bump when the layout of the cache file changes
+CACHE_SCHEMA_VERSION = 1
+
+
+def _bucket_expression(seconds):
+    cases = " ".join(f"WHEN {seconds} < {edge * 60} THEN {i}"
+                     for i, edge in enumerate(BUCKET_EDGES_MINUTES))
+    return f"CASE {cases} ELSE {len(BUCKET_EDGES_MINUTES)} END"
+
+
+def _phase_cycle_select(fase):
+    fase = db._phase_column(fase)
+    return f"""
+        SELECT '{fase}' AS fase, CONVERT(date, t.{fase}_ET) AS dia, b.bucket,
+               COUNT(*) AS intervals, SUM(CAST(d.secs AS bigint)) AS seconds
+        FROM FP_TIMES t
+        CROSS APPLY (SELECT DATEDIFF(SECOND, t.{fase}_ST, t.{fase}_ET) AS secs) d
+        CROSS APPLY (SELECT {_bucket_expression("d.secs")} AS bucket) b
+        WHERE t.{fase}_ET >= ? AND t.{fase}_ST IS NOT NULL AND d.secs >= 0
+        GROUP BY CONVERT(date, t.{fase}_ET), b.bucket
+"""
+
+
+# Completed phase intervals aggregated on the server per phase, end day and duration bucket:
+# only a few hundred rows come back however long the history is. One `since` parameter per phase.
+CYCLE_TIME_QUERY = "        UNION ALL".join(_phase_cycle_select(fase) for fase in PHASES)
+
+# Same aggregates from the phase event log (db.use_phase_events): a range seek on the end events
+# of the window, each matched with the first start of its record and phase. Like the FP_TIMES
+# columns, an interval ends at the last end event and starts at the first start event.
+PHASE_EVENTS_CYCLE_TIME_QUERY = f"""
+        SELECT e.FASE AS fase, CONVERT(date, e.ended) AS dia, b.bucket,
+               COUNT(*) AS intervals, SUM(CAST(d.secs AS bigint)) AS seconds
+        FROM (SELECT FP_ID, FASE, MAX(EVENT_AT) AS ended
+              FROM FP_PHASE_EVENTS
+              WHERE EVENT = 'ET' AND EVENT_AT >= ?
+              GROUP BY FP_ID, FASE) e
+        CROSS APPLY (SELECT MIN(s.EVENT_AT) AS started FROM FP_PHASE_EVENTS s
+                     WHERE s.FP_ID = e.FP_ID AND s.FASE = e.FASE AND s.EVENT = 'ST') s
+        CROSS APPLY (SELECT DATEDIFF(SECOND, s.started, e.ended) AS secs) d
+        CROSS APPLY (SELECT {_bucket_expression("d.secs")} AS bucket) b
+        WHERE s.started IS NOT NULL AND d.secs >= 0
+        GROUP BY e.FASE, CONVERT(date, e.ended), b.bucket
+"""
+
+
+def cycle_time_query():
+    # (query, number of `since` parameters) for the phase time source in use
+    if db.PHASE_EVENTS:
+        return PHASE_EVENTS_CYCLE_TIME_QUERY, 1
+    return CYCLE_TIME_QUERY, len(PHASES)
+
+
+def _day_key(value):
+    if isinstance(value, datetime):
+        value = value.date()
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)[:10]
+
+
+# Daily aggregates of completed phase intervals: {day: {phase: {"n", "s", "h"}}} with the
+# interval count, the summed seconds and the duration histogram. Days inside the refresh
+# window are re-queried and replaced; older days are final and never read again.
+class AnalyticsCache:
+    def __init__(self, key, history_days=180):
+        self.key = key
+        self.history_days = history_days
+        self.days = {}
+        # Day of the last refresh (ISO) and its timestamp
+        self.refreshed_on = None
+        self.refreshed_at = None
+
+    def refresh_since(self, today, refresh_days=2):
+        # First day to ask the server for
+        oldest = today - timedelta(days=self.history_days)
+        if self.refreshed_on is None or not self.days:
+            return oldest
+        last = date.fromisoformat(self.refreshed_on)
+        return max(oldest, min(last, today) - timedelta(days=refresh_days))
+
+    def merge(self, rows, since, today):
+        # rows: (fase, dia, bucket, intervals, seconds) for every day >= since
+        since_key = since.isoformat()
+        for day in [day for day in self.days if day >= since_key]:
+            del self.days[day]
+        for fase, dia, bucket, intervals, seconds in rows:
+            phase = self.days.setdefault(_day_key(dia), {}).setdefault(
+                fase, {"n": 0, "s": 0, "h": [0] * BUCKET_COUNT})
+            phase["n"] += int(intervals)
+            phase["s"] += int(seconds or 0)
+            phase["h"][min(int(bucket), BUCKET_COUNT - 1)] += int(intervals)
+        self.refreshed_on = today.isoformat()
+        self.refreshed_at = time.time()
+        self.prune(today)
+
+    def prune(self, today):
+        oldest = (today - timedelta(days=self.history_days)).isoformat()
+        for day in [day for day in self.days if day < oldest]:
+            del self.days[day]
+
+    def phase_stats(self):
+        # {phase: {"count", "avg_hours", "p50_hours", "p90_hours"}} over the whole cached window
+        totals = {}
+        for phases in self.days.values():
+            for fase, values in phases.items():
+                total = totals.setdefault(fase, {"n": 0, "s": 0, "h": [0] * BUCKET_COUNT})
+                total["n"] += values["n"]
+                total["s"] += values["s"]
+                for i, count in enumerate(values["h"]):
+                    total["h"][i] += count
+        stats = {}
+        for fase, total in totals.items():
+            if not total["n"]:
+                continue
+            stats[fase] = {
+                "count": total["n"],
+                "avg_hours": total["s"] / total["n"] / 3600,
+                "p50_hours": _histogram_percentile(total["h"], 50) / 60,
+                "p90_hours": _histogram_percentile(total["h"], 90) / 60,
+            }
+        return stats
+
+    def throughput(self, today, days=14):
+        # [(day, {phase: completed intervals})], most recent day first
+        result = []
+        for offset in range(days):
+            day = (today - timedelta(days=offset)).isoformat()
+            phases = self.days.get(day, {})
+            result.append((day, {fase: values["n"] for fase, values in phases.items()}))
+        return result
+
+    def to_payload(self):
+        return {"schema_version": CACHE_SCHEMA_VERSION, "key": self.key,
+                "history_days": self.history_days, "refreshed_on": self.refreshed_on,
+                "refreshed_at": self.refreshed_at,
+                "days": self.days}
+
+
+def _histogram_percentile(histogram, pct):
+    # Minutes; linear interpolation inside the bucket holding the requested rank
+    total = sum(histogram)
+    if not total:
+        return 0.0
+    rank = total * pct / 100
+    seen = 0
+    for i, count in enumerate(histogram):
+        if count and seen + count >= rank:
+            low = BUCKET_EDGES_MINUTES[i - 1] if i > 0 else 0
+            if i >= len(BUCKET_EDGES_MINUTES):
+                return float(low)
+            return low + (BUCKET_EDGES_MINUTES[i] - low) * (rank - seen) / count
+        seen += count
+    return float(BUCKET_EDGES_MINUTES[-1])
+
+
+def load_cache(path, key, history_days=180):
+    # Always returns a cache; unreadable or foreign files start from scratch
+    cache = AnalyticsCache(key, history_days)
+    if not path:
+        return cache
+    try:
+        with gzip.open(path, "rb") as f:
+            payload = json.loads(f.read().decode("utf-8"))
+    except FileNotFoundError:
+        return cache
+    except (OSError, ValueError, EOFError) as e:
+        logging.error(f"Discarding unreadable analytics cache {path}: {str(e)}")
+        return cache
+    if (payload.get("schema_version") != CACHE_SCHEMA_VERSION or payload.get("key") != key
+            or payload.get("history_days") != history_days):
+        return cache
+    cache.days = payload.get("days") or {}
+    cache.refreshed_on = payload.get("refreshed_on")
+    cache.refreshed_at = payload.get("refreshed_at")
+    return cache
+
+
+def save_cache(path, cache):
+    if path:
+        snapshot.write_json_atomic(path, cache.to_payload(), prefix=".analytics-")
+
+
+def refresh_cache(cache, cancel_event, on_cursor=None, today=None, refresh_days=2):
+    # Runs on a worker thread: re-aggregates the days inside the refresh window only
+    today = today or date.today()
+    since = cache.refresh_since(today, refresh_days)
+
+    def work(cursor):
+        with metrics.timer("analytics", "query", days=(today - since).days + 1) as m:
+            query, since_params = cycle_time_query()
+            cursor.execute(query, (datetime(since.year, since.month, since.day),) * since_params)
+            rows = cursor.fetchall()
+            m["rows"] = len(rows)
+        return rows
+
+    rows = db._run_cancellable(cancel_event, on_cursor, work, pool_name="DB1", operation="analytics")
+    with metrics.timer("analytics", "merge", rows=len(rows)):
+        cache.merge(rows, since, today)
+    return cache
+
+
+def work_in_progress(rows):
+    # {(phase, planta): [FP records, quantity in production]} over the loaded grid rows
+    wip = {}
+    for row in rows:
+        fase = row.value(12)
+        if not fase or fase == FINAL_PHASE:
+            continue
+        entry = wip.setdefault((fase, row.value(13) or ""), [0, 0.0])
+        entry[0] += 1
+        entry[1] += row.value(11) or 0.0
+    return wip
+
+
+def remaining_hours(fase, stats):
+    # Expected hours until dispatch using the median cycle time of every phase still ahead,
+    # the current one included (the time already spent in it is not known locally)
+    if fase == FINAL_PHASE:
+        return 0.0
+    if fase == "Reproceso":
+        ahead = ["Reproceso"] + FLOW_PHASES[FLOW_PHASES.index(REWORK_RESUMES_AT):]
+    elif fase in FLOW_PHASES:
+        ahead = FLOW_PHASES[FLOW_PHASES.index(fase):]
+    else:
+        ahead = FLOW_PHASES
+    return sum(stats[phase]["p50_hours"] for phase in ahead if phase != FINAL_PHASE and phase in stats)
+
+
+def ops_at_risk(rows, stats, now=None, margin_hours=0):
+    # Grid rows expected to reach dispatch less than `margin_hours` before FECHA REQUERIDA,
+    # tightest slack first: [(slack_hours, row, expected_finish)]
+    now = now or datetime.now()
+    at_risk = []
+    for row in rows:
+        fase = row.value(12)
+        if fase == FINAL_PHASE:
+            continue
+        required = row.value(4)
+        if required is None or isinstance(required, str):
+            continue
+        if not isinstance(required, datetime):
+            required = datetime(required.year, required.month, required.day)
+        expected = now + timedelta(hours=remaining_hours(fase, stats))
+        slack = (required - expected).total_seconds() / 3600
+        if slack < margin_hours:
+            at_risk.append((slack, row, expected))
+    at_risk.sort(key=lambda item: item[0])
+    return at_risk
@@ -0,0 +1,160 @@
+import logging
+import threading
+
+from cachetools import TTLCache
+from ldap3 import ALL, NONE, NTLM, SUBTREE, Connection, Server
+from ldap3.utils.conv import escape_filter_chars
+
+# Login activity goes to auth.log (configured by the app), errors also reach app.log
+log = logging.getLogger("auth")
+
+
+def normalize_dn(dn):
+    # "CN=App Users, OU=Groups,DC=corp" -> "cn=app users,ou=groups,dc=corp"
+    return ",".join(part.strip() for part in str(dn).split(",")).lower()
+
+
+def _common_name(dn):
+    # First RDN value of a group DN when it is a CN, e.g. "CN=App Users,OU=..." -> "app users"
+    attribute, sep, value = str(dn).split(",", 1)[0].partition("=")
+    if sep and attribute.strip().lower() == "cn":
+        return value.strip().lower()
+    return None
+
+
+def _split_setting(value):
+    # ";" separated env setting. Plain names may also be separated by ",", but not group DNs,
+    # which contain commas themselves: a value with a DN in it is only split on ";"
+    if not value:
+        return []
+    separator = ";" if ";" in value or "=" in value else ","
+    return [item.strip() for item in value.split(separator) if item.strip()]
+
+
+def domain_search_base(domain):
+    # "corp.example.com" -> "DC=corp,DC=example,DC=com"
+    return f'DC={domain.replace(".", ",DC=")}'
+
+
+def ntlm_connection(server, user, password):
+    return Connection(server, user=user, password=password,
+                      authentication=NTLM, auto_bind=True)
+
+
+# Authenticates users against Active Directory and authorizes them by user name or group.
+# The bind (password check) always runs; the group membership lookup is cached per user
+# for cache_ttl seconds. Allowed groups are matched by full DN or by CN through set lookups.
+# `server` and `connection_factory` can be replaced, e.g. by an ldap3 MOCK_SYNC connection.
+class LdapAuthorizer:
+    def __init__(self, server_address=None, domain="", allowed_users=(), allowed_groups=(),
+                 search_base=None, fetch_schema=False, cache_ttl=600, cache_size=256,
+                 server=None, connection_factory=ntlm_connection):
+        # The schema is only needed by ldap3's entry helpers; skipping it saves a round trip
+        self.server = server or Server(server_address, get_info=ALL if fetch_schema else NONE)
+        self.domain = domain or ""
+        self.search_base = search_base or domain_search_base(self.domain)
+        self.connection_factory = connection_factory
+        self.allowed_users = {user.lower() for user in allowed_users}
+        self.allowed_group_dns = set()
+        self.allowed_group_names = set()
+        for group in allowed_groups:
+            if "=" in group:
+                self.allowed_group_dns.add(normalize_dn(group))
+            else:
+                self.allowed_group_names.add(group.lower())
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl) if cache_ttl > 0 else None
+        self._cache_lock = threading.Lock()
+
+    def bind_user(self, username):
+        return f"{self.domain}\\{username}" if self.domain else username
+
+    def is_allowed_group(self, group_dn):
+        if normalize_dn(group_dn) in self.allowed_group_dns:
+            return True
+        return _common_name(group_dn) in self.allowed_group_names
+
+    def authenticate(self, username, password):
+        if not username or not password:
+            # An empty password would be an anonymous bind on most servers
+            log.warning(f"Access denied for {username}: empty credentials.")
+            return False
+        conn = None
+        try:
+            conn = self.connection_factory(self.server, self.bind_user(username), password)
+            log.info(f"LDAP bind successful for {username}.")
+            if username.lower() in self.allowed_users:
+                return True
+            if self.is_authorized(conn, username):
+                return True
+        except Exception as e:
+            log.error(f"LDAP error for {username}: {e}")
+        finally:
+            if conn is not None:
+                try:
+                    conn.unbind()
+                except Exception:
+                    pass
+
+        log.warning(f"Access denied for {username}.")
+        return False
+
+    def is_authorized(self, conn, username):
+        key = username.lower()
+        if self._cache is not None:
+            with self._cache_lock:
+                cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+
+        groups = self.fetch_groups(conn, username)
+        if groups is None:
+            # Unknown user: do not cache, the directory may not be replicated yet
+            return False
+        authorized = any(self.is_allowed_group(group) for group in groups)
+        if self._cache is not None:
+            with self._cache_lock:
+                self._cache[key] = authorized
+        return authorized
+
+    def fetch_groups(self, conn, username):
+        # Returns the user's memberOf DNs, or None when the user is not found
+        conn.search(
+            self.search_base,
+            f'(sAMAccountName={escape_filter_chars(username)})',
+            search_scope=SUBTREE,
+            attributes=['memberOf'],
+            size_limit=1,
+        )
+        entries = [entry for entry in conn.response or ()
+                   if entry.get("type") == "searchResEntry"]
+        if not entries:
+            log.warning(f"User {username} not found in LDAP search.")
+            return None
+        groups = []
+        for entry in entries:
+            member_of = entry.get("attributes", {}).get("memberOf", [])
+            groups.extend(member_of if isinstance(member_of, list) else [member_of])
+        return groups
+
+    def invalidate(self, username=None):
+        if self._cache is None:
+            return
+        with self._cache_lock:
+            if username is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(username.lower(), None)
+
+
+def authorizer_from_settings(settings):
+    # settings: a mapping such as os.environ
+    return LdapAuthorizer(
+        server_address=settings.get('AD_SERVER'),
+        domain=settings.get('AD_DOMAIN', ''),
+        allowed_users=_split_setting(settings.get('ALLOWED_USERS', '')),
+        allowed_groups=_split_setting(settings.get('ALLOWED_GROUPS', '')),
+        search_base=settings.get('AD_SEARCH_BASE') or None,
+        fetch_schema=settings.get('AD_FETCH_SCHEMA', '0').lower() in ('1', 'true', 'yes'),
+        cache_ttl=int(settings.get('AD_AUTH_CACHE_SECONDS', '600')),
+        cache_size=int(settings.get('AD_AUTH_CACHE_SIZE', '256')),
+    )
@@ -0,0 +1,176 @@
+import gzip
+import json
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import db
+from db import LoadCancelled, PoolTimeout, SaveConflict
+
+
+class ServiceError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        # HTTP status, None when the service could not be reached
+        self.status = status
+
+
+# Where MyFrame gets the production grid from and sends its saves to. Both backends return
+# the same shapes as the db.fetch_* functions, rows built on the store passed in.
+class DirectBackend:
+    # Every client queries SQL Server itself, one query per scope (db.parse_scopes) in parallel
+    def __init__(self, fetch_size=db.DEFAULT_FETCH_SIZE, version_column="", parents_only=False,
+                 scopes=db.DEFAULT_SCOPES):
+        self.fetch_size = fetch_size
+        self.version_column = version_column
+        self.parents_only = parents_only
+        self.scopes = list(scopes)
+
+    @property
+    def errors(self):
+        return (db.driver_error(), PoolTimeout)
+
+    def is_transient(self, error):
+        return db.is_transient_error(error)
+
+    def fetch_full(self, store, cancel_event, on_cursor=None, on_batch=None):
+        return db.fetch_scoped_data(
+            self.scopes, cancel_event, on_cursor=on_cursor, on_batch=on_batch,
+            fetch_size=self.fetch_size, version_column=self.version_column,
+            row_factory=store.append_raw, parents_only=self.parents_only)
+
+    def fetch_delta(self, store, sync_state, cancel_event, on_cursor=None):
+        return db.fetch_scoped_delta(
+            self.scopes, sync_state, cancel_event, on_cursor=on_cursor, fetch_size=self.fetch_size,
+            version_column=self.version_column, row_factory=store.append_raw,
+            parents_only=self.parents_only)
+
+    def fetch_page(self, store, cancel_event, terms, after_op, page_size, on_cursor=None,
+                   with_sync_state=False):
+        return db.fetch_production_page(
+            cancel_event, terms, after_op, page_size, on_cursor=on_cursor,
+            with_sync_state=with_sync_state, fetch_size=self.fetch_size,
+            version_column=self.version_column, row_factory=store.append_raw,
+            params=db.scope_params(self.scopes[0]))
+
+    def create_record(self, op_value, it_comp, cantidad_fp, fase_producc, planta, comentarios,
+                      save_key=None, user=None):
+        return db.create_fp_record(op_value, it_comp, cantidad_fp, fase_producc, planta, comentarios,
+                                   save_key=save_key, user=user)
+
+    def update_record(self, fp_id, cantidad_fp, fase_producc, planta, comentarios, save_key=None,
+                      expected=None, user=None):
+        db.update_fp_record(fp_id, cantidad_fp, fase_producc, planta, comentarios,
+                            save_key=save_key, expected=expected, user=user)
+
+    def bulk_save(self, creates, updates, fase_producc, planta, comentarios=None, user=None):
+        return db.bulk_save_fp_records(creates, updates, fase_producc, planta, comentarios, user=user)
+
+
+# Reads the grid from the caching service (service.py): one shared query for every client.
+# The sync state is the service's cache id and version; refreshes ask for the OPs changed
+# since that version and get an empty 304 answer when nothing changed.
+class ServiceBackend:
+    def __init__(self, url, timeout=30, batch_size=db.DEFAULT_FETCH_SIZE, token=""):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.batch_size = batch_size
+        # Shared secret of the service (service.py SERVICE_TOKEN)
+        self.token = token
+
+    @property
+    def errors(self):
+        return (ServiceError,)
+
+    def is_transient(self, error):
+        # Unreachable service, or the service could not reach SQL Server
+        return isinstance(error, ServiceError) and error.status in (None, 502, 503, 504)
+
+    def _request(self, method, path, body=None, headers=None):
+        # Returns (status, headers, decoded JSON or None)
+        request = urllib.request.Request(
+            self.url + path, method=method,
+            data=None if body is None else json.dumps(body).encode("utf-8"),
+            headers={"Accept-Encoding": "gzip", "Content-Type": "application/json",
+                     "X-Service-Token": self.token, **(headers or {})})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                status, response_headers, raw = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            status, response_headers, raw = e.code, e.headers, e.read()
+        except (urllib.error.URLError, OSError) as e:
+            raise ServiceError(f"{method} {path}: {str(e)}") from e
+        if response_headers.get("Content-Encoding") == "gzip":
+            raw = gzip.decompress(raw)
+        payload = json.loads(raw.decode("utf-8")) if raw else None
+        if status == 400:
+            # Rejected input (e.g. an unknown phase), same as db raises locally
+            raise ValueError(payload.get("detail") if payload else "Invalid request")
+        if status == 409:
+            raise SaveConflict(payload.get("detail") if payload else "Conflict")
+        if status >= 500 or (status >= 400 and status not in (410,)):
+            detail = payload.get("detail") if isinstance(payload, dict) else raw[:200]
+            raise ServiceError(f"{method} {path}: HTTP {status} {detail}", status)
+        return status, response_headers, payload
+
+    @staticmethod
+    def _state(payload):
+        return {"service": {"cache": payload["cache"], "version": payload["version"]}}
+
+    def fetch_full(self, store, cancel_event, on_cursor=None, on_batch=None):
+        _, _, payload = self._request("GET", "/production")
+        rows = []
+        exported = payload["rows"]
+        for i in range(0, len(exported), self.batch_size):
+            if cancel_event.is_set():
+                raise LoadCancelled()
+            batch = [store.append_exported(values) for values in exported[i:i + self.batch_size]]
+            rows.extend(batch)
+            if on_batch:
+                on_batch(batch)
+        return rows, self._state(payload)
+
+    def fetch_delta(self, store, sync_state, cancel_event, on_cursor=None):
+        # None when the service cannot answer from its change log: the caller loads everything
+        service = (sync_state or {}).get("service")
+        if not service:
+            return None
+        query = urllib.parse.urlencode({"cache": service["cache"], "since": service["version"]})
+        etag = f'"{service["cache"]}:{service["version"]}"'
+        status, _, payload = self._request(
+            "GET", f"/production/changes?{query}", headers={"If-None-Match": etag})
+        if status == 304:
+            return set(), set(), [], sync_state
+        if status == 410:
+            return None
+        if cancel_event.is_set():
+            raise LoadCancelled()
+        changed_rows = [store.append_exported(values) for values in payload["rows"]]
+        # [company, op] pairs back to the (company, # OP) keys of db.fetch_production_delta
+        touched = {tuple(key) for key in payload["touched"]}
+        removed = {tuple(key) for key in payload["removed"]}
+        return touched, removed, changed_rows, self._state(payload)
+
+    def fetch_page(self, store, cancel_event, terms, after_op, page_size, on_cursor=None,
+                   with_sync_state=False):
+        raise ServiceError("Paged loading is not available through the service")
+
+    def create_record(self, op_value, it_comp, cantidad_fp, fase_producc, planta, comentarios,
+                      save_key=None, user=None):
+        _, _, payload = self._request("POST", "/records", {
+            "op": op_value, "company": it_comp, "cantidad": cantidad_fp, "fase": fase_producc,
+            "planta": planta, "comentarios": comentarios, "save_key": save_key, "user": user})
+        return payload["fp_id"]
+
+    def update_record(self, fp_id, cantidad_fp, fase_producc, planta, comentarios, save_key=None,
+                      expected=None, user=None):
+        self._request("PUT", f"/records/{urllib.parse.quote(str(fp_id))}", {
+            "cantidad": cantidad_fp, "fase": fase_producc, "planta": planta,
+            "comentarios": comentarios, "save_key": save_key, "expected": expected, "user": user})
+
+    def bulk_save(self, creates, updates, fase_producc, planta, comentarios=None, user=None):
+        _, _, payload = self._request("POST", "/records/bulk", {
+            "creates": [list(values) for values in creates],
+            "updates": [list(values) for values in updates],
+            "fase": fase_producc, "planta": planta, "comentarios": comentarios, "user": user})
+        return {(company, op): fp_id for company, op, fp_id in payload["result"]}
@@ -0,0 +1,512 @@
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import backends
+import db
+import erp_mirror
+import grid_export
+import grid_view
+import phase_events
+import save_journal
+import snapshot
+from row_store import ProductionStore, build_store
+from search_index import SearchIndex
+from sort_index import SortIndex
+
+from benchmark.datagen import Dataset, parse_scale
+from benchmark.fake_driver import FakeDatabase
+
+STAGES = ("format", "load", "filter", "sort", "render", "delta", "save", "snapshot", "export", "mirror",
+          "events")
+# Queries typed in the filter box: bare keys, categories and combinations
+FILTER_QUERIES = ["10012", "PT0001", "500", "fase:envasado", "estado:espera planta:02",
+                  "PT00 fase:pesaje", "crema", "pedido:5001 estado:fabricacion"]
+COLUMN_WIDTHS = [120, 120, 120, 500, 140, 140, 140, 120, 120, 120, 120, 220, 200, 120, 600]
+VISIBLE_ROWS = 40
+# Header sorts and groupings: (sort spec, group column)
+SORT_ORDERS = [([(4, False)], None), ([(7, True), (6, False)], None), ([(11, True)], 12), ([], 8)]
+# OPs whose records are fetched in the tree mode measurement (a typical selection)
+TREE_SELECTION = 20
+# GRID_SCOPES of the parallel load: both companies of the synthetic data
+SCOPES = db.parse_scopes("01:EF,PE,EE;02:EF,PE,EE")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+# Stands in for tksheet.Sheet: records the calls MyFrame makes and formats the visible cells,
+# which is the only per-cell work a real redraw does.
+class StubSheet:
+    def __init__(self):
+        self.data = []
+        self.calls = 0
+        self.top = 0
+
+    def set_sheet_data(self, data, reset_col_positions=True, redraw=True):
+        self.calls += 1
+        self.data = data
+        if redraw:
+            self.redraw()
+
+    def column_width(self, column, width):
+        self.calls += 1
+
+    def highlight_columns(self, columns, bg=None, fg=None):
+        self.calls += 1
+
+    def del_rows(self, rows, redraw=True):
+        for i in sorted(rows, reverse=True):
+            del self.data[i]
+
+    def insert_rows(self, rows, idx=None, redraw=True):
+        idx = len(self.data) if idx is None else idx
+        self.data[idx:idx] = rows
+
+    def get_total_rows(self):
+        return len(self.data)
+
+    def get_total_columns(self):
+        return len(COLUMN_WIDTHS)
+
+    # Selection and scrolling, as used by grid_view.GridView
+    def get_yview(self):
+        if not self.data:
+            return 0.0, 1.0
+        return self.top / len(self.data), min(1.0, (self.top + VISIBLE_ROWS) / len(self.data))
+
+    def set_yview(self, position):
+        self.top = int(position * len(self.data))
+
+    def get_selected_rows(self):
+        return set()
+
+    def get_currently_selected(self):
+        return ()
+
+    def deselect(self, what="all", redraw=True):
+        pass
+
+    def redraw(self):
+        self.calls += 1
+        for row in self.data[self.top:self.top + VISIBLE_ROWS]:
+            for col in range(len(COLUMN_WIDTHS)):
+                str(row[col])
+
+
+def make_tk_sheet():
+    # Real tksheet widget, needs a display (e.g. xvfb-run python -m benchmark --render tk)
+    import tkinter as tk
+    from tksheet import Sheet
+
+    root = tk.Tk()
+    sheet = Sheet(root)
+    sheet.pack(fill="both", expand=True)
+    root.update()
+
+    class TkSheet:
+        def __getattr__(self, name):
+            return getattr(sheet, name)
+
+        def redraw(self):
+            sheet.redraw()
+            root.update()
+
+    return TkSheet()
+
+
+def style_sheet(sheet):
+    # Done once when MyFrame is built
+    for i, width in enumerate(COLUMN_WIDTHS):
+        sheet.column_width(column=i, width=width)
+    for i in range(10, 15):
+        sheet.highlight_columns(columns=[i], bg="lightgray", fg="black")
+
+
+def apply_data(sheet, data):
+    # Same widget calls as MyFrame.apply_data without a filter, into an empty grid
+    grid_view.GridView(sheet, 200).show(list(data))
+
+
+class Stopwatch:
+    # Times the sub-stages of one stage run. In the memory run (tracemalloc on) each sub-stage
+    # also gets its own peak, above the traced memory at its start, and the allocated blocks it
+    # leaves behind; a sub-stage measured several times keeps the largest values
+    def __init__(self):
+        self.timings = []
+        self.memory = {}
+
+    @contextlib.contextmanager
+    def measure(self, suffix):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            gc.collect()
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+            blocks_before = sys.getallocatedblocks()
+        started = time.perf_counter()
+        yield
+        self.timings.append((suffix, time.perf_counter() - started))
+        if tracing:
+            peak = (tracemalloc.get_traced_memory()[1] - traced_before) / 1024
+            blocks = sys.getallocatedblocks() - blocks_before
+            previous = self.memory.get(suffix, (peak, blocks))
+            self.memory[suffix] = (max(peak, previous[0]), max(blocks, previous[1]))
+
+    def add(self, suffix, seconds):
+        # Measured elsewhere (e.g. in a callback): no memory figures
+        self.timings.append((suffix, seconds))
+
+
+class Bench:
+    def __init__(self, orders, seed, latency, render, mutate_fraction, save_batch):
+        started = time.perf_counter()
+        self.dataset = Dataset(orders, seed)
+        self.generate_seconds = time.perf_counter() - started
+        self.database = FakeDatabase(self.dataset, latency)
+        for name in db.POOL_DATABASES:
+            db.set_pool(name, db.ConnectionPool(self.database.connect, name=name))
+        self.render = render
+        self.mutate_fraction = mutate_fraction
+        self.save_batch = save_batch
+        self.sheet = make_tk_sheet() if render == "tk" else StubSheet()
+        style_sheet(self.sheet)
+        self.raw_rows = None
+        self.store = None
+        self.rows = None
+        self.sync_state = None
+        self.index = None
+        self.tmpdir = tempfile.mkdtemp(prefix="siiapp-bench-")
+
+    def full_load(self):
+        # What MyFrame._load_worker does for a full load
+        store = ProductionStore()
+        rows, sync_state = db.fetch_production_data(
+            threading.Event(), row_factory=store.append_raw)
+        index = SearchIndex()
+        index.rebuild(rows)
+        return store, rows, sync_state, index
+
+    def prepare(self):
+        self.raw_rows = self.dataset.production_rows()
+        self.store, self.rows, self.sync_state, self.index = self.full_load()
+
+    # Stages: each returns the Stopwatch of one repetition
+    def stage_format(self):
+        # The produced rows stay referenced until their sub-stage is measured, so the memory
+        # columns compare the string rows with the store
+        watch = Stopwatch()
+        with watch.measure("strings"):
+            strings = [db.format_production_row(row) for row in self.raw_rows]
+        del strings
+        with watch.measure("store"):
+            store, rows = build_store(self.raw_rows)
+        return watch
+
+    def stage_load(self):
+        watch = Stopwatch()
+        with watch.measure(""):
+            loaded = self.full_load()
+        del loaded
+
+        # Tree mode (GRID_TREE): parent rows only, then the records of a few selected OPs
+        store = ProductionStore()
+        with watch.measure("tree"):
+            parents, _ = db.fetch_production_data(
+                threading.Event(), row_factory=store.append_raw, parents_only=True)
+        with watch.measure("children"):
+            children = db.fetch_fp_children([db.op_key(row) for row in parents[:TREE_SELECTION]], threading.Event())
+        del store, parents, children
+
+        # Several scopes, each on its own pooled connection, merged in # OP order
+        with watch.measure("scopes"):
+            loaded = backends.DirectBackend(scopes=SCOPES).fetch_full(ProductionStore(), threading.Event())
+        return watch
+
+    def stage_filter(self):
+        watch = Stopwatch()
+        for query in FILTER_QUERIES:
+            with watch.measure(""):
+                self.index.search(query)
+        return watch
+
+    def stage_sort(self):
+        # First use of each order (keys and permutation built), the cached reuse, and a
+        # filter result ordered through the cached permutation
+        watch = Stopwatch()
+        index = SortIndex()
+        index.rebuild(self.rows)
+        subset = self.index.search(FILTER_QUERIES[3])
+        for spec, group in SORT_ORDERS:
+            with watch.measure("first"):
+                index.ordered(None, spec, group)
+            with watch.measure("cached"):
+                index.ordered(None, spec, group)
+            with watch.measure("filtered"):
+                index.ordered(subset, spec, group)
+        return watch
+
+    def stage_render(self):
+        watch = Stopwatch()
+        with watch.measure(""):
+            apply_data(self.sheet, self.rows)
+
+        # Streamed first load: time to the first visible batch and to the last one
+        store = ProductionStore()
+        sheet_rows = []
+        first = []
+        started = time.perf_counter()
+
+        def on_batch(batch):
+            if not sheet_rows:
+                sheet_rows.extend(batch)
+                self.sheet.set_sheet_data(sheet_rows, reset_col_positions=False)
+                first.append(time.perf_counter() - started)
+            else:
+                self.sheet.insert_rows(batch, idx=self.sheet.get_total_rows())
+
+        with watch.measure("stream_total"):
+            db.fetch_production_data(threading.Event(), row_factory=store.append_raw, on_batch=on_batch)
+        watch.add("stream_first", first[0] if first else 0.0)
+
+        # Full reload with a few changed OPs, shown as row edits against the rows on screen
+        view = grid_view.GridView(self.sheet, 200)
+        view.show(list(sheet_rows))
+        self.dataset.mutate(3 / max(1, len(self.dataset.orders)))
+        store = ProductionStore()
+        reloaded = db.fetch_production_data(threading.Event(), row_factory=store.append_raw)[0]
+        with watch.measure("reload_diff"):
+            view.show(reloaded)
+        return watch
+
+    def stage_delta(self):
+        # reload_data: server activity, then fetch + patch of the changed OPs
+        self.dataset.mutate(self.mutate_fraction)
+        watch = Stopwatch()
+        with watch.measure(""):
+            touched, removed, changed_rows, self.sync_state = db.fetch_production_delta(
+                self.sync_state, threading.Event(), row_factory=self.store.append_raw)
+            deleted, inserted = db.apply_production_delta(self.rows, touched, removed, changed_rows)
+            self.store.release(len(deleted))
+            self.index.remove_ops(touched | removed)
+            self.index.add_rows(changed_rows)
+        return watch
+
+    def stage_save(self):
+        watch = Stopwatch()
+        with_fp = [row for row in self.rows[:self.save_batch * 4] if row[10]]
+        without_fp = [row for row in self.rows[:self.save_batch * 4] if not row[10]]
+        creates = [(row[0], row[9], row[7]) for row in without_fp[:self.save_batch]]
+        updates = [(row[10], None) for row in with_fp[:self.save_batch]]
+        with watch.measure("bulk"):
+            db.bulk_save_fp_records(creates, updates, "Envasado", "01", None)
+        if self.rows:
+            with watch.measure("single"):
+                db.create_fp_record(self.rows[0][0], "01", "100", "Pesaje", "01", "")
+            # Journaled save: fsync'd append (what the user waits for), then the flush to SIIAPP
+            journal = save_journal.SaveJournal(os.path.join(self.tmpdir, "save_journal.jsonl"))
+            flusher = save_journal.JournalFlusher(journal, backends.DirectBackend(), lambda *args: None)
+            with watch.measure("journal"):
+                journal.append("create", self.rows[0][0], "01", None,
+                               {"cantidad": "100", "fase": "Pesaje", "planta": "01", "comentarios": ""})
+            with watch.measure("flush"):
+                flusher.flush()
+            journal.close()
+        return watch
+
+    def stage_snapshot(self):
+        path = os.path.join(self.tmpdir, "grid_snapshot.json.gz")
+        watch = Stopwatch()
+        with watch.measure("save"):
+            snapshot.save_snapshot(path, "bench", self.rows, self.sync_state)
+        with watch.measure("load"):
+            exported, _, _ = snapshot.load_snapshot(path, "bench")
+            store = ProductionStore()
+            rows = [store.append_exported(values) for values in exported]
+        return watch
+
+    def stage_export(self):
+        headers = [f"COL{col}" for col in range(len(COLUMN_WIDTHS))]
+        watch = Stopwatch()
+        for extension in grid_export.EXPORT_FORMATS:
+            path = os.path.join(self.tmpdir, f"export{extension}")
+            with watch.measure(extension[1:]):
+                grid_export.export_rows(path, headers, self.rows, column_widths=COLUMN_WIDTHS)
+        return watch
+
+    def stage_mirror(self):
+        # ERP mirror worker: a first copy into an empty FP_OP_MIRROR, then a pass after server
+        # activity that only rewrites the changed OPs
+        self.database.mirror.clear()
+        self.database.mirror_state.clear()
+        mirror = erp_mirror.ErpMirror()
+        watch = Stopwatch()
+        with watch.measure("initial"):
+            mirror.sync()
+        self.dataset.mutate(self.mutate_fraction)
+        with watch.measure("refresh"):
+            mirror.sync()
+        return watch
+
+    def stage_events(self):
+        # Phase event log: the FP_TIMES backfill into an empty log, then the bulk save of the
+        # save stage writing both FP_TIMES and the log (migration) and the log alone
+        self.database.phase_events.clear()
+        watch = Stopwatch()
+        with watch.measure("backfill"):
+            phase_events.backfill()
+        with_fp = [row for row in self.rows[:self.save_batch * 4] if row[10]]
+        without_fp = [row for row in self.rows[:self.save_batch * 4] if not row[10]]
+        creates = [(row[0], row[9], row[7]) for row in without_fp[:self.save_batch]]
+        updates = [(row[10], None) for row in with_fp[:self.save_batch]]
+        saved = (db.PHASE_EVENTS, db.PHASE_EVENT_WRITES, db.FP_TIMES_WRITES, db._TIMES_TABLE)
+        try:
+            for name, dual, fase in (("dual", True, "Embalaje"), ("bulk", False, "Despacho")):
+                db.use_phase_events(dual)
+                with watch.measure(name):
+                    db.bulk_save_fp_records(creates, updates, fase, "01", None, user="benchmark")
+        finally:
+            db.PHASE_EVENTS, db.PHASE_EVENT_WRITES, db.FP_TIMES_WRITES, db._TIMES_TABLE = saved
+        return watch
+
+
+def run_stage(bench, stage, repeat, warmup):
+    method = getattr(bench, f"stage_{stage}")
+    for _ in range(warmup):
+        method()
+    samples = {}
+    for _ in range(repeat):
+        for suffix, seconds in method().timings:
+            samples.setdefault(suffix, []).append(seconds)
+
+    # One extra, separate run for memory: tracemalloc slows everything down
+    gc.collect()
+    tracemalloc.start()
+    try:
+        memory = method().memory
+    finally:
+        tracemalloc.stop()
+
+    results = {}
+    for suffix, values in samples.items():
+        name = f"{stage}.{suffix}" if suffix else stage
+        peak_kb, blocks = memory.get(suffix, (None, None))
+        results[name] = {
+            "runs": len(values),
+            "mean_ms": 1000 * sum(values) / len(values),
+            "p50_ms": 1000 * percentile(values, 50),
+            "p90_ms": 1000 * percentile(values, 90),
+            "p99_ms": 1000 * percentile(values, 99),
+            "max_ms": 1000 * max(values),
+            "peak_kb": peak_kb,
+            "net_blocks": blocks,
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # A stage regresses when its median latency or peak memory grows beyond the tolerance
+    regressions = []
+    for name, current in results["stages"].items():
+        previous = baseline.get("stages", {}).get(name)
+        if previous is None:
+            continue
+        for metric in ("p50_ms", "peak_kb"):
+            if previous[metric] is None or current[metric] is None:
+                continue
+            if previous[metric] > 0 and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{name} {metric}: {previous[metric]:.2f} -> {current[metric]:.2f} "
+                    f"(+{100 * (current[metric] / previous[metric] - 1):.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmark",
+        description="Synthetic benchmarks of the grid load, format, filter, render, refresh and save paths")
+    parser.add_argument("--rows", default="10k", help="pd_ordenproceso rows: 1k, 10k, 100k, 1m or a number")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated network latency per round trip")
+    parser.add_argument("--render", choices=("stub", "tk"), default="stub",
+                        help="stub Sheet, or a real tksheet widget (needs a display, e.g. xvfb-run)")
+    parser.add_argument("--mutate", type=float, default=0.01, help="fraction of OPs changed before each delta")
+    parser.add_argument("--save-batch", type=int, default=50, help="records per bulk save")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing, 0.25 = 25%%")
+    args = parser.parse_args(argv)
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    bench = Bench(parse_scale(args.rows), args.seed, args.latency_ms / 1000,
+                  args.render, args.mutate, args.save_batch)
+    bench.prepare()
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "orders": len(bench.dataset.orders),
+            "grid_rows": len(bench.rows),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "latency_ms": args.latency_ms,
+            "render": args.render,
+            "generate_s": bench.generate_seconds,
+        },
+        "stages": {},
+    }
+    for stage in stages:
+        results["stages"].update(run_stage(bench, stage, args.repeat, args.warmup))
+    results["meta"]["round_trips"] = bench.database.round_trips
+
+    print(f"{results['meta']['grid_rows']} grid rows ({results['meta']['orders']} orders)")
+    print(f"{'stage':<18}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'peak KB':>12}{'blocks':>10}")
+    for name, stats in results["stages"].items():
+        peak = "-" if stats["peak_kb"] is None else f"{stats['peak_kb']:.0f}"
+        blocks = "-" if stats["net_blocks"] is None else stats["net_blocks"]
+        print(f"{name:<18}{stats['p50_ms']:>10.2f}{stats['p90_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+              f"{stats['max_ms']:>10.2f}{peak:>12}{blocks:>10}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against", args.baseline)
+            for line in regressions:
+                print("  " + line)
+            return 1
+        print("No regressions against", args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
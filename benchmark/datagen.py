@@ -0,0 +1,214 @@
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+# Grid scales accepted by --rows (number of pd_ordenproceso rows)
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+PHASES = ["Dispensacion", "Pesaje", "Fabricacion", "Microbiologia", "Envasado",
+          "Acondicionamiento", "Embalaje", "Despacho", "Reproceso"]
+PLANTS = ["01", "02"]
+# eobcodigo -> eobnombre; the grid only shows EF/PE/EE
+STATES = {"EF": "En Fabricacion", "PE": "Pendiente", "EE": "En Espera", "CE": "Cerrada"}
+ACTIVE_STATES = ("EF", "PE", "EE")
+PRODUCTS = ["CREMA HIDRATANTE", "GEL ANTIBACTERIAL", "SHAMPOO ANTICASPA", "LOCION CORPORAL",
+            "JARABE PEDIATRICO", "TABLETAS RECUBIERTAS", "SUSPENSION ORAL", "UNGUENTO TOPICO"]
+PRESENTATIONS = ["X 30 ML", "X 60 ML", "X 120 ML", "X 250 ML", "X 500 ML", "X 10 TAB", "X 30 TAB"]
+COMMENTS = ["", "", "", "Pendiente liberacion de calidad", "Falta material de empaque",
+            "Reproceso por viscosidad", "Prioridad cliente", "Esperando aprobacion"]
+
+
+def parse_scale(value):
+    value = str(value).lower()
+    if value in SCALES:
+        return SCALES[value]
+    return int(value.replace("_", ""))
+
+
+# In-memory stand-in for ssf_genericos (pd_ordenproceso, in_items) and SIIAPP (FP_PROGRES,
+# FP_TIMES). Deterministic for a given seed, so results are comparable between runs.
+class Dataset:
+    def __init__(self, orders, seed=1):
+        self.rng = random.Random(seed)
+        self.now = datetime(2024, 6, 1, 8, 0, 0)
+        self.items = {}
+        self.orders = {}
+        self.fp_progres = {}
+        self.fp_times = {}
+        self.next_op = 100000
+        self.next_fp_id = 1
+        self.next_order = 50000
+        for i in range(max(20, orders // 25)):
+            code = f"PT{i:05d}"
+            name = f"{self.rng.choice(PRODUCTS)} REF {i} {self.rng.choice(PRESENTATIONS)}"
+            self.items[(code, "01")] = name
+            self.items[(code, "02")] = name
+        self._item_codes = sorted({code for code, _ in self.items})
+        for _ in range(orders):
+            self.add_order()
+
+    def add_order(self):
+        rng = self.rng
+        op = self.next_op
+        self.next_op += 1
+        if rng.random() < 0.6:
+            # Several OPs usually share one sales order
+            self.next_order += 1
+        required = self.now + timedelta(days=rng.randint(-30, 90))
+        self.orders[op] = {
+            "orpconspedi": str(self.next_order),
+            "orpcodiitem": rng.choice(self._item_codes),
+            "orpfecharequ": required,
+            "orpfechaentrega": required - timedelta(days=rng.randint(3, 15)),
+            "orpfechestifin": required - timedelta(days=rng.randint(0, 3)),
+            "orpcantrequump": Decimal(rng.choice([500, 1000, 2000, 5000, 12000])).quantize(Decimal("0.0001")),
+            "eobcodigo": rng.choices(list(STATES), weights=[45, 25, 20, 10])[0],
+            "orpcompania": "01" if rng.random() < 0.95 else "02",
+        }
+        # 70% of the orders already have progress records, a few more than one
+        records = 0 if rng.random() < 0.3 else (2 if rng.random() < 0.1 else 1)
+        for _ in range(records):
+            self.add_fp_record(op)
+        return op
+
+    def add_fp_record(self, op, fase=None, planta=None, cantidad=None, comentarios=None):
+        rng = self.rng
+        fp_id = self.next_fp_id
+        self.next_fp_id += 1
+        fase = fase or rng.choice(PHASES)
+        self.fp_progres[fp_id] = {
+            "orpconsecutivo": str(op),
+            "orpcompania": self.orders[op]["orpcompania"] if op in self.orders else "01",
+            "CANTIDAD_FP": Decimal(cantidad if cantidad is not None else rng.choice([250, 500, 1000])).quantize(Decimal("0.01")),
+            "FASE_PODUCC": fase,
+            "PLANTA": planta or rng.choice(PLANTS),
+            "COMENTARIES": rng.choice(COMMENTS) if comentarios is None else comentarios,
+        }
+        self.fp_times[fp_id] = {f"{fase}_ST": self.now - timedelta(hours=rng.randint(1, 200))}
+        return fp_id
+
+    def mutate(self, fraction=0.01):
+        # Simulates activity between two refreshes: moved phases, edited orders, new and
+        # closed OPs. Returns the number of OPs touched.
+        rng = self.rng
+        count = max(1, int(len(self.orders) * fraction))
+        ops = rng.sample(list(self.orders), min(count, len(self.orders)))
+        fp_by_op = {}
+        for fp_id, record in self.fp_progres.items():
+            fp_by_op.setdefault(record["orpconsecutivo"], []).append(fp_id)
+        for op in ops:
+            roll = rng.random()
+            if roll < 0.6 and fp_by_op.get(str(op)):
+                record = self.fp_progres[rng.choice(fp_by_op[str(op)])]
+                record["FASE_PODUCC"] = rng.choice(PHASES)
+            elif roll < 0.8:
+                self.orders[op]["orpcantrequump"] += 100
+            elif roll < 0.9:
+                self.orders[op]["eobcodigo"] = "CE"
+            else:
+                self.add_fp_record(op)
+        for _ in range(max(1, count // 10)):
+            self.add_order()
+        return len(ops)
+
+    def is_active(self, op, company="01", states=ACTIVE_STATES):
+        # Whether the grid query of a scope (company, ERP states) returns the OP
+        order = self.orders.get(op)
+        return (order is not None and order["orpcompania"] == company
+                and order["eobcodigo"] in states
+                and (order["orpcodiitem"], company) in self.items)
+
+    def _fp_by_op(self):
+        # FP_PROGRES records by (company, OP), the way the production query joins them
+        fp_by_op = {}
+        for fp_id, record in self.fp_progres.items():
+            fp_by_op.setdefault((record["orpcompania"], record["orpconsecutivo"]), []).append(fp_id)
+        return fp_by_op
+
+    def _head(self, op):
+        # ERP columns of an OP (db._ERP_COLUMNS)
+        order = self.orders[op]
+        return (op, order["orpconspedi"], order["orpcodiitem"],
+                self.items[(order["orpcodiitem"], order["orpcompania"])], order["orpfecharequ"],
+                order["orpfechaentrega"], order["orpfechestifin"], order["orpcantrequump"],
+                STATES[order["eobcodigo"]], order["orpcompania"])
+
+    def production_rows(self, ops=None, company="01", states=ACTIVE_STATES):
+        # Rows of the production query (same column order as db.PRODUCTION_SELECT)
+        fp_by_op = self._fp_by_op()
+        selected = sorted(self.orders) if ops is None else sorted(ops)
+        rows = []
+        for op in selected:
+            if not self.is_active(op, company, states):
+                continue
+            head = self._head(op)
+            fp_ids = fp_by_op.get((company, str(op)))
+            if not fp_ids:
+                rows.append(head + (None, None, None, None, None))
+                continue
+            for fp_id in fp_ids:
+                record = self.fp_progres[fp_id]
+                rows.append(head + (fp_id, record["CANTIDAD_FP"], record["FASE_PODUCC"],
+                                    record["PLANTA"], record["COMENTARIES"]))
+        return rows
+
+    def parent_rows(self, ops=None, company="01", states=ACTIVE_STATES):
+        # Rows of the tree mode parent query (db.PARENT_SELECT): one per active OP
+        selected = sorted(self.orders) if ops is None else sorted(ops)
+        return [self._head(op) for op in selected if self.is_active(op, company, states)]
+
+    def fp_children(self, ops=None, with_times=True):
+        # Rows of db.fetch_fp_children: FP_PROGRES records of every company, optionally
+        # followed by FP_TIMES
+        fp_by_op = {}
+        for fp_id, record in self.fp_progres.items():
+            fp_by_op.setdefault(record["orpconsecutivo"], []).append(fp_id)
+        selected = sorted(fp_by_op) if ops is None else sorted({str(op) for op in ops})
+        rows = []
+        for op in selected:
+            for fp_id in sorted(fp_by_op.get(op, ())):
+                record = self.fp_progres[fp_id]
+                row = (op, record["orpcompania"], fp_id, record["CANTIDAD_FP"],
+                       record["FASE_PODUCC"], record["PLANTA"], record["COMENTARIES"])
+                if with_times:
+                    times = self.fp_times.get(fp_id, {})
+                    row += tuple(times.get(f"{fase}_{edge}") for fase in PHASES for edge in ("ST", "ET"))
+                rows.append(row)
+        return rows
+
+    def mirror_source_rows(self, ops=None, company="01", states=ACTIVE_STATES):
+        # Rows of db.MIRROR_SOURCE_SELECT: ERP columns, itecompania, eobcodigo and checksum
+        selected = sorted(self.orders) if ops is None else sorted(ops)
+        return [self._head(op) + (company, self.orders[op]["eobcodigo"], self._mirror_checksum(op))
+                for op in selected if self.is_active(op, company, states)]
+
+    def mirror_signatures(self, company="01", states=ACTIVE_STATES):
+        return [(op, self._mirror_checksum(op)) for op in sorted(self.orders)
+                if self.is_active(op, company, states)]
+
+    def _mirror_checksum(self, op):
+        order = self.orders[op]
+        return hash(self._head(op)[1:9] + (order["eobcodigo"],)) & 0x7FFFFFFF
+
+    def op_signatures(self, company="01", states=ACTIVE_STATES):
+        signatures = []
+        for op, order in self.orders.items():
+            if order["orpcompania"] != company or order["eobcodigo"] not in states:
+                continue
+            checksum = hash((order["orpconspedi"], order["orpcodiitem"], order["orpfecharequ"],
+                             order["orpfechaentrega"], order["orpfechestifin"],
+                             order["orpcantrequump"], STATES[order["eobcodigo"]])) & 0x7FFFFFFF
+            signatures.append((op, checksum))
+        return signatures
+
+    def fp_signatures(self, ops, company="01"):
+        # FP_SIGNATURE_QUERY restricted to the given (active) OPs of a company
+        by_op = {}
+        for fp_id, record in self.fp_progres.items():
+            if int(record["orpconsecutivo"]) not in ops or record["orpcompania"] != company:
+                continue
+            checksum = hash((fp_id, record["CANTIDAD_FP"], record["FASE_PODUCC"],
+                             record["PLANTA"], record["COMENTARIES"])) & 0x7FFFFFFF
+            aggregate, count = by_op.get(record["orpconsecutivo"], (0, 0))
+            by_op[record["orpconsecutivo"]] = (aggregate ^ checksum, count + 1)
+        return [(op, aggregate, count) for op, (aggregate, count) in by_op.items()]
@@ -0,0 +1,313 @@
+import threading
+import time
+from datetime import datetime
+
+import db
+import phase_events
+
+
+class FakeDriverError(Exception):
+    pass
+
+
+def _normalize(query):
+    return " ".join(query.split())
+
+
+_PRODUCTION_SELECT = _normalize(db.PRODUCTION_SELECT)
+_PRODUCTION_QUERY = _normalize(db.PRODUCTION_QUERY)
+_OP_SIGNATURE_QUERY = _normalize(db.OP_SIGNATURE_QUERY)
+_FP_SIGNATURE_QUERY = _normalize(db.FP_SIGNATURE_QUERY)
+_FP_COUNT_QUERY = _normalize(db.FP_COUNT_QUERY)
+_PARENT_SELECT = _normalize(db.PARENT_SELECT)
+_PARENT_QUERY = _normalize(db.PARENT_QUERY)
+_MIRROR_PRODUCTION_SELECT = _normalize(db.MIRROR_PRODUCTION_SELECT)
+_MIRROR_PRODUCTION_QUERY = _normalize(db.MIRROR_PRODUCTION_QUERY)
+_MIRROR_PARENT_SELECT = _normalize(db.MIRROR_PARENT_SELECT)
+_MIRROR_PARENT_QUERY = _normalize(db.MIRROR_PARENT_QUERY)
+_MIRROR_OP_SIGNATURE_QUERY = _normalize(db.MIRROR_OP_SIGNATURE_QUERY)
+_MIRROR_FP_SIGNATURE_QUERY = _normalize(db.MIRROR_FP_SIGNATURE_QUERY)
+_MIRROR_FP_COUNT_QUERY = _normalize(db.MIRROR_FP_COUNT_QUERY)
+_MIRROR_SOURCE_SELECT = _normalize(db.MIRROR_SOURCE_SELECT)
+_MIRROR_SOURCE_SIGNATURE_QUERY = _normalize(db.MIRROR_SOURCE_SIGNATURE_QUERY)
+_CHILDREN_SELECT = "SELECT FP_PROGRES.orpconsecutivo, FP_PROGRES.orpcompania, FP_PROGRES.FP_ID,"
+_PHASE_EVENT_INSERT = "INSERT INTO FP_PHASE_EVENTS (FP_ID, FASE, EVENT, EVENT_AT, USER_NAME) SELECT v.FP_ID,"
+_PHASE_EVENT_BACKFILL = _normalize(phase_events.BACKFILL_QUERY)
+
+
+def _scope(params):
+    # (company, states) of the grid query parameters (db.scope_params)
+    return params[0], tuple(params[2:5])
+
+
+# A pyodbc-shaped driver over a datagen.Dataset. It recognises the statements issued by db.py
+# and answers them from memory; `latency` seconds are added per round trip to mimic the network.
+class FakeDatabase:
+    def __init__(self, dataset, latency=0.0):
+        self.dataset = dataset
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        # FP_SAVE_KEYS: {SAVE_KEY: FP_ID}
+        self.save_keys = {}
+        # FP_OP_MIRROR: {OP: row in erp_mirror.MIRROR_COLUMNS order}, FP_OP_MIRROR_STATE per company
+        self.mirror = {}
+        self.mirror_state = {}
+        # FP_PHASE_EVENTS: [(FP_ID, FASE, EVENT, EVENT_AT, USER_NAME)]
+        self.phase_events = []
+
+    def add_phase_event(self, fp_id, fase, event, event_at, user):
+        # Also kept in the dataset's FP_TIMES values, which stand in for the FP_PHASE_TIMES view
+        self.phase_events.append((fp_id, fase, event, event_at, user))
+        times = self.dataset.fp_times.setdefault(fp_id, {})
+        if event == "ST":
+            times.setdefault(f"{fase}_ST", event_at)
+        elif f"{fase}_ST" in times:
+            times[f"{fase}_ET"] = max(event_at, times.get(f"{fase}_ET") or event_at)
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+        self.timeout = 0
+
+    def cursor(self):
+        return FakeCursor(self.database)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self._rows = []
+        self._pos = 0
+        self._last_id = None
+        self.fast_executemany = False
+        self.rowcount = -1
+
+    def _round_trip(self):
+        self.database.round_trips += 1
+        if self.database.latency:
+            time.sleep(self.database.latency)
+
+    def execute(self, query, params=()):
+        self._round_trip()
+        self.rowcount = -1
+        with self.database.lock:
+            self._rows = self._dispatch(_normalize(query), list(params))
+        self._pos = 0
+        return self
+
+    def executemany(self, query, seq_of_params):
+        self._round_trip()
+        query = _normalize(query)
+        with self.database.lock:
+            for params in seq_of_params:
+                self._dispatch(query, list(params))
+        self._rows = []
+        return self
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchmany(self, size):
+        if self._pos < len(self._rows):
+            self._round_trip()
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _mirror_rows(self, params, ops=None, with_fp=True):
+        # Grid rows read from FP_OP_MIRROR (db.MIRROR_PRODUCTION_SELECT / MIRROR_PARENT_SELECT)
+        data = self.database.dataset
+        mirror = self.database.mirror
+        company, states = _scope(params)
+        fp_by_op = data._fp_by_op() if with_fp else {}
+        rows = []
+        for op in sorted(mirror) if ops is None else sorted(op for op in ops if op in mirror):
+            if mirror[op][9] != company or mirror[op][11] not in states:
+                continue
+            head = tuple(mirror[op][:10])
+            if not with_fp:
+                rows.append(head)
+                continue
+            fp_ids = fp_by_op.get((company, str(op)))
+            if not fp_ids:
+                rows.append(head + (None, None, None, None, None))
+            for fp_id in fp_ids or ():
+                record = data.fp_progres[fp_id]
+                rows.append(head + (fp_id, record["CANTIDAD_FP"], record["FASE_PODUCC"],
+                                    record["PLANTA"], record["COMENTARIES"]))
+        return rows
+
+    def _dispatch_mirror(self, query, params):
+        # Statements of the ERP mirror (erp_mirror.py and db.use_erp_mirror); None if not one
+        data = self.database.dataset
+        database = self.database
+        skip = len(db.PRODUCTION_PARAMS)
+        if query == _MIRROR_SOURCE_SIGNATURE_QUERY:
+            return data.mirror_signatures(*_scope(params))
+        if query.startswith(_MIRROR_SOURCE_SELECT + " AND pd_ordenproceso.orpconsecutivo IN ("):
+            return data.mirror_source_rows({int(op) for op in params[skip:]}, *_scope(params))
+        if query == _MIRROR_OP_SIGNATURE_QUERY:
+            company, states = params[0], tuple(params[1:4])
+            return [(op, row[12]) for op, row in sorted(database.mirror.items())
+                    if row[9] == company and row[11] in states]
+        if query in (_MIRROR_FP_SIGNATURE_QUERY, _MIRROR_FP_COUNT_QUERY):
+            company, states = params[0], tuple(params[1:4])
+            signatures = data.fp_signatures({op for op, row in database.mirror.items()
+                                             if row[9] == company and row[11] in states}, company)
+            if query == _MIRROR_FP_COUNT_QUERY:
+                return [(op, count) for op, _, count in signatures]
+            return signatures
+        if query == _MIRROR_PRODUCTION_QUERY:
+            return self._mirror_rows(params)
+        if query.startswith(_MIRROR_PRODUCTION_SELECT + " AND pd_ordenproceso.orpconsecutivo IN ("):
+            return self._mirror_rows(params, {int(op) for op in params[skip:]})
+        if query == _MIRROR_PARENT_QUERY:
+            return self._mirror_rows(params, with_fp=False)
+        if query.startswith(_MIRROR_PARENT_SELECT + " AND pd_ordenproceso.orpconsecutivo IN ("):
+            return self._mirror_rows(params, {int(op) for op in params[skip:]}, with_fp=False)
+        if query.startswith("SELECT orpconsecutivo, ERP_CHECKSUM FROM FP_OP_MIRROR WHERE"):
+            return [(str(op), row[12]) for op, row in database.mirror.items() if row[9] == params[0]]
+        if query.startswith("SELECT WATERMARK, FULL_SYNC_AT FROM FP_OP_MIRROR_STATE"):
+            state = database.mirror_state.get(params[0])
+            return [] if state is None else [(state["WATERMARK"], state["FULL_SYNC_AT"])]
+        if query.startswith("INSERT INTO FP_OP_MIRROR_STATE"):
+            database.mirror_state[params[0]] = {"WATERMARK": None, "SYNCED_AT": None,
+                                                "FULL_SYNC_AT": None, "OPS": None}
+            return []
+        if query.startswith("DELETE FROM FP_OP_MIRROR WHERE"):
+            for op in params[1:]:
+                database.mirror.pop(int(op), None)
+            return []
+        if query.startswith("INSERT INTO FP_OP_MIRROR"):
+            database.mirror[int(params[0])] = tuple(params)
+            return []
+        if query.startswith("UPDATE FP_OP_MIRROR_STATE"):
+            watermark, synced_at, full, _, ops, company = params
+            state = database.mirror_state[company]
+            if watermark is not None:
+                state["WATERMARK"] = watermark
+            state["SYNCED_AT"] = datetime.strptime(synced_at, "%Y-%m-%d %H:%M:%S")
+            if full:
+                state["FULL_SYNC_AT"] = state["SYNCED_AT"]
+            state["OPS"] = ops
+            return []
+        return None
+
+    def _dispatch(self, query, params):
+        data = self.database.dataset
+        if query == "SELECT 1":
+            return [(1,)]
+        if query == _OP_SIGNATURE_QUERY:
+            return data.op_signatures(params[0], tuple(params[1:4]))
+        if query in (_FP_SIGNATURE_QUERY, _FP_COUNT_QUERY):
+            signatures = data.fp_signatures(
+                {int(op) for op, _ in data.op_signatures(params[0], tuple(params[1:4]))}, params[0])
+            if query == _FP_COUNT_QUERY:
+                return [(op, count) for op, _, count in signatures]
+            return signatures
+        if query == _PRODUCTION_QUERY:
+            return data.production_rows(None, *_scope(params))
+        if query.startswith(_PRODUCTION_SELECT + " AND pd_ordenproceso.orpconsecutivo IN ("):
+            # Delta refetch: the OPs follow the production parameters
+            return data.production_rows(
+                {int(op) for op in params[len(db.PRODUCTION_PARAMS):]}, *_scope(params))
+        if query == _PARENT_QUERY:
+            return data.parent_rows(None, *_scope(params))
+        if query.startswith(_PARENT_SELECT + " AND pd_ordenproceso.orpconsecutivo IN ("):
+            return data.parent_rows({int(op) for op in params[len(db.PRODUCTION_PARAMS):]}, *_scope(params))
+        if query.startswith(_CHILDREN_SELECT):
+            return data.fp_children(params if " WHERE " in query else None, "FP_TIMES" in query)
+        if query.startswith("INSERT INTO FP_PROGRES"):
+            created = []
+            for i in range(0, len(params), 6):
+                op, company, cantidad, fase, planta, comentarios = params[i:i + 6]
+                fp_id = data.add_fp_record(int(op), fase, planta, cantidad, comentarios)
+                created.append((fp_id, op, company))
+            self._last_id = created[-1][0]
+            return created if "OUTPUT INSERTED" in query else []
+        if query == "SELECT @@IDENTITY":
+            return [(self._last_id,)]
+        if query.startswith("SELECT FASE_PODUCC FROM FP_PROGRES WHERE FP_ID = ?"):
+            record = data.fp_progres.get(int(params[0]))
+            return [(record["FASE_PODUCC"],)] if record else []
+        if query.startswith("SELECT FASE_PODUCC, CANTIDAD_FP, PLANTA, COMENTARIES FROM FP_PROGRES WITH (UPDLOCK, ROWLOCK)"):
+            record = data.fp_progres.get(int(params[0]))
+            return [(record["FASE_PODUCC"], record["CANTIDAD_FP"], record["PLANTA"],
+                     record["COMENTARIES"])] if record else []
+        if query == "SELECT FP_ID FROM FP_SAVE_KEYS WHERE SAVE_KEY = ?":
+            fp_id = self.database.save_keys.get(params[0])
+            return [] if fp_id is None else [(fp_id,)]
+        if query.startswith("INSERT INTO FP_SAVE_KEYS"):
+            self.database.save_keys[params[0]] = params[1]
+            return []
+        if query.startswith("SELECT FP_ID, FASE_PODUCC FROM FP_PROGRES WHERE FP_ID IN"):
+            return [(int(fp_id), data.fp_progres[int(fp_id)]["FASE_PODUCC"])
+                    for fp_id in params if int(fp_id) in data.fp_progres]
+        if query.startswith("UPDATE FP_PROGRES"):
+            cantidad, fase, planta, comentarios, fp_id = params
+            record = data.fp_progres.get(int(fp_id))
+            if record is not None:
+                if cantidad is not None:
+                    record["CANTIDAD_FP"] = cantidad
+                if comentarios is not None:
+                    record["COMENTARIES"] = comentarios
+                record["FASE_PODUCC"] = fase
+                record["PLANTA"] = planta
+            return []
+        if query.startswith(_PHASE_EVENT_INSERT):
+            event_at = params[0] or datetime.now()
+            for i in range(1, len(params), 4):
+                fp_id, fase, event, user = params[i:i + 4]
+                self.database.add_phase_event(int(fp_id), fase, event, event_at, user or "fake")
+            return []
+        if query == "SELECT CONVERT(datetime2(0), SYSDATETIME())":
+            return [(datetime.now().replace(microsecond=0),)]
+        if query == "SELECT MIN(FP_ID), MAX(FP_ID) FROM FP_TIMES":
+            return [(min(data.fp_times, default=None), max(data.fp_times, default=None))]
+        if query == _PHASE_EVENT_BACKFILL:
+            user, low, high = params
+            logged = {event[:4] for event in self.database.phase_events}
+            events = [(fp_id, column[:-3], column[-2:], value, user)
+                      for fp_id, times in data.fp_times.items() if low < fp_id <= high
+                      for column, value in times.items()
+                      if value is not None and (fp_id, column[:-3], column[-2:], value) not in logged]
+            self.database.phase_events.extend(events)
+            self.rowcount = len(events)
+            return []
+        if query.startswith("INSERT INTO FP_TIMES") or query.startswith("UPDATE FP_TIMES"):
+            fp_id = params[0] if query.startswith("INSERT") else params[-1]
+            data.fp_times.setdefault(int(fp_id), {})
+            return []
+        rows = self._dispatch_mirror(query, params)
+        if rows is not None:
+            return rows
+        raise FakeDriverError(f"Statement not supported by the benchmark driver: {query[:80]}")
@@ -0,0 +1,1375 @@
+import bisect
+import heapq
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+import metrics
+import startup_profile
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class LoadCancelled(Exception):
+    pass
+
+
+# A journaled save that no longer applies: the record was deleted or changed by someone else
+class SaveConflict(Exception):
+    pass
+
+
+# Bounded, thread-safe pool of DB-API connections.
+# `connect` is any callable returning a new connection (pyodbc, sqlite3, a fake driver...).
+# Idle connections older than `max_idle` seconds are recycled, the rest are health-checked
+# with `health_query` before being handed out.
+class ConnectionPool:
+    def __init__(self, connect, max_size=5, timeout=30, max_idle=300,
+                 health_query="SELECT 1", name="pool"):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_query = health_query
+        self.name = name
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "wait_time": 0.0,
+            "max_wait": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "reconnects": 0,
+            "recycled": 0,
+            "discarded": 0,
+        }
+
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout(f"Pool {self.name} is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # Reserve the slot now, connect outside the lock
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(
+                        f"No connection available in pool {self.name} after {timeout}s")
+                self._cond.wait(remaining)
+
+        try:
+            conn = self._prepare(conn, last_used)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self._stats["checkouts"] += 1
+            self._stats["wait_time"] += waited
+            self._stats["max_wait"] = max(self._stats["max_wait"], waited)
+        return conn
+
+    def _prepare(self, conn, last_used):
+        if conn is None:
+            return self._new_connection()
+        if time.monotonic() - last_used > self.max_idle:
+            self._close_quietly(conn)
+            with self._cond:
+                self._stats["recycled"] += 1
+            return self._new_connection()
+        if not self._is_healthy(conn):
+            self._close_quietly(conn)
+            with self._cond:
+                self._stats["reconnects"] += 1
+            return self._new_connection()
+        return conn
+
+    def _new_connection(self):
+        with metrics.timer("db", "connect", pool=self.name):
+            conn = self._connect()
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _is_healthy(self, conn):
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.health_query)
+            cursor.fetchall()
+            return True
+        except Exception as e:
+            logging.error(f"Discarding broken connection from pool {self.name}: {str(e)}")
+            return False
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
+    def release(self, conn, discard=False):
+        if not discard:
+            try:
+                # Never hand out a connection with an open transaction
+                conn.rollback()
+            except Exception:
+                discard = True
+        with self._cond:
+            if discard or self._closed:
+                self._size -= 1
+                if discard:
+                    self._stats["discarded"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if discard or self._closed:
+            self._close_quietly(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        discard = False
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+        stats["avg_wait"] = stats["wait_time"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        return stats
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+# One pool per target database: "DB1" is SIIAPP (FP_PROGRES, phase times), "DB2" is the ERP
+POOL_DATABASES = {
+    "DB1": "DB1_DATABASE",
+    "DB2": "DB2_DATABASE",
+}
+_pools = {}
+_pools_lock = threading.Lock()
+_pool_settings = {
+    "connect_timeout": 15,
+    "query_timeout": 60,
+    "max_size": 5,
+    "timeout": 30,
+    "max_idle": 300,
+}
+
+
+def configure_pools(**settings):
+    # Call once after the .env file has been loaded, before the first get_pool()
+    _pool_settings.update(settings)
+
+
+def _pyodbc_connector(database_env):
+    def connect():
+        pyodbc = startup_profile.lazy_import("pyodbc")
+        conn_str = (
+            f"DRIVER={os.getenv('DB1_DRIVER')};"
+            f"SERVER={os.getenv('DB1_SERVER')};"
+            f"DATABASE={os.getenv(database_env)};"
+            f"UID={os.getenv('DB1_UID')};"
+            f"PWD={os.getenv('DB1_PWD')}"
+        )
+        conn = pyodbc.connect(conn_str, timeout=_pool_settings["connect_timeout"])
+        conn.timeout = _pool_settings["query_timeout"]
+        return conn
+
+    return connect
+
+
+def get_pool(name):
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = ConnectionPool(
+                _pyodbc_connector(POOL_DATABASES[name]),
+                max_size=_pool_settings["max_size"],
+                timeout=_pool_settings["timeout"],
+                max_idle=_pool_settings["max_idle"],
+                name=name,
+            )
+            _pools[name] = pool
+        return pool
+
+
+def set_pool(name, pool):
+    # Replace a pool, e.g. with one backed by a local stand-in database
+    with _pools_lock:
+        old = _pools.pop(name, None)
+        _pools[name] = pool
+    if old is not None:
+        old.close()
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = dict(_pools)
+    return {name: pool.stats() for name, pool in pools.items()}
+
+
+def driver_error():
+    # pyodbc.Error, resolved on first use: pyodbc is not imported until a connection is needed
+    return startup_profile.lazy_import("pyodbc").Error
+
+
+# SQLSTATEs worth retrying: connection failures (08xxx), timeouts (HYTxx) and deadlocks (40001)
+TRANSIENT_SQLSTATES = ("08", "HYT", "40001")
+
+
+def is_transient_error(error):
+    # Whether the same write can succeed later (network blip, busy pool, deadlock)
+    if isinstance(error, PoolTimeout):
+        return True
+    if type(error).__name__ in ("OperationalError", "InterfaceError"):
+        return True
+    state = str(error.args[0]) if getattr(error, "args", None) else ""
+    return state.startswith(TRANSIENT_SQLSTATES)
+
+
+def warm_pools(names=tuple(POOL_DATABASES)):
+    # Open one connection per pool ahead of time (e.g. while the login screen is shown)
+    for name in names:
+        try:
+            with get_pool(name).connection():
+                pass
+        except Exception as e:
+            logging.error(f"An error occurred while warming pool {name}: {str(e)}")
+
+
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+# Production grid query (ERP orders joined with FP_PROGRES)
+_ERP_COLUMNS = """
+        pd_ordenproceso.orpconsecutivo AS [# OP]
+        ,pd_ordenproceso.orpconspedi AS [# PEDIDO]
+        ,pd_ordenproceso.orpcodiitem AS [CODIGO ITEM]
+        ,in_items.itedesclarg AS [DESCRIPCION ITEM]
+        ,pd_ordenproceso.orpfecharequ AS [FECHA REQUERIDA]
+        ,pd_ordenproceso.orpfechaentrega AS [FECHA ENTREGA PLANTA]
+        ,pd_ordenproceso.orpfechestifin AS [FECHA ESTIMADO FIN]
+        ,pd_ordenproceso.orpcantrequump AS [CANTIDAD PEDIDA]
+        ,pd_ordenproceso.eobnombre AS [ESTADO OP]
+        ,pd_ordenproceso.orpcompania"""
+_ERP_FROM = """
+        FROM ssf_genericos.dbo.pd_ordenproceso
+        INNER JOIN ssf_genericos.dbo.in_items
+        ON pd_ordenproceso.orpcodiitem = in_items.itecodigo
+            AND pd_ordenproceso.orpcompania = in_items.itecompania"""
+_ERP_WHERE = """
+        WHERE pd_ordenproceso.orpcompania = ?
+        AND in_items.itecompania = ?
+        AND pd_ordenproceso.eobcodigo IN (?, ?, ?)
+"""
+_FP_COLUMNS = """
+        ,FP_PROGRES.FP_ID
+        ,FP_PROGRES.CANTIDAD_FP AS [CANTIDAD EN PRODUCCION]
+        ,FP_PROGRES.FASE_PODUCC AS [FASE DE PRODUCCION]
+        ,FP_PROGRES.PLANTA AS PLANTA
+        ,FP_PROGRES.COMENTARIES AS [COMENTARIOS/OBSERVACIONES]"""
+# The ERP orders are compared with the FP_PROGRES collation
+_ERP_COLLATE = " COLLATE Latin1_General_CI_AS"
+
+
+def _fp_join(collate):
+    # Consecutives repeat across companies: the records of an OP are matched on both
+    return ("""
+        LEFT OUTER JOIN SIIAPP.dbo.FP_PROGRES
+        ON pd_ordenproceso.orpconsecutivo = FP_PROGRES.orpconsecutivo""" + collate + """
+        AND pd_ordenproceso.orpcompania = FP_PROGRES.orpcompania""" + collate)
+
+
+PRODUCTION_SELECT = "\n    SELECT" + _ERP_COLUMNS + _FP_COLUMNS + _ERP_FROM + _fp_join(_ERP_COLLATE) + _ERP_WHERE
+PRODUCTION_QUERY = PRODUCTION_SELECT + "        ORDER BY [# OP]\n"
+PRODUCTION_PARAMS = ('01', '01', 'EF', 'PE', 'EE')
+
+# Load scopes: (company, ERP states) pairs, each loaded with its own query and sync state
+DEFAULT_SCOPES = (("01", ("EF", "PE", "EE")),)
+
+
+def parse_scopes(text):
+    # "01:EF,PE,EE;02:EF,PE" -> [(company, states)]; an empty text is the default scope
+    scopes = []
+    for part in (text or "").split(";"):
+        if not part.strip():
+            continue
+        company, sep, states = part.partition(":")
+        company = company.strip()
+        states = tuple(state.strip().upper() for state in states.split(",") if state.strip())
+        if not sep:
+            states = DEFAULT_SCOPES[0][1]
+        if not company or not 1 <= len(states) <= 3:
+            raise ValueError(f"Invalid grid scope {part.strip()!r}: expected COMPANY:STATE[,STATE[,STATE]]")
+        for other_company, other_states in scopes:
+            if other_company == company and set(other_states) & set(states):
+                # The OP would be loaded twice
+                raise ValueError(f"Grid scopes of company {company} overlap")
+        scopes.append((company, states))
+    return scopes or list(DEFAULT_SCOPES)
+
+
+def scope_key(scope):
+    return f"{scope[0]}:{','.join(scope[1])}"
+
+
+def scope_params(scope):
+    # Grid query parameters of a scope. The queries take three states: shorter lists repeat
+    # their last one, so every scope runs the same statement text and cached plan
+    company, states = scope
+    return (company, company) + tuple(states) + (states[-1],) * (3 - len(states))
+
+# Tree mode parents: one row per OP with the ERP columns only. The progress records are
+# fetched per OP from SIIAPP on demand (fetch_fp_children), so there is no join fan-out.
+PARENT_SELECT = "\n    SELECT" + _ERP_COLUMNS + _ERP_FROM + _ERP_WHERE
+PARENT_QUERY = PARENT_SELECT + "        ORDER BY [# OP]\n"
+
+# Cheap change check on the active OP set: one checksum per OP, no joins
+OP_SIGNATURE_QUERY = """
+    SELECT orpconsecutivo,
+        BINARY_CHECKSUM(orpconspedi, orpcodiitem, orpfecharequ, orpfechaentrega,
+                        orpfechestifin, orpcantrequump, eobnombre)
+    FROM ssf_genericos.dbo.pd_ordenproceso
+    WHERE orpcompania = ?
+    AND eobcodigo IN (?, ?, ?)
+"""
+
+
+def _fp_aggregate_query(aggregates, grid_from, collate):
+    # Per-OP aggregates of the FP_PROGRES records of the active OPs only (same filter as the
+    # OP signature), so the check does not grow with the FP_PROGRES history
+    return ("\n    SELECT FP_PROGRES.orpconsecutivo," + aggregates + grid_from + """
+        INNER JOIN SIIAPP.dbo.FP_PROGRES
+        ON pd_ordenproceso.orpconsecutivo = FP_PROGRES.orpconsecutivo""" + collate + """
+        AND pd_ordenproceso.orpcompania = FP_PROGRES.orpcompania""" + collate + """
+        WHERE pd_ordenproceso.orpcompania = ?
+        AND pd_ordenproceso.eobcodigo IN (?, ?, ?)
+        GROUP BY FP_PROGRES.orpcompania, FP_PROGRES.orpconsecutivo
+""")
+
+
+_FP_CHECKSUM = """
+        CHECKSUM_AGG(BINARY_CHECKSUM(FP_PROGRES.FP_ID, FP_PROGRES.CANTIDAD_FP, FP_PROGRES.FASE_PODUCC,
+                                     FP_PROGRES.PLANTA, FP_PROGRES.COMENTARIES)),
+        COUNT(*)"""
+_ERP_ORDERS = """
+        FROM ssf_genericos.dbo.pd_ordenproceso"""
+# Per-OP checksum of FP_PROGRES, used when no version column is configured
+FP_SIGNATURE_QUERY = _fp_aggregate_query(_FP_CHECKSUM, _ERP_ORDERS, _ERP_COLLATE)
+# Per-OP record count, used with a version column: a rowversion does not show deletes
+FP_COUNT_QUERY = _fp_aggregate_query(" COUNT(*)", _ERP_ORDERS, _ERP_COLLATE)
+
+# Local mirror of the active ERP orders (kept up to date by erp_mirror.py): the ERP columns and
+# the item description in one SIIAPP table with the FP_PROGRES collation, indexed on
+# orpconsecutivo. It is aliased pd_ordenproceso, so filters and delta refetches apply unchanged.
+_MIRROR_COLUMNS = """
+        pd_ordenproceso.orpconsecutivo AS [# OP]
+        ,pd_ordenproceso.orpconspedi AS [# PEDIDO]
+        ,pd_ordenproceso.orpcodiitem AS [CODIGO ITEM]
+        ,pd_ordenproceso.itedesclarg AS [DESCRIPCION ITEM]
+        ,pd_ordenproceso.orpfecharequ AS [FECHA REQUERIDA]
+        ,pd_ordenproceso.orpfechaentrega AS [FECHA ENTREGA PLANTA]
+        ,pd_ordenproceso.orpfechestifin AS [FECHA ESTIMADO FIN]
+        ,pd_ordenproceso.orpcantrequump AS [CANTIDAD PEDIDA]
+        ,pd_ordenproceso.eobnombre AS [ESTADO OP]
+        ,pd_ordenproceso.orpcompania"""
+_MIRROR_FROM = """
+        FROM SIIAPP.dbo.FP_OP_MIRROR AS pd_ordenproceso"""
+_MIRROR_WHERE = """
+        WHERE pd_ordenproceso.orpcompania = ?
+        AND pd_ordenproceso.itecompania = ?
+        AND pd_ordenproceso.eobcodigo IN (?, ?, ?)
+"""
+MIRROR_PRODUCTION_SELECT = (
+    "\n    SELECT" + _MIRROR_COLUMNS + _FP_COLUMNS + _MIRROR_FROM + _fp_join("") + _MIRROR_WHERE)
+MIRROR_PRODUCTION_QUERY = MIRROR_PRODUCTION_SELECT + "        ORDER BY [# OP]\n"
+MIRROR_PARENT_SELECT = "\n    SELECT" + _MIRROR_COLUMNS + _MIRROR_FROM + _MIRROR_WHERE
+MIRROR_PARENT_QUERY = MIRROR_PARENT_SELECT + "        ORDER BY [# OP]\n"
+# The mirror stores the checksum of every OP (item description included), so the change
+# check reads one index
+MIRROR_OP_SIGNATURE_QUERY = """
+    SELECT orpconsecutivo, ERP_CHECKSUM
+    FROM SIIAPP.dbo.FP_OP_MIRROR
+    WHERE orpcompania = ?
+    AND eobcodigo IN (?, ?, ?)
+"""
+MIRROR_FP_SIGNATURE_QUERY = _fp_aggregate_query(_FP_CHECKSUM, _MIRROR_FROM, "")
+MIRROR_FP_COUNT_QUERY = _fp_aggregate_query(" COUNT(*)", _MIRROR_FROM, "")
+
+# What erp_mirror.py copies from the ERP: the mirror columns, the filter columns and a checksum
+# of everything shown, so an OP is only rewritten when something in it changed
+_MIRROR_CHECKSUM = """
+        BINARY_CHECKSUM(pd_ordenproceso.orpconspedi, pd_ordenproceso.orpcodiitem,
+                        pd_ordenproceso.orpfecharequ, pd_ordenproceso.orpfechaentrega,
+                        pd_ordenproceso.orpfechestifin, pd_ordenproceso.orpcantrequump,
+                        pd_ordenproceso.eobnombre, pd_ordenproceso.eobcodigo, in_items.itedesclarg)"""
+MIRROR_SOURCE_SELECT = (
+    "\n    SELECT" + _ERP_COLUMNS + """
+        ,in_items.itecompania
+        ,pd_ordenproceso.eobcodigo
+        ,""" + _MIRROR_CHECKSUM.strip() + _ERP_FROM + _ERP_WHERE)
+MIRROR_SOURCE_SIGNATURE_QUERY = (
+    "\n    SELECT pd_ordenproceso.orpconsecutivo," + _MIRROR_CHECKSUM + _ERP_FROM + _ERP_WHERE)
+
+# Sources of the grid queries, switched to the mirror by use_erp_mirror()
+_GRID_FROM = _ERP_FROM
+_GRID_WHERE = _ERP_WHERE
+_GRID_COLLATE = _ERP_COLLATE
+
+
+def use_erp_mirror():
+    # Read the grid from FP_OP_MIRROR instead of joining the ERP tables on every load
+    global PRODUCTION_SELECT, PRODUCTION_QUERY, PARENT_SELECT, PARENT_QUERY, OP_SIGNATURE_QUERY
+    global FP_SIGNATURE_QUERY, FP_COUNT_QUERY, _GRID_FROM, _GRID_WHERE, _GRID_COLLATE
+    PRODUCTION_SELECT, PRODUCTION_QUERY = MIRROR_PRODUCTION_SELECT, MIRROR_PRODUCTION_QUERY
+    PARENT_SELECT, PARENT_QUERY = MIRROR_PARENT_SELECT, MIRROR_PARENT_QUERY
+    OP_SIGNATURE_QUERY = MIRROR_OP_SIGNATURE_QUERY
+    FP_SIGNATURE_QUERY, FP_COUNT_QUERY = MIRROR_FP_SIGNATURE_QUERY, MIRROR_FP_COUNT_QUERY
+    _GRID_FROM, _GRID_WHERE, _GRID_COLLATE = _MIRROR_FROM, _MIRROR_WHERE, ""
+
+
+# SQL Server accepts at most 2100 parameters per statement
+DELTA_CHUNK_SIZE = 500
+DEFAULT_FETCH_SIZE = 1000
+
+
+def format_production_row(row):
+    parent_row = [
+        str(value) if value is not None else "" for value in row[:10]]
+    fp_progres_values = row[10:]
+
+    if any(fp_progres_values):
+        parent_row.extend(
+            str(value) if value is not None else "" for value in fp_progres_values)
+    else:
+        # Add empty cells for FP_PROGRES columns
+        parent_row.extend([""] * 5)
+    return parent_row
+
+
+def op_key(row):
+    # Identity of the OP of a grid row: consecutives repeat across companies, so deltas,
+    # indexes and caches key OPs by (company, OP)
+    return (str(row[9]), str(row[0]))
+
+
+def op_sort_key(op_value):
+    # Mirror the server ORDER BY for numeric consecutives stored as text
+    try:
+        return (0, int(op_value), "")
+    except ValueError:
+        return (1, 0, op_value)
+
+
+def fetch_sync_state(cursor, previous=None, version_column="", params=PRODUCTION_PARAMS):
+    # High-water marks describing what the client has already loaded
+    state = {}
+    op_params = (params[0],) + tuple(params[2:])
+    cursor.execute(OP_SIGNATURE_QUERY, op_params)
+    state["ops"] = {str(op): checksum for op, checksum in cursor.fetchall()}
+
+    if version_column:
+        # Versions from MIN_ACTIVE_ROWVERSION() on may still be uncommitted: the next check
+        # starts there (inclusive), so a transaction that commits late is not skipped
+        cursor.execute("SELECT MIN_ACTIVE_ROWVERSION()")
+        state["fp_watermark"] = cursor.fetchone()[0]
+        state["fp_changed"] = set()
+        if previous is not None and previous.get("fp_watermark") is not None:
+            cursor.execute(
+                f"SELECT DISTINCT orpconsecutivo FROM SIIAPP.dbo.FP_PROGRES "
+                f"WHERE {version_column} >= ? AND orpcompania = ?", (previous["fp_watermark"], params[0]))
+            state["fp_changed"] = {str(row[0]) for row in cursor.fetchall()}
+        cursor.execute(FP_COUNT_QUERY, op_params)
+        state["fp_counts"] = {str(op): count for op, count in cursor.fetchall()}
+    else:
+        cursor.execute(FP_SIGNATURE_QUERY, op_params)
+        state["fp"] = {str(op): (checksum, count)
+                       for op, checksum, count in cursor.fetchall()}
+    return state
+
+
+def diff_sync_state(previous, current):
+    # Returns (OPs whose rows must be refetched, OPs that left the active set). A sync state
+    # covers one company, so its OPs are bare consecutives
+    old_ops = previous["ops"]
+    new_ops = current["ops"]
+    removed = set(old_ops) - set(new_ops)
+    touched = {op for op, checksum in new_ops.items()
+               if old_ops.get(op) != checksum}
+
+    if "fp" in current:
+        old_fp = previous.get("fp", {})
+        new_fp = current["fp"]
+        fp_changed = {op for op in set(old_fp) | set(new_fp)
+                      if old_fp.get(op) != new_fp.get(op)}
+    else:
+        # Deleted records only show in the counts
+        old_counts = previous.get("fp_counts", {})
+        new_counts = current.get("fp_counts", {})
+        fp_changed = set(current["fp_changed"]) | {
+            op for op in set(old_counts) | set(new_counts) if old_counts.get(op) != new_counts.get(op)}
+    touched |= fp_changed & set(new_ops)
+    return touched, removed
+
+
+def forget_ops(sync_state, keys, company=None):
+    # Copy of sync_state in which the given (company, OP) keys look changed, so the next delta
+    # refetches them (e.g. rows shown before a save that then failed). None when the state
+    # cannot express it (service versions): the caller reloads everything.
+    if sync_state is None or "service" in sync_state:
+        return None
+    if "scopes" in sync_state:
+        return {**sync_state, "scopes": {key: forget_ops(state, keys, key.split(":", 1)[0])
+                                         for key, state in sync_state["scopes"].items()}}
+    checksums = dict(sync_state["ops"])
+    for key_company, op in keys:
+        if op in checksums and (company is None or key_company == company):
+            checksums[op] = None
+    return {**sync_state, "ops": checksums}
+
+
+def _run_cancellable(cancel_event, on_cursor, work, pool_name="DB2", operation="load"):
+    # Runs work(cursor) on a pooled connection: no Tk calls allowed here
+    started = time.perf_counter()
+    with get_pool(pool_name).connection() as conn:
+        # Pool wait, including a new connection when none is idle
+        metrics.record(operation, "acquire", time.perf_counter() - started)
+        cursor = conn.cursor()
+        try:
+            if on_cursor:
+                # Expose the cursor so the UI thread can cancel the running statement
+                on_cursor(cursor)
+            if cancel_event.is_set():
+                raise LoadCancelled()
+            return work(cursor)
+        except LoadCancelled:
+            raise
+        except Exception:
+            # A statement cancelled from the UI surfaces as a driver error
+            if cancel_event.is_set():
+                raise LoadCancelled()
+            raise
+        finally:
+            if on_cursor:
+                on_cursor(None)
+            cursor.close()
+
+
+def _estimate_payload(rows):
+    # Approximate transferred bytes from the text width of the first row of a batch
+    return sum(len(str(value)) for value in rows[0] if value is not None) * len(rows)
+
+
+def _timed_execute(cursor, operation, query, params=()):
+    with metrics.timer(operation, "execute"):
+        cursor.execute(query, params)
+
+
+def iter_formatted_batches(cursor, cancel_event, fetch_size,
+                           row_factory=format_production_row, operation="load"):
+    # Generator: one list of grid rows per fetchmany round trip, so only one driver batch is
+    # alive at a time and the caller can show rows while the rest is still being fetched.
+    # row_factory turns a driver row into a grid row (a list of strings by default)
+    fetch_time = format_time = 0.0
+    total = payload = batches = 0
+    while True:
+        if cancel_event.is_set():
+            raise LoadCancelled()
+        started = time.perf_counter()
+        rows = cursor.fetchmany(fetch_size)
+        fetched = time.perf_counter()
+        fetch_time += fetched - started
+        if not rows:
+            break
+        batches += 1
+        total += len(rows)
+        payload += _estimate_payload(rows)
+        batch = [row_factory(row) for row in rows]
+        format_time += time.perf_counter() - fetched
+        yield batch
+    metrics.record(operation, "fetch", fetch_time, rows=total,
+                   payload_bytes=payload, batches=batches)
+    metrics.record(operation, "format", format_time, rows=total)
+
+
+def _fetch_formatted(cursor, cancel_event, fetch_size, on_progress=None,
+                     row_factory=format_production_row, operation="load", on_batch=None):
+    formatted_data = []
+    for batch in iter_formatted_batches(cursor, cancel_event, fetch_size, row_factory, operation):
+        formatted_data.extend(batch)
+        if on_batch:
+            on_batch(batch)
+        if on_progress:
+            on_progress(len(formatted_data))
+    return formatted_data
+
+
+def fetch_production_data(cancel_event, on_cursor=None, on_progress=None,
+                          fetch_size=DEFAULT_FETCH_SIZE, version_column="",
+                          row_factory=format_production_row, on_batch=None, parents_only=False,
+                          params=PRODUCTION_PARAMS):
+    # on_batch(rows) is called from this thread with every formatted fetchmany batch
+    def work(cursor):
+        # Take the sync baseline first so changes made during the load show up in the next delta
+        with metrics.timer("full_load", "sync_state"):
+            sync_state = fetch_sync_state(cursor, version_column=version_column, params=params)
+        query = PARENT_QUERY if parents_only else PRODUCTION_QUERY
+        _timed_execute(cursor, "full_load", query, params)
+        rows = _fetch_formatted(cursor, cancel_event, fetch_size, on_progress, row_factory,
+                                operation="full_load", on_batch=on_batch)
+        return rows, sync_state
+
+    return _run_cancellable(cancel_event, on_cursor, work, operation="full_load")
+
+
+def fetch_production_delta(previous_state, cancel_event, on_cursor=None,
+                           fetch_size=DEFAULT_FETCH_SIZE, version_column="",
+                           row_factory=format_production_row, parents_only=False,
+                           params=PRODUCTION_PARAMS):
+    # In tree mode an OP touched by an FP_PROGRES change is refetched as a parent as well;
+    # the caller drops its cached children. touched and removed are (company, OP) keys
+    select = PARENT_SELECT if parents_only else PRODUCTION_SELECT
+    company = str(params[0])
+
+    def work(cursor):
+        with metrics.timer("delta", "sync_state"):
+            sync_state = fetch_sync_state(cursor, previous_state, version_column, params)
+        touched, removed = diff_sync_state(previous_state, sync_state)
+
+        changed_rows = []
+        ops = sorted(touched)
+        for i in range(0, len(ops), DELTA_CHUNK_SIZE):
+            chunk = ops[i:i + DELTA_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            _timed_execute(
+                cursor, "delta",
+                select
+                + f"        AND pd_ordenproceso.orpconsecutivo IN ({placeholders})\n"
+                + "        ORDER BY [# OP]\n",
+                tuple(params) + tuple(chunk))
+            changed_rows.extend(_fetch_formatted(
+                cursor, cancel_event, fetch_size, row_factory=row_factory, operation="delta"))
+        return ({(company, op) for op in touched}, {(company, op) for op in removed},
+                changed_rows, sync_state)
+
+    return _run_cancellable(cancel_event, on_cursor, work, operation="delta")
+
+
+# Cursors of the statements running in parallel for several scopes, exposed to the UI thread
+# as one cursor: cancel() aborts all of them
+class CursorGroup:
+    def __init__(self):
+        self._cursors = {}
+        self._lock = threading.Lock()
+
+    def tracker(self, key):
+        def track(cursor):
+            with self._lock:
+                if cursor is None:
+                    self._cursors.pop(key, None)
+                else:
+                    self._cursors[key] = cursor
+        return track
+
+    def cancel(self):
+        with self._lock:
+            cursors = list(self._cursors.values())
+        first_error = None
+        for cursor in cursors:
+            try:
+                cursor.cancel()
+            except Exception as e:
+                first_error = first_error or e
+        if first_error is not None:
+            raise first_error
+
+
+def _locked(row_factory):
+    # Row stores are not thread-safe: scopes loading in parallel append one row at a time
+    lock = threading.Lock()
+
+    def build(row):
+        with lock:
+            return row_factory(row)
+    return build
+
+
+def _run_scopes(scopes, work, on_cursor):
+    # work(scope, on_cursor) for every scope on a thread pool, each on its own pooled
+    # connection. Returns the result or the exception of every scope, in scope order
+    group = CursorGroup()
+    if on_cursor:
+        on_cursor(group)
+    try:
+        with ThreadPoolExecutor(max_workers=len(scopes), thread_name_prefix="scope") as executor:
+            futures = [executor.submit(work, scope, group.tracker(scope_key(scope))) for scope in scopes]
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(e)
+            return results
+    finally:
+        if on_cursor:
+            on_cursor(None)
+
+
+def _scope_errors(scopes, results):
+    # Logs the scopes that failed; raises when none of them could be loaded
+    errors = [(scope, result) for scope, result in zip(scopes, results) if isinstance(result, Exception)]
+    for scope, error in errors:
+        if not isinstance(error, LoadCancelled):
+            logging.error(f"An error occurred while loading scope {scope_key(scope)}: {str(error)}")
+    if len(errors) == len(scopes):
+        raise errors[0][1]
+    for _, error in errors:
+        if isinstance(error, LoadCancelled):
+            raise error
+
+
+def fetch_scoped_data(scopes, cancel_event, on_cursor=None, fetch_size=DEFAULT_FETCH_SIZE,
+                      version_column="", row_factory=format_production_row, on_batch=None,
+                      parents_only=False):
+    # Full load of several scopes in parallel. on_batch gets the batches of every scope as they
+    # arrive; the rows are returned merged in # OP order. The sync state holds one state per
+    # loaded scope ({"scopes": {scope key: state}}): a scope that failed is missing from it and
+    # is loaded by the next delta. A single scope keeps the plain state of fetch_production_data.
+    if len(scopes) == 1:
+        return fetch_production_data(
+            cancel_event, on_cursor=on_cursor, fetch_size=fetch_size, version_column=version_column,
+            row_factory=row_factory, on_batch=on_batch, parents_only=parents_only,
+            params=scope_params(scopes[0]))
+    build = _locked(row_factory)
+
+    def load(scope, track):
+        return fetch_production_data(
+            cancel_event, on_cursor=track, fetch_size=fetch_size, version_column=version_column,
+            row_factory=build, on_batch=on_batch, parents_only=parents_only,
+            params=scope_params(scope))
+
+    results = _run_scopes(scopes, load, on_cursor)
+    _scope_errors(scopes, results)
+    loaded = [(scope, result) for scope, result in zip(scopes, results)
+              if not isinstance(result, Exception)]
+    rows = list(heapq.merge(*(result[0] for _, result in loaded), key=lambda row: op_sort_key(row[0])))
+    return rows, {"scopes": {scope_key(scope): result[1] for scope, result in loaded}}
+
+
+def fetch_scoped_delta(scopes, previous_state, cancel_event, on_cursor=None,
+                       fetch_size=DEFAULT_FETCH_SIZE, version_column="",
+                       row_factory=format_production_row, parents_only=False):
+    # fetch_production_delta of every scope in parallel, each from its own sync state. A scope
+    # that fails keeps its previous state (and rows) until the next refresh; a scope without a
+    # state is loaded whole, its rows reported as touched.
+    if len(scopes) == 1:
+        return fetch_production_delta(
+            previous_state, cancel_event, on_cursor=on_cursor, fetch_size=fetch_size,
+            version_column=version_column, row_factory=row_factory, parents_only=parents_only,
+            params=scope_params(scopes[0]))
+    previous = previous_state.get("scopes", {})
+    build = _locked(row_factory)
+
+    def refresh(scope, track):
+        params = scope_params(scope)
+        state = previous.get(scope_key(scope))
+        if state is None:
+            rows, state = fetch_production_data(
+                cancel_event, on_cursor=track, fetch_size=fetch_size, version_column=version_column,
+                row_factory=build, parents_only=parents_only, params=params)
+            return {op_key(row) for row in rows}, set(), rows, state
+        return fetch_production_delta(
+            state, cancel_event, on_cursor=track, fetch_size=fetch_size,
+            version_column=version_column, row_factory=build, parents_only=parents_only,
+            params=params)
+
+    results = _run_scopes(scopes, refresh, on_cursor)
+    _scope_errors(scopes, results)
+    touched, removed, changed_rows = set(), set(), []
+    states = {}
+    for scope, result in zip(scopes, results):
+        key = scope_key(scope)
+        if isinstance(result, Exception):
+            if key in previous:
+                states[key] = previous[key]
+            continue
+        scope_touched, scope_removed, scope_rows, states[key] = result
+        touched |= scope_touched
+        removed |= scope_removed
+        changed_rows.extend(scope_rows)
+    # An OP that moved to another scope left one and was touched in the other
+    return touched, removed - touched, changed_rows, {"scopes": states}
+
+
+def missing_scopes(scopes, sync_state):
+    # Scopes not loaded by the last full load or refresh (their query failed)
+    if len(scopes) == 1 or sync_state is None or "scopes" not in sync_state:
+        return []
+    return [scope for scope in scopes if scope_key(scope) not in sync_state["scopes"]]
+
+
+# SQL expressions behind the searchable grid columns (see search_index.SEARCH_FIELDS)
+PAGE_FILTER_COLUMNS = {
+    0: "pd_ordenproceso.orpconsecutivo",
+    1: "pd_ordenproceso.orpconspedi",
+    2: "pd_ordenproceso.orpcodiitem",
+    8: "pd_ordenproceso.eobnombre",
+    9: "pd_ordenproceso.orpcompania",
+    12: "FP_PROGRES.FASE_PODUCC",
+    13: "FP_PROGRES.PLANTA",
+}
+FP_FILTER_COLUMNS = (12, 13)
+BARE_TERM_COLUMNS = (0, 1, 2)
+
+
+def _like_pattern(term):
+    # Escape the LIKE wildcards of SQL Server so the term is matched literally
+    for char in ("[", "%", "_"):
+        term = term.replace(char, f"[{char}]")
+    return f"%{term}%"
+
+
+def _page_conditions(terms):
+    erp_conditions, erp_params = [], []
+    fp_conditions, fp_params = [], []
+    for col, term in terms:
+        pattern = _like_pattern(term)
+        if col is None:
+            erp_conditions.append(
+                "(" + " OR ".join(f"{PAGE_FILTER_COLUMNS[c]} LIKE ?" for c in BARE_TERM_COLUMNS) + ")")
+            erp_params.extend([pattern] * len(BARE_TERM_COLUMNS))
+        elif col in FP_FILTER_COLUMNS:
+            fp_conditions.append(f"{PAGE_FILTER_COLUMNS[col]} LIKE ?")
+            fp_params.append(pattern)
+        else:
+            erp_conditions.append(f"{PAGE_FILTER_COLUMNS[col]} LIKE ?")
+            erp_params.append(pattern)
+    return erp_conditions, erp_params, fp_conditions, fp_params
+
+
+def build_page_query(terms, after_op, page_size, params=PRODUCTION_PARAMS):
+    # Keyset pagination on orpconsecutivo: pick the next page of OPs, then join their rows
+    erp_conditions, erp_params, fp_conditions, fp_params = _page_conditions(terms)
+    page_where = ""
+    page_params = [page_size, *params]
+    if after_op is not None:
+        page_where += "            AND pd_ordenproceso.orpconsecutivo > ?\n"
+        page_params.append(after_op)
+    for condition in erp_conditions:
+        page_where += f"            AND {condition}\n"
+    page_params.extend(erp_params)
+    if fp_conditions:
+        page_where += (
+            "            AND EXISTS (SELECT 1 FROM SIIAPP.dbo.FP_PROGRES\n"
+            "                WHERE pd_ordenproceso.orpconsecutivo = FP_PROGRES.orpconsecutivo"
+            + _GRID_COLLATE + "\n"
+            + "                AND pd_ordenproceso.orpcompania = FP_PROGRES.orpcompania" + _GRID_COLLATE + "\n"
+            + "".join(f"                AND {condition}\n" for condition in fp_conditions)
+            + "            )\n")
+        page_params.extend(fp_params)
+
+    query = (
+        "    WITH page_ops AS (\n"
+        "        SELECT TOP (?) pd_ordenproceso.orpconsecutivo"
+        + _GRID_FROM + _GRID_WHERE
+        + page_where
+        + "            ORDER BY pd_ordenproceso.orpconsecutivo\n"
+        "    )"
+        + PRODUCTION_SELECT
+        + "        AND pd_ordenproceso.orpconsecutivo IN (SELECT orpconsecutivo FROM page_ops)\n"
+        + "".join(f"        AND {condition}\n" for condition in fp_conditions)
+        + "        ORDER BY [# OP]\n"
+    )
+    return query, tuple(page_params + list(params) + fp_params)
+
+
+def fetch_production_page(cancel_event, terms=(), after_op=None, page_size=500,
+                          on_cursor=None, with_sync_state=False,
+                          fetch_size=DEFAULT_FETCH_SIZE, version_column="",
+                          row_factory=format_production_row, params=PRODUCTION_PARAMS):
+    # Returns (rows, last OP of the page, whether this was the last page, sync state or None)
+    def work(cursor):
+        sync_state = None
+        if with_sync_state:
+            with metrics.timer("page", "sync_state"):
+                sync_state = fetch_sync_state(cursor, version_column=version_column, params=params)
+        query, query_params = build_page_query(terms, after_op, page_size, params)
+        _timed_execute(cursor, "page", query, query_params)
+        rows = _fetch_formatted(
+            cursor, cancel_event, fetch_size, row_factory=row_factory, operation="page")
+        page_ops = {row[0] for row in rows}
+        last_op = rows[-1][0] if rows else after_op
+        return rows, last_op, len(page_ops) < page_size, sync_state
+
+    return _run_cancellable(cancel_event, on_cursor, work, operation="page")
+
+
+def apply_production_delta(data, touched, removed, changed_rows):
+    # Patches data in place; touched and removed are (company, OP) keys. Returns the row edits
+    # so a view can mirror them
+    stale = touched | removed
+    deleted = [i for i, row in enumerate(data) if op_key(row) in stale]
+    for i in reversed(deleted):
+        del data[i]
+
+    groups = {}
+    for row in changed_rows:
+        groups.setdefault(op_key(row), []).append(row)
+
+    keys = [op_sort_key(row[0]) for row in data]
+    inserted = []
+    for group in sorted(groups, key=lambda group: (op_sort_key(group[1]), group[0])):
+        key = op_sort_key(group[1])
+        idx = bisect.bisect_right(keys, key)
+        rows = groups[group]
+        data[idx:idx] = rows
+        keys[idx:idx] = [key] * len(rows)
+        inserted.append((idx, rows))
+    return deleted, inserted
+
+
+# Production phases in flow order (FP_TIMES has a <Fase>_ST/<Fase>_ET pair for each)
+PHASES = ["Dispensacion", "Pesaje", "Fabricacion", "Microbiologia", "Envasado",
+          "Acondicionamiento", "Embalaje", "Despacho", "Reproceso"]
+
+# Append-only phase log (see phase_events.py): one FP_PHASE_EVENTS row per phase start ("ST") or
+# end ("ET"), stamped with the server time and the user. With use_phase_events() saves append
+# to it instead of updating the FP_TIMES columns, and the phase times are read from the
+# FP_PHASE_TIMES view, which has the FP_TIMES layout. use_phase_events(dual=True) is the
+# migration mode: saves write both and the phase times are still read from FP_TIMES.
+PHASE_EVENTS = False
+PHASE_EVENT_WRITES = False
+FP_TIMES_WRITES = True
+_TIMES_TABLE = "FP_TIMES"
+# Rows per multi-row event INSERT: 4 parameters each
+PHASE_EVENT_CHUNK_SIZE = 500
+
+
+def use_phase_events(dual=False):
+    global PHASE_EVENTS, PHASE_EVENT_WRITES, FP_TIMES_WRITES, _TIMES_TABLE
+    PHASE_EVENT_WRITES = True
+    if not dual:
+        PHASE_EVENTS = True
+        FP_TIMES_WRITES = False
+        _TIMES_TABLE = "FP_PHASE_TIMES AS FP_TIMES"
+
+
+def _phase_write_time(cursor):
+    # (FP_TIMES value, EVENT_AT) of a save. While both are written they get the same server
+    # time in whole seconds, which datetime and datetime2 store alike, so the backfill can tell
+    # the FP_TIMES values already in the log. The log alone uses SYSDATETIME() (None).
+    if PHASE_EVENT_WRITES and FP_TIMES_WRITES:
+        cursor.execute("SELECT CONVERT(datetime2(0), SYSDATETIME())")
+        now = cursor.fetchone()[0]
+        return now, now
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S'), None
+
+
+def phase_transition_events(fp_id, prev_fase, fase):
+    # [(FP_ID, phase, event)] of a record created in (prev_fase None) or moved to `fase`.
+    # Despacho is the last phase: it ends as soon as it starts. Saves that keep the phase log nothing.
+    if fase not in PHASES:
+        raise ValueError(f"Invalid production phase: {fase!r}")
+    prev_fase = str(prev_fase).strip() if prev_fase else None
+    if prev_fase == fase:
+        return []
+    events = [(fp_id, prev_fase, "ET")] if prev_fase else []
+    events.append((fp_id, fase, "ST"))
+    if fase == "Despacho":
+        events.append((fp_id, fase, "ET"))
+    return events
+
+
+def append_phase_events(cursor, events, user=None, event_at=None):
+    # One server timestamp per statement (SYSDATETIME is evaluated once per query), so the end
+    # of the previous phase and the start of the next one match; event_at overrides it.
+    # user None: the SQL login.
+    for i in range(0, len(events), PHASE_EVENT_CHUNK_SIZE):
+        chunk = events[i:i + PHASE_EVENT_CHUNK_SIZE]
+        values = ", ".join(["(?, ?, ?, ?)"] * len(chunk))
+        params = [event_at]
+        for fp_id, fase, event in chunk:
+            params.extend((fp_id, fase, event, user))
+        cursor.execute(f"""
+            INSERT INTO FP_PHASE_EVENTS (FP_ID, FASE, EVENT, EVENT_AT, USER_NAME)
+            SELECT v.FP_ID, v.FASE, v.EVENT, COALESCE(CAST(? AS datetime2(3)), SYSDATETIME()),
+                COALESCE(v.USER_NAME, SUSER_SNAME())
+            FROM (VALUES {values}) AS v (FP_ID, FASE, EVENT, USER_NAME)
+        """, params)
+
+
+def _children_query(op_count, with_times=True):
+    times = "".join(f"\n            ,FP_TIMES.{fase}_ST, FP_TIMES.{fase}_ET" for fase in PHASES)
+    # Records of the requested consecutives in every company; fetch_fp_children keys them by
+    # (company, OP)
+    query = (
+        "        SELECT FP_PROGRES.orpconsecutivo, FP_PROGRES.orpcompania, FP_PROGRES.FP_ID,\n"
+        "            FP_PROGRES.CANTIDAD_FP, FP_PROGRES.FASE_PODUCC, FP_PROGRES.PLANTA,\n"
+        "            FP_PROGRES.COMENTARIES"
+        + (times + "\n        FROM FP_PROGRES\n"
+           f"        LEFT OUTER JOIN {_TIMES_TABLE} ON FP_TIMES.FP_ID = FP_PROGRES.FP_ID\n"
+           if with_times else "\n        FROM FP_PROGRES\n")
+    )
+    if op_count is not None:
+        query += f"        WHERE FP_PROGRES.orpconsecutivo IN ({', '.join('?' * op_count)})\n"
+    return query + "        ORDER BY FP_PROGRES.orpconsecutivo, FP_PROGRES.FP_ID\n"
+
+
+def fetch_fp_children(keys, cancel_event, on_cursor=None, with_times=True):
+    # Tree mode children from SIIAPP for (company, OP) keys. Returns ({(company, op): [(company,
+    # FP_ID, cantidad, fase, planta, comentarios)]}, {FP_ID: {fase: (start, end)}}), the records
+    # laid out like grid columns 9-14. Every requested key gets an entry, empty when the OP has
+    # no progress record; keys=None reads all.
+    def work(cursor):
+        children = {(str(company), str(op)): [] for company, op in keys or ()}
+        times = {}
+        ops = None if keys is None else sorted({str(op) for _, op in keys}, key=op_sort_key)
+        chunks = [None] if ops is None else [ops[i:i + DELTA_CHUNK_SIZE]
+                                            for i in range(0, len(ops), DELTA_CHUNK_SIZE)]
+        for chunk in chunks:
+            if cancel_event.is_set():
+                raise LoadCancelled()
+            query = _children_query(None if chunk is None else len(chunk), with_times)
+            _timed_execute(cursor, "children", query, tuple(chunk or ()))
+            with metrics.timer("children", "fetch") as m:
+                rows = cursor.fetchall()
+                m["rows"] = len(rows)
+            for row in rows:
+                key = (str(row[1]).strip(), str(row[0]).strip())
+                if keys is not None and key not in children:
+                    # Same consecutive in a company that was not asked for
+                    continue
+                children.setdefault(key, []).append(tuple(row[1:7]))
+                if with_times:
+                    times[row[2]] = {fase: (row[7 + 2 * i], row[8 + 2 * i])
+                                     for i, fase in enumerate(PHASES)
+                                     if row[7 + 2 * i] is not None or row[8 + 2 * i] is not None}
+        return children, times
+
+    return _run_cancellable(cancel_event, on_cursor, work, pool_name="DB1", operation="children")
+
+
+# Idempotency keys of journaled saves (see save_journal.py), written in the same transaction as
+# the save: a retry whose first attempt did commit finds its key and does nothing
+def _applied_save(cursor, save_key):
+    cursor.execute("SELECT FP_ID FROM FP_SAVE_KEYS WHERE SAVE_KEY = ?", (save_key,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _record_save(cursor, save_key, fp_id):
+    cursor.execute("INSERT INTO FP_SAVE_KEYS (SAVE_KEY, FP_ID, APPLIED_AT) VALUES (?, ?, ?)",
+                   (save_key, fp_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def _same_progress(current, values):
+    # current: (CANTIDAD_FP, FASE_PODUCC, PLANTA, COMENTARIES) as read; values: a journal dict
+    cantidad, fase, planta, comentarios = current
+    try:
+        same_cantidad = abs(float(cantidad) - float(values["cantidad"])) < 1e-6
+    except (TypeError, ValueError):
+        same_cantidad = str(cantidad or "").strip() == str(values["cantidad"] or "").strip()
+    return (same_cantidad
+            and str(fase or "").strip() == str(values["fase"] or "").strip()
+            and str(planta or "").strip() == str(values["planta"] or "").strip()
+            and str(comentarios or "").strip() == str(values["comentarios"] or "").strip())
+
+
+def create_fp_record(op_value, it_comp, cantidad_fp, fase_producc, planta, comentarios, save_key=None,
+                     user=None):
+    fase_producc = _phase_column(fase_producc)
+    with metrics.timer("create", "transaction", rows=1), get_pool("DB1").connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if save_key:
+                applied = _applied_save(cursor, save_key)
+                if applied is not None:
+                    # Already saved by an earlier attempt whose answer was lost
+                    return applied
+            insert_query = """
+                INSERT INTO FP_PROGRES (orpconsecutivo, orpcompania, CANTIDAD_FP, FASE_PODUCC, PLANTA, COMENTARIES)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """
+            params = (op_value, it_comp, cantidad_fp,
+                      fase_producc, planta, comentarios)
+            cursor.execute(insert_query, params)
+
+            # Get the last inserted FP_ID
+            cursor.execute("SELECT @@IDENTITY")
+            fp_id = cursor.fetchone()[0]
+
+            # Insert data into FP_TIMES table for the corresponding phase with current datetime
+            current_datetime, event_at = _phase_write_time(cursor)
+            if PHASE_EVENT_WRITES:
+                append_phase_events(cursor, phase_transition_events(fp_id, None, fase_producc), user,
+                                    event_at)
+            if FP_TIMES_WRITES:
+                if fase_producc == "Despacho":
+                    insert_times_query = f"""
+                        INSERT INTO FP_TIMES (FP_ID, {fase_producc}_ST, {fase_producc}_ET)
+                        VALUES (?, ?, ?)
+                    """
+                    cursor.execute(
+                        insert_times_query, (fp_id, current_datetime, current_datetime))
+                else:
+                    insert_times_query = f"""
+                        INSERT INTO FP_TIMES (FP_ID, {fase_producc}_ST)
+                        VALUES (?, ?)
+                    """
+                    cursor.execute(insert_times_query,
+                                   (fp_id, current_datetime))
+            if save_key:
+                _record_save(cursor, save_key, fp_id)
+            # FP_PROGRES and the phase times are committed together
+            conn.commit()
+            return fp_id
+        finally:
+            cursor.close()
+
+
+def update_fp_record(fp_id, cantidad_fp, fase_producc, planta, comentarios, save_key=None,
+                     expected=None, user=None):
+    # expected: values the user saw when editing (journaled saves); the update is refused with
+    # SaveConflict when the record has changed since, unless it already holds the new values
+    fase_producc = _phase_column(fase_producc)
+    with metrics.timer("edit", "transaction", rows=1), get_pool("DB1").connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if save_key and _applied_save(cursor, save_key) is not None:
+                return
+            if expected is None:
+                select_query = """
+                    SELECT FASE_PODUCC
+                    FROM FP_PROGRES
+                    WHERE FP_ID = ?
+                """
+                cursor.execute(select_query, (fp_id,))
+                existing_data = cursor.fetchone()
+                if existing_data:
+                    prev_fase = existing_data[0]
+                else:
+                    prev_fase = None
+            else:
+                # Locked until commit, so nobody changes it between the check and the update
+                cursor.execute("""
+                    SELECT FASE_PODUCC, CANTIDAD_FP, PLANTA, COMENTARIES
+                    FROM FP_PROGRES WITH (UPDLOCK, ROWLOCK)
+                    WHERE FP_ID = ?
+                """, (fp_id,))
+                existing_data = cursor.fetchone()
+                if not existing_data:
+                    raise SaveConflict(f"Record {fp_id} no longer exists")
+                prev_fase = existing_data[0]
+                current = (existing_data[1], existing_data[0], existing_data[2], existing_data[3])
+                new_values = {"cantidad": cantidad_fp, "fase": fase_producc, "planta": planta,
+                              "comentarios": comentarios}
+                if not _same_progress(current, expected) and not _same_progress(current, new_values):
+                    raise SaveConflict(
+                        f"Record {fp_id} was changed by someone else "
+                        f"(now {existing_data[0]}, plant {existing_data[2]}, quantity {existing_data[1]})")
+
+            # Read back from SIIAPP (char columns may be padded); it ends up in a column name below
+            prev_fase = _phase_column(prev_fase) if prev_fase else None
+            update_query = """
+                UPDATE FP_PROGRES
+                SET CANTIDAD_FP = ?, FASE_PODUCC = ?, PLANTA = ?, COMENTARIES = ?
+                WHERE FP_ID = ?
+            """
+            params = (cantidad_fp, fase_producc,
+                      planta, comentarios, fp_id)
+            cursor.execute(update_query, params)
+
+            # Update the corresponding phase start and end times in FP_TIMES table with current datetime
+            current_datetime, event_at = _phase_write_time(cursor)
+            if PHASE_EVENT_WRITES:
+                append_phase_events(cursor, phase_transition_events(fp_id, prev_fase, fase_producc), user,
+                                    event_at)
+            if FP_TIMES_WRITES:
+                set_clauses = [f"{fase_producc}_ST = CASE WHEN {fase_producc}_ST IS NULL THEN ? ELSE {fase_producc}_ST END"]
+                params = [current_datetime]
+                if fase_producc == "Despacho":
+                    set_clauses.append(f"{fase_producc}_ET = ?")
+                    params.append(current_datetime)
+                # A record without a phase has nothing to close; Despacho_ET is already set above
+                if prev_fase and not (prev_fase == fase_producc == "Despacho"):
+                    set_clauses.append(
+                        f"{prev_fase}_ET = CASE WHEN {prev_fase}_ST IS NOT NULL THEN ? ELSE {prev_fase}_ET END")
+                    params.append(current_datetime)
+                cursor.execute(f"UPDATE FP_TIMES SET {', '.join(set_clauses)} WHERE FP_ID = ?",
+                               (*params, fp_id))
+            if save_key:
+                _record_save(cursor, save_key, fp_id)
+            conn.commit()
+        finally:
+            cursor.close()
+
+
+# Rows per multi-row INSERT: 6 parameters each stays well under the 2100 parameter limit
+BULK_INSERT_CHUNK_SIZE = 200
+
+
+def _phase_column(fase):
+    # Phase names end up in column names (<Fase>_ST/<Fase>_ET): only the known phases are accepted
+    name = str(fase or "").strip()
+    if name not in PHASES:
+        raise ValueError(f"Invalid production phase: {fase!r}")
+    return name
+
+
+def enable_fast_executemany(cursor):
+    try:
+        cursor.fast_executemany = True
+    except AttributeError:
+        # Not a pyodbc cursor (e.g. a local stand-in driver)
+        pass
+
+
+def bulk_save_fp_records(creates, updates, fase_producc, planta, comentarios=None, user=None):
+    # creates: [(op_value, it_comp, cantidad_fp)], updates: [(fp_id, cantidad_fp or None)]
+    # Every FP_PROGRES and phase time write runs in a single transaction; returns
+    # {(it_comp, op_value): new FP_ID}, since the same consecutive can exist in several companies
+    fase_producc = fase = _phase_column(fase_producc)
+    created = {}
+    rows = len(creates) + len(updates)
+    with metrics.timer("bulk_save", "transaction", rows=rows), get_pool("DB1").connection() as conn:
+        cursor = conn.cursor()
+        enable_fast_executemany(cursor)
+        try:
+            current_datetime, event_at = _phase_write_time(cursor)
+            for i in range(0, len(creates), BULK_INSERT_CHUNK_SIZE):
+                chunk = creates[i:i + BULK_INSERT_CHUNK_SIZE]
+                values = ", ".join(["(?, ?, ?, ?, ?, ?)"] * len(chunk))
+                params = []
+                for op_value, it_comp, cantidad_fp in chunk:
+                    params.extend((op_value, it_comp, cantidad_fp,
+                                   fase_producc, planta, comentarios or ""))
+                # OUTPUT INSERTED returns every identity; rows are matched back by company and OP
+                cursor.execute(f"""
+                    INSERT INTO FP_PROGRES (orpconsecutivo, orpcompania, CANTIDAD_FP, FASE_PODUCC, PLANTA, COMENTARIES)
+                    OUTPUT INSERTED.FP_ID, INSERTED.orpconsecutivo, INSERTED.orpcompania
+                    VALUES {values}
+                """, params)
+                for fp_id, op_value, it_comp in cursor.fetchall():
+                    created[(str(it_comp), str(op_value))] = fp_id
+
+            events = []
+            if PHASE_EVENT_WRITES:
+                for fp_id in created.values():
+                    events.extend(phase_transition_events(fp_id, None, fase_producc))
+            if created and FP_TIMES_WRITES:
+                if fase_producc == "Despacho":
+                    cursor.executemany(
+                        f"INSERT INTO FP_TIMES (FP_ID, {fase}_ST, {fase}_ET) VALUES (?, ?, ?)",
+                        [(fp_id, current_datetime, current_datetime) for fp_id in created.values()])
+                else:
+                    cursor.executemany(
+                        f"INSERT INTO FP_TIMES (FP_ID, {fase}_ST) VALUES (?, ?)",
+                        [(fp_id, current_datetime) for fp_id in created.values()])
+
+            if updates:
+                # Previous phase of every record, to close its timing column
+                prev_fases = {}
+                fp_ids = [fp_id for fp_id, _ in updates]
+                for i in range(0, len(fp_ids), DELTA_CHUNK_SIZE):
+                    chunk = fp_ids[i:i + DELTA_CHUNK_SIZE]
+                    placeholders = ", ".join("?" * len(chunk))
+                    cursor.execute(
+                        f"SELECT FP_ID, FASE_PODUCC FROM FP_PROGRES WHERE FP_ID IN ({placeholders})", chunk)
+                    for fp_id, prev_fase in cursor.fetchall():
+                        # Stored phases may carry padding; compared with the new phase as names
+                        prev_fases[str(fp_id)] = str(prev_fase).strip() if prev_fase else None
+
+                cursor.executemany("""
+                    UPDATE FP_PROGRES
+                    SET CANTIDAD_FP = COALESCE(?, CANTIDAD_FP), FASE_PODUCC = ?, PLANTA = ?,
+                        COMENTARIES = COALESCE(?, COMENTARIES)
+                    WHERE FP_ID = ?
+                """, [(cantidad_fp, fase_producc, planta, comentarios, fp_id)
+                      for fp_id, cantidad_fp in updates])
+
+                by_prev_fase = {}
+                for fp_id, _ in updates:
+                    by_prev_fase.setdefault(prev_fases.get(str(fp_id)), []).append(fp_id)
+                for prev_fase, group in by_prev_fase.items():
+                    if PHASE_EVENT_WRITES:
+                        for fp_id in group:
+                            events.extend(phase_transition_events(fp_id, prev_fase, fase_producc))
+                    if not FP_TIMES_WRITES:
+                        continue
+                    set_clauses = [f"{fase}_ST = CASE WHEN {fase}_ST IS NULL THEN ? ELSE {fase}_ST END"]
+                    params = [current_datetime]
+                    if fase_producc == "Despacho":
+                        set_clauses.append(f"{fase}_ET = ?")
+                        params.append(current_datetime)
+                    # Close the previous phase only when the record actually moves
+                    if prev_fase and prev_fase != fase_producc:
+                        prev = _phase_column(prev_fase)
+                        set_clauses.append(
+                            f"{prev}_ET = CASE WHEN {prev}_ST IS NOT NULL THEN ? ELSE {prev}_ET END")
+                        params.append(current_datetime)
+                    cursor.executemany(
+                        f"UPDATE FP_TIMES SET {', '.join(set_clauses)} WHERE FP_ID = ?",
+                        [(*params, fp_id) for fp_id in group])
+
+            # Every event of the save in as few INSERTs as possible
+            append_phase_events(cursor, events, user, event_at)
+            conn.commit()
+            return created
+        finally:
+            cursor.close()
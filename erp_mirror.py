@@ -0,0 +1,231 @@
+import argparse
+import logging
+import os
+import threading
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+import db
+import metrics
+
+# Sync worker of the ERP mirror: copies the active OPs (db.PRODUCTION_PARAMS) and their item
+# description from ssf_genericos into SIIAPP.dbo.FP_OP_MIRROR, which has the FP_PROGRES
+# collation and its own indexes. With ERP_MIRROR=1 the app reads the grid from that table
+# (db.use_erp_mirror), so a load no longer scans the ERP through a COLLATE join.
+
+MIRROR_COLUMNS = ("orpconsecutivo", "orpconspedi", "orpcodiitem", "itedesclarg", "orpfecharequ",
+                  "orpfechaentrega", "orpfechestifin", "orpcantrequump", "eobnombre", "orpcompania",
+                  "itecompania", "eobcodigo", "ERP_CHECKSUM", "SYNCED_AT")
+INSERT_MIRROR_QUERY = (
+    f"INSERT INTO FP_OP_MIRROR ({', '.join(MIRROR_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(MIRROR_COLUMNS))})")
+
+
+def _read_mirror(company):
+    # ({OP: checksum} of the mirrored OPs, watermark, last full sync) from SIIAPP
+    with db.get_pool("DB1").connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT orpconsecutivo, ERP_CHECKSUM FROM FP_OP_MIRROR WHERE orpcompania = ?",
+                           (company,))
+            mirrored = {str(op).strip(): checksum for op, checksum in cursor.fetchall()}
+            cursor.execute("SELECT WATERMARK, FULL_SYNC_AT FROM FP_OP_MIRROR_STATE WHERE orpcompania = ?",
+                           (company,))
+            state = cursor.fetchone()
+            if state is None:
+                # First pass for this company
+                cursor.execute("INSERT INTO FP_OP_MIRROR_STATE (orpcompania) VALUES (?)", (company,))
+                conn.commit()
+                state = (None, None)
+        finally:
+            cursor.close()
+    return mirrored, state[0], state[1]
+
+
+def company_mirrors(scopes, version_column="", full_sync_seconds=3600):
+    # One mirror per company of the grid scopes (db.parse_scopes), over the states of all of
+    # its scopes: OPs moving between them stay in the mirror
+    states = {}
+    for company, scope_states in scopes:
+        states.setdefault(company, []).extend(scope_states)
+    mirrors = []
+    for company, company_states in states.items():
+        if len(company_states) > 3:
+            raise ValueError(f"The ERP mirror takes at most three states per company ({company})")
+        mirrors.append(ErpMirror(version_column, full_sync_seconds,
+                                 db.scope_params((company, tuple(company_states)))))
+    return mirrors
+
+
+# One mirror pass over the OPs of a company in the given states. Without a version column every pass compares the per-OP checksums of the
+# active ERP orders with the mirrored ones. With a last-modified column on pd_ordenproceso
+# (version_column) a pass only looks at the OPs modified after the stored watermark, and the
+# checksum comparison runs every full_sync_seconds to catch what the column does not track
+# (item descriptions, rows committed with an older timestamp).
+class ErpMirror:
+    def __init__(self, version_column="", full_sync_seconds=3600, params=db.PRODUCTION_PARAMS):
+        if version_column and not version_column.isidentifier():
+            raise ValueError("ERP_MIRROR_VERSION_COLUMN must be a plain column name.")
+        self.version_column = version_column
+        self.full_sync_seconds = full_sync_seconds
+        self.params = tuple(params)
+
+    def _full_sync_due(self, watermark, full_sync_at):
+        if not self.version_column or watermark is None or full_sync_at is None:
+            return True
+        return (datetime.now() - full_sync_at).total_seconds() >= self.full_sync_seconds
+
+    def sync(self):
+        # Returns {"mode", "checked", "upserted", "removed"}
+        company = self.params[0]
+        with metrics.timer("mirror", "sync") as m:
+            mirrored, watermark, full_sync_at = _read_mirror(company)
+            full = self._full_sync_due(watermark, full_sync_at)
+            with db.get_pool("DB2").connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    if self.version_column:
+                        # Taken before reading, so changes made meanwhile are seen next time
+                        cursor.execute(
+                            f"SELECT CONVERT(varchar(23), MAX({self.version_column}), 121) "
+                            f"FROM ssf_genericos.dbo.pd_ordenproceso WHERE orpcompania = ?", (company,))
+                        new_watermark = cursor.fetchone()[0]
+                    else:
+                        new_watermark = None
+                    if full:
+                        with metrics.timer("mirror", "signatures") as s:
+                            cursor.execute(db.MIRROR_SOURCE_SIGNATURE_QUERY, self.params)
+                            source = {str(op).strip(): checksum for op, checksum in cursor.fetchall()}
+                            s["rows"] = len(source)
+                        candidates = sorted(op for op, checksum in source.items()
+                                            if mirrored.get(op) != checksum)
+                        # OPs that left the active states (or the ERP)
+                        removed = set(mirrored) - set(source)
+                    else:
+                        cursor.execute(
+                            f"SELECT orpconsecutivo FROM ssf_genericos.dbo.pd_ordenproceso "
+                            f"WHERE orpcompania = ? AND {self.version_column} > CONVERT(datetime2, ?, 121)",
+                            (company, watermark))
+                        candidates = sorted({str(row[0]).strip() for row in cursor.fetchall()})
+                        removed = set()
+                    rows = self._fetch_source(cursor, candidates)
+                finally:
+                    cursor.close()
+
+            fetched = {str(row[0]).strip() for row in rows}
+            if not full:
+                # Modified OPs that are no longer active
+                removed = {op for op in candidates if op not in fetched and op in mirrored}
+            rows = [row for row in rows if mirrored.get(str(row[0]).strip()) != row[12]]
+            self._write(company, {str(row[0]).strip() for row in rows} | removed, rows,
+                        new_watermark, full, len((set(mirrored) | fetched) - removed))
+            stats = {"mode": "full" if full else "watermark", "checked": len(candidates),
+                     "upserted": len(rows), "removed": len(removed)}
+            m.update(stats)
+            return stats
+
+    def _fetch_source(self, cursor, ops):
+        # Mirror rows of the given OPs that are still active, in DELTA_CHUNK_SIZE chunks
+        rows = []
+        with metrics.timer("mirror", "fetch") as m:
+            for i in range(0, len(ops), db.DELTA_CHUNK_SIZE):
+                chunk = ops[i:i + db.DELTA_CHUNK_SIZE]
+                placeholders = ", ".join("?" * len(chunk))
+                cursor.execute(
+                    db.MIRROR_SOURCE_SELECT
+                    + f"        AND pd_ordenproceso.orpconsecutivo IN ({placeholders})\n",
+                    self.params + tuple(chunk))
+                rows.extend(cursor.fetchall())
+            m["rows"] = len(rows)
+        return rows
+
+    def _write(self, company, stale, rows, watermark, full, ops):
+        # Replaces the stale OPs and moves the watermark in one SIIAPP transaction
+        synced_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        stale = sorted(stale)
+        with metrics.timer("mirror", "write", rows=len(rows)), db.get_pool("DB1").connection() as conn:
+            cursor = conn.cursor()
+            db.enable_fast_executemany(cursor)
+            try:
+                for i in range(0, len(stale), db.DELTA_CHUNK_SIZE):
+                    chunk = stale[i:i + db.DELTA_CHUNK_SIZE]
+                    placeholders = ", ".join("?" * len(chunk))
+                    cursor.execute(
+                        f"DELETE FROM FP_OP_MIRROR WHERE orpcompania = ? AND orpconsecutivo IN ({placeholders})",
+                        [company, *chunk])
+                if rows:
+                    cursor.executemany(INSERT_MIRROR_QUERY,
+                                       [(*tuple(row), synced_at) for row in rows])
+                cursor.execute(
+                    "UPDATE FP_OP_MIRROR_STATE SET WATERMARK = COALESCE(?, WATERMARK), SYNCED_AT = ?, "
+                    "FULL_SYNC_AT = CASE WHEN ? = 1 THEN ? ELSE FULL_SYNC_AT END, OPS = ? "
+                    "WHERE orpcompania = ?",
+                    (watermark, synced_at, 1 if full else 0, synced_at, ops, company))
+                conn.commit()
+            finally:
+                cursor.close()
+
+
+def _sync_all(mirrors):
+    # Companies are synced one after the other; a failing one does not stop the others
+    for mirror in mirrors:
+        try:
+            stats = mirror.sync()
+            logging.info(f"ERP mirror of company {mirror.params[0]} synced: {stats}")
+        except Exception as e:
+            logging.error(f"An error occurred while syncing the ERP mirror of company {mirror.params[0]}: {str(e)}")
+
+
+def _sync_loop(mirrors, interval, stop_event):
+    while True:
+        _sync_all(mirrors)
+        if stop_event.wait(interval):
+            return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SIIAPP_FP ERP mirror sync worker")
+    parser.add_argument("--interval", type=float,
+                        default=float(os.getenv("ERP_MIRROR_INTERVAL_SECONDS", "60")),
+                        help="seconds between two passes")
+    parser.add_argument("--once", action="store_true", help="run a single pass and exit")
+    parser.add_argument("--fake-rows", metavar="N",
+                        help="sync a synthetic dataset (benchmark driver) instead of SQL Server")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    metrics.configure(os.getenv("ERP_MIRROR_METRICS_FILE", "mirror_metrics.jsonl"))
+    db.configure_pools(
+        connect_timeout=int(os.getenv('DB_CONNECT_TIMEOUT', '15')),
+        query_timeout=int(os.getenv('DB_QUERY_TIMEOUT', '60')),
+        max_size=2,
+        timeout=int(os.getenv('DB_POOL_TIMEOUT', '30')),
+        max_idle=int(os.getenv('DB_POOL_MAX_IDLE', '300')),
+    )
+    if args.fake_rows:
+        from benchmark.datagen import Dataset, parse_scale
+        from benchmark.fake_driver import FakeDatabase
+        database = FakeDatabase(Dataset(parse_scale(args.fake_rows)))
+        for name in db.POOL_DATABASES:
+            db.set_pool(name, db.ConnectionPool(database.connect, name=name))
+
+    mirrors = company_mirrors(db.parse_scopes(os.getenv('GRID_SCOPES', '')),
+                              os.getenv('ERP_MIRROR_VERSION_COLUMN', ''),
+                              float(os.getenv('ERP_MIRROR_FULL_SYNC_MINUTES', '60')) * 60)
+    stop_event = threading.Event()
+    try:
+        if args.once:
+            _sync_all(mirrors)
+        else:
+            _sync_loop(mirrors, args.interval, stop_event)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        db.close_pools()
+
+
+if __name__ == "__main__":
+    main()
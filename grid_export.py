@@ -0,0 +1,199 @@
+import csv
+import os
+import re
+import tempfile
+import zipfile
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+import metrics
+from row_store import COLUMN_COUNT, DATE_COLUMNS, FLOAT_COLUMNS, INT_COLUMNS
+
+# Export of the grid rows (RowView) to CSV or XLSX with typed values: dates as dates and
+# quantities as numbers. Rows are written in chunks and the file is only swapped in when
+# complete, so memory stays bounded and a cancelled export leaves nothing behind.
+# XLSX is written directly as SpreadsheetML: the app build needs no spreadsheet library.
+
+EXPORT_CHUNK_ROWS = 2000
+EXPORT_FORMATS = (".xlsx", ".csv")
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def export_rows(path, headers, rows, cancel_event=None, on_progress=None,
+                chunk_size=EXPORT_CHUNK_ROWS, column_widths=None):
+    # Format chosen from the extension; on_progress(written, total) is called after every chunk
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {extension}")
+    with metrics.timer("export", "write", rows=len(rows), format=extension[1:]) as m:
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".export-", suffix=extension, dir=directory)
+        os.close(fd)
+        try:
+            if extension == ".csv":
+                _write_csv(tmp_path, headers, rows, cancel_event, on_progress, chunk_size)
+            else:
+                _write_xlsx(tmp_path, headers, rows, cancel_event, on_progress, chunk_size,
+                            column_widths)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        m["payload_bytes"] = os.path.getsize(path)
+
+
+def _chunks(rows, cancel_event, on_progress, chunk_size):
+    total = len(rows)
+    for start in range(0, total, chunk_size):
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExportCancelled()
+        chunk = rows[start:start + chunk_size]
+        yield chunk
+        if on_progress:
+            on_progress(start + len(chunk), total)
+
+
+def _csv_value(row, col):
+    value = row.value(col)
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        # Dates without a time part are written as plain dates
+        return value.strftime("%Y-%m-%d %H:%M:%S" if value.time() != datetime.min.time() else "%Y-%m-%d")
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, float):
+        return repr(int(value)) if value.is_integer() else repr(value)
+    return value
+
+
+def _write_csv(path, headers, rows, cancel_event, on_progress, chunk_size):
+    # UTF-8 with BOM so Excel reads the accents; numbers use "." as decimal separator
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        for chunk in _chunks(rows, cancel_event, on_progress, chunk_size):
+            writer.writerows([_csv_value(row, col) for col in range(COLUMN_COUNT)] for row in chunk)
+
+
+# Characters XML 1.0 does not allow, e.g. control codes pasted into the comments
+_INVALID_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+# Excel stores dates as days since 1899-12-30
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+# Cell styles (index into cellXfs of _STYLES)
+_STYLE_HEADER, _STYLE_DATE, _STYLE_DATETIME = 1, 2, 3
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>"""
+
+_ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Produccion" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+
+_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+_STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd hh:mm"/></numFmts>
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="4">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>
+<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+</cellXfs>
+</styleSheet>"""
+
+
+def _column_name(col):
+    name = ""
+    col += 1
+    while col:
+        col, rest = divmod(col - 1, 26)
+        name = chr(65 + rest) + name
+    return name
+
+
+_COLUMN_NAMES = [_column_name(col) for col in range(COLUMN_COUNT)]
+
+
+def _text_cell(ref, text, style=0):
+    style_attr = f' s="{style}"' if style else ""
+    text = escape(_INVALID_XML.sub("", text))
+    return f'<c r="{ref}" t="inlineStr"{style_attr}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _xlsx_cell(ref, row, col):
+    value = row.value(col)
+    if value is None:
+        return ""
+    if col in DATE_COLUMNS and isinstance(value, date):
+        if isinstance(value, datetime):
+            days = (value - _EXCEL_EPOCH).total_seconds() / 86400
+            style = _STYLE_DATE if value.time() == datetime.min.time() else _STYLE_DATETIME
+        else:
+            days = (value - _EXCEL_EPOCH.date()).days
+            style = _STYLE_DATE
+        return f'<c r="{ref}" s="{style}"><v>{days!r}</v></c>'
+    if col in FLOAT_COLUMNS + INT_COLUMNS and isinstance(value, (int, float)):
+        return f'<c r="{ref}"><v>{value!r}</v></c>'
+    return _text_cell(ref, str(value))
+
+
+def _write_xlsx(path, headers, rows, cancel_event, on_progress, chunk_size, column_widths):
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=5) as archive:
+        archive.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        archive.writestr("_rels/.rels", _ROOT_RELS)
+        archive.writestr("xl/workbook.xml", _WORKBOOK)
+        archive.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+        archive.writestr("xl/styles.xml", _STYLES)
+        # The sheet is compressed as it is written, one chunk of rows at a time
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                b'<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" '
+                b'activePane="bottomLeft" state="frozen"/></sheetView></sheetViews>')
+            if column_widths:
+                # Grid widths are pixels; Excel widths are roughly characters
+                cols = "".join(f'<col min="{col + 1}" max="{col + 1}" width="{max(8, width // 7)}" customWidth="1"/>'
+                               for col, width in enumerate(column_widths))
+                sheet.write(f"<cols>{cols}</cols>".encode("utf-8"))
+            header = "".join(_text_cell(f"{name}1", text, _STYLE_HEADER)
+                             for name, text in zip(_COLUMN_NAMES, headers))
+            sheet.write(f'<sheetData><row r="1">{header}</row>'.encode("utf-8"))
+            number = 1
+            for chunk in _chunks(rows, cancel_event, on_progress, chunk_size):
+                parts = []
+                for row in chunk:
+                    number += 1
+                    cells = "".join(_xlsx_cell(f"{name}{number}", row, col)
+                                    for col, name in enumerate(_COLUMN_NAMES))
+                    parts.append(f'<row r="{number}">{cells}</row>')
+                sheet.write("".join(parts).encode("utf-8"))
+            sheet.write(b"</sheetData></worksheet>")
@@ -0,0 +1,233 @@
+import math
+
+# View model of the production sheet: the row list the sheet shows (tksheet keeps it by
+# reference) and the edits that turn it into a new one. Rows are matched across loads, filters
+# and sorts by (# OP, company, FP_ID), so a refresh only inserts and deletes the rows that came and went,
+# swaps the others in place and redraws once. Selection and scroll position follow the rows.
+
+# Larger edits replace the sheet rows at once: each insert or delete is a pass over the sheet's
+# row positions, so many scattered edits cost more than one replace
+MAX_ROW_EDITS = 2000
+MAX_INSERT_BLOCKS = 50
+
+
+def row_key(row):
+    # # OP, company and FP_ID ("" for OPs without records and for tree mode parents)
+    return row.key()
+
+
+def row_keys(rows):
+    # Unique keys: several unsaved records of an OP share the FP_ID "pendiente"
+    seen = {}
+    keys = []
+    for row in rows:
+        key = row.key()
+        count = seen.get(key, 0)
+        seen[key] = count + 1
+        keys.append(key + (count,) if count else key)
+    return keys
+
+
+def diff_rows(old_keys, new_keys, positions):
+    # (deleted old indexes, inserted new indexes), or None when rows present in both lists
+    # changed order (a new sort); positions is {key: index} of new_keys
+    deleted = []
+    last = -1
+    for i, key in enumerate(old_keys):
+        j = positions.get(key)
+        if j is None:
+            deleted.append(i)
+        elif j < last:
+            return None
+        else:
+            last = j
+    if len(deleted) == len(old_keys):
+        inserted = list(range(len(new_keys)))
+    else:
+        old = set(old_keys)
+        inserted = [j for j, key in enumerate(new_keys) if key not in old]
+    return deleted, inserted
+
+
+def insert_blocks(rows, inserted):
+    # [(index, [rows])] of consecutive inserted indexes, in ascending order
+    blocks = []
+    for j in inserted:
+        if blocks and blocks[-1][0] + len(blocks[-1][1]) == j:
+            blocks[-1][1].append(rows[j])
+        else:
+            blocks.append((j, [rows[j]]))
+    return blocks
+
+
+def changed_cells(old, new):
+    return sum(1 for a, b in zip(old, new) if a != b)
+
+
+class GridView:
+    def __init__(self, sheet, group_index_width):
+        self.sheet = sheet
+        self.group_index_width = group_index_width
+        # The list the sheet shows (tksheet keeps it by reference and edits it in place)
+        self.rows = []
+        # Whether the row index currently shows group names
+        self.index_shown = False
+        # row_keys(self.rows), kept from the last show() until the rows are edited
+        self._keys = None
+
+    def show(self, rows, index_labels=None):
+        # Show rows (a new list) with the fewest sheet edits. index_labels: {id(row): group name}.
+        # Returns the edit counts for the metrics.
+        new_keys = row_keys(rows)
+        positions = {key: i for i, key in enumerate(new_keys)}
+        diff = None
+        reordered = False
+        if self.rows:
+            old_keys = self._keys if self._keys is not None else row_keys(self.rows)
+            diff = diff_rows(old_keys, new_keys, positions)
+            reordered = diff is None
+        if diff is not None:
+            deleted, inserted = diff
+            blocks = insert_blocks(rows, inserted)
+            if len(deleted) + len(inserted) > MAX_ROW_EDITS or len(blocks) > MAX_INSERT_BLOCKS:
+                diff = None
+        state = self._capture()
+        stats = {"inserted": 0, "deleted": 0, "changed_rows": 0, "changed_cells": 0}
+        if diff is None:
+            stats["replaced"] = 1
+            self.rows = rows
+            self._keys = new_keys
+            self.sheet.set_sheet_data(rows, reset_col_positions=False, redraw=False)
+            self._set_index(index_labels)
+            # A new sort starts at the top; otherwise the view stays on the same rows
+            self._restore(state, positions, scroll=not reordered)
+            self.sheet.redraw()
+            return stats
+
+        if deleted:
+            self.sheet.del_rows(deleted, redraw=False)
+        for idx, block in blocks:
+            self.sheet.insert_rows(block, idx=idx, redraw=False)
+        # Every row is now in place, but the kept ones may be other objects with the same key
+        # (a new load): only the visible ones are compared, the rest are drawn when scrolled to
+        current = self.rows
+        start, end = self._visible_range()
+        for i in range(start, end):
+            if current[i] is not rows[i]:
+                cells = changed_cells(current[i], rows[i])
+                if cells:
+                    stats["changed_rows"] += 1
+                    stats["changed_cells"] += cells
+        current[:] = rows
+        self._keys = new_keys
+        stats["inserted"] = len(inserted)
+        stats["deleted"] = len(deleted)
+        index_changed = self._set_index(index_labels)
+        if deleted or inserted:
+            # del_rows/insert_rows reset the selection
+            self._restore(state, positions)
+        if deleted or inserted or stats["changed_rows"] or index_changed:
+            self.sheet.redraw()
+        return stats
+
+    def apply(self, deleted=(), inserted=()):
+        # Mirror edits made to the data behind the view (deltas, expanded records, new pages):
+        # deleted indexes, then (index, rows) blocks in ascending order
+        state = self._capture()
+        if deleted:
+            self.sheet.del_rows(deleted, redraw=False)
+        for idx, rows in inserted:
+            self.sheet.insert_rows(rows, idx=idx, redraw=False)
+        self._keys = None
+        self._restore(state, None)
+        self.sheet.redraw()
+
+    def append(self, rows):
+        if rows:
+            self.apply(inserted=[(len(self.rows), rows)])
+
+    def _visible_range(self):
+        # Rows are all the same height, so the scroll fractions give the visible indexes
+        count = len(self.rows)
+        if not count:
+            return 0, 0
+        top, bottom = self.sheet.get_yview()
+        return min(int(top * count), count - 1), min(count, math.ceil(bottom * count) + 1)
+
+    def _capture(self):
+        # (row, index) of the selected rows, the current cell and the first visible row
+        rows = self.rows
+        if not rows:
+            return None
+        selected = [(rows[r], r) for r in sorted(self.sheet.get_selected_rows()) if r < len(rows)]
+        cell = None
+        current = self.sheet.get_currently_selected()
+        if current and not selected and current.row < len(rows):
+            cell = ((rows[current.row], current.row), current.column)
+        top = self._visible_range()[0]
+        return selected, cell, (rows[top], top)
+
+    def _restore(self, state, positions, scroll=True):
+        # positions: {key: index} of the rows, when the caller already has it
+        rows = self.rows
+        if state is None or not rows:
+            return
+        lookups = {"key": positions}
+
+        def locate(captured):
+            # Same index, same object elsewhere, or a reloaded row with the same key; None if gone
+            row, index = captured
+            if index < len(rows) and rows[index] is row:
+                return index
+            if "id" not in lookups:
+                lookups["id"] = {id(r): i for i, r in enumerate(rows)}
+            found = lookups["id"].get(id(row))
+            if found is not None:
+                return found
+            if lookups["key"] is None:
+                lookups["key"] = {key: i for i, key in enumerate(row_keys(rows))}
+            return lookups["key"].get(row_key(row))
+
+        selected, cell, top = state
+        sheet = self.sheet
+        sheet.deselect("all", redraw=False)
+        # One selection box per run of consecutive rows (select all is a single box)
+        located = sorted({r for r in map(locate, selected) if r is not None})
+        columns = sheet.get_total_columns()
+        start = None
+        for i, r in enumerate(located):
+            if start is None:
+                start = r
+            if i + 1 == len(located) or located[i + 1] != r + 1:
+                sheet.create_selection_box(start, 0, r + 1, columns, "rows")
+                start = None
+        if cell is not None:
+            r = locate(cell[0])
+            if r is not None and cell[1] is not None:
+                sheet.select_cell(r, cell[1], redraw=False, run_binding_func=False)
+        if not scroll:
+            sheet.set_yview(0)
+            return
+        r = locate(top)
+        if r is None:
+            # The first visible row is gone: stay at the same height
+            r = min(top[1], len(rows) - 1)
+        if r != self._visible_range()[0]:
+            sheet.set_yview(r / len(rows))
+
+    def _set_index(self, labels):
+        # Group names in the row index, or back to row numbers; returns whether it changed
+        sheet = self.sheet
+        if labels is not None:
+            sheet.set_options(show_default_index_for_empty=False, redraw=False)
+            sheet.set_index_width(self.group_index_width, redraw=False)
+            sheet.row_index([labels.get(id(row), "") for row in self.rows], redraw=False)
+            self.index_shown = True
+            return True
+        if self.index_shown:
+            sheet.set_options(show_default_index_for_empty=True, redraw=False)
+            sheet.set_index_width(sheet.ops.default_row_index_width, redraw=False)
+            sheet.row_index([], redraw=False)
+            self.index_shown = False
+            return True
+        return False
@@ -0,0 +1,121 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+# Performance telemetry: every measurement is kept in a small in-memory window (for the
+# diagnostics panel) and written as one JSON line to a rotating metrics file.
+WINDOW_SIZE = 500
+
+_lock = threading.Lock()
+_windows = {}
+_totals = {}
+_logger = logging.getLogger("metrics")
+_logger.propagate = False
+
+
+def configure(path, max_bytes=1_000_000, backups=3):
+    # An empty path keeps the measurements in memory only
+    for handler in list(_logger.handlers):
+        _logger.removeHandler(handler)
+        handler.close()
+    if not path:
+        return
+    try:
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    except OSError as e:
+        logging.error(f"An error occurred while opening the metrics file {path}: {str(e)}")
+        return
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    _logger.addHandler(handler)
+    _logger.setLevel(logging.INFO)
+
+
+def record(operation, stage, seconds, write=True, **fields):
+    # fields: rows, payload_bytes or any other JSON friendly value
+    key = (operation, stage)
+    with _lock:
+        window = _windows.get(key)
+        if window is None:
+            window = _windows[key] = deque(maxlen=WINDOW_SIZE)
+            _totals[key] = {"count": 0, "rows": 0}
+        window.append(seconds)
+        totals = _totals[key]
+        totals["count"] += 1
+        totals["rows"] += fields.get("rows") or 0
+    if write and _logger.handlers:
+        entry = {"ts": round(time.time(), 3), "op": operation, "stage": stage,
+                 "ms": round(seconds * 1000, 3)}
+        entry.update(fields)
+        _logger.info(json.dumps(entry, default=str))
+
+
+@contextmanager
+def timer(operation, stage, **fields):
+    # with metrics.timer("full_load", "fetch") as m: ...; m["rows"] = n
+    started = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        record(operation, stage, time.perf_counter() - started, **fields)
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round((len(ordered) - 1) * pct / 100)))]
+
+
+def summary():
+    # {(operation, stage): {"count", "rows", "last_ms", "p50_ms", "p95_ms", "max_ms"}} over the window
+    with _lock:
+        items = [(key, list(window), dict(_totals[key])) for key, window in _windows.items()]
+    result = {}
+    for key, values, totals in items:
+        ordered = sorted(values)
+        result[key] = {
+            "count": totals["count"],
+            "rows": totals["rows"],
+            "last_ms": values[-1] * 1000,
+            "p50_ms": _percentile(ordered, 50) * 1000,
+            "p95_ms": _percentile(ordered, 95) * 1000,
+            "max_ms": ordered[-1] * 1000,
+        }
+    return result
+
+
+def reset():
+    with _lock:
+        _windows.clear()
+        _totals.clear()
+
+
+# Samples the Tk event loop: a callback is scheduled every `interval_ms`, and the extra delay
+# before it runs is the time the main thread was busy. Every sample feeds the in-memory window;
+# only stalls above `threshold_ms` are written to the metrics file.
+class LagMonitor:
+    def __init__(self, widget, interval_ms=100, threshold_ms=200):
+        self.widget = widget
+        self.interval_ms = interval_ms
+        self.threshold_ms = threshold_ms
+        self._expected = None
+        self._job = None
+
+    def start(self):
+        self._expected = time.perf_counter() + self.interval_ms / 1000
+        self._job = self.widget.after(self.interval_ms, self._sample)
+
+    def stop(self):
+        if self._job is not None:
+            self.widget.after_cancel(self._job)
+            self._job = None
+
+    def _sample(self):
+        now = time.perf_counter()
+        lag = max(0.0, now - self._expected)
+        record("ui", "event_loop_lag", lag, write=lag * 1000 >= self.threshold_ms)
+        self._expected = now + self.interval_ms / 1000
+        self._job = self.widget.after(self.interval_ms, self._sample)
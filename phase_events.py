@@ -0,0 +1,125 @@
+import argparse
+import logging
+import os
+
+from dotenv import load_dotenv
+
+import db
+import metrics
+
+# Migration of the phase times from the wide FP_TIMES rows to the append-only FP_PHASE_EVENTS
+# log (db.use_phase_events): prints the FP_PHASE_TIMES compatibility view and copies the
+# existing FP_TIMES values into the log in FP_ID ranges. A value already in the log (same
+# record, phase, event and time, e.g. written by a client in dual mode) is not copied again, so
+# the backfill can run while FP_TIMES is still written and be repeated before the switch.
+
+# USER_NAME of the backfilled events
+BACKFILL_USER = "FP_TIMES"
+BACKFILL_BATCH_SIZE = 5000
+
+
+def compatibility_view():
+    # FP_TIMES layout over the log: a phase starts at its first start event and ends at its
+    # last end event, which only counts once the phase has started (like the FP_TIMES updates)
+    columns = []
+    for fase in db.PHASES:
+        started = f"MIN(CASE WHEN FASE = '{fase}' AND EVENT = 'ST' THEN EVENT_AT END)"
+        columns.append(f"    {started} AS {fase}_ST")
+        columns.append(
+            f"    CASE WHEN {started} IS NOT NULL\n"
+            f"        THEN MAX(CASE WHEN FASE = '{fase}' AND EVENT = 'ET' THEN EVENT_AT END) END AS {fase}_ET")
+    return ("CREATE OR ALTER VIEW FP_PHASE_TIMES AS\n"
+            "SELECT FP_ID,\n" + ",\n".join(columns) + "\n"
+            "FROM FP_PHASE_EVENTS\n"
+            "GROUP BY FP_ID\n")
+
+
+def _backfill_query():
+    # Unpivots the FP_TIMES columns of one FP_ID range into events
+    values = ", ".join(f"('{fase}', '{event}', t.{fase}_{event})"
+                       for fase in db.PHASES for event in ("ST", "ET"))
+    return f"""
+        INSERT INTO FP_PHASE_EVENTS (FP_ID, FASE, EVENT, EVENT_AT, USER_NAME)
+        SELECT t.FP_ID, e.FASE, e.EVENT, e.EVENT_AT, ?
+        FROM FP_TIMES t
+        CROSS APPLY (VALUES {values}) AS e (FASE, EVENT, EVENT_AT)
+        WHERE t.FP_ID > ? AND t.FP_ID <= ? AND e.EVENT_AT IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM FP_PHASE_EVENTS x
+                        WHERE x.FP_ID = t.FP_ID AND x.FASE = e.FASE AND x.EVENT = e.EVENT
+                        AND x.EVENT_AT = e.EVENT_AT)
+"""
+
+
+BACKFILL_QUERY = _backfill_query()
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE):
+    # One transaction per FP_ID range, so the log grows in small steps and an interrupted run
+    # can simply be started again. Returns the number of events written.
+    with db.get_pool("DB1").connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT MIN(FP_ID), MAX(FP_ID) FROM FP_TIMES")
+            low, high = cursor.fetchone()
+            if low is None:
+                return 0
+            written = 0
+            start = int(low) - 1
+            while start < int(high):
+                end = start + batch_size
+                with metrics.timer("phase_events", "backfill") as m:
+                    cursor.execute(BACKFILL_QUERY, (BACKFILL_USER, start, end))
+                    count = max(cursor.rowcount, 0)
+                    conn.commit()
+                    m["rows"] = count
+                written += count
+                logging.info(f"Backfilled FP_ID {start + 1}-{end}: {count} events")
+                start = end
+            return written
+        finally:
+            cursor.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SIIAPP_FP phase event log migration")
+    parser.add_argument("--print-view", action="store_true",
+                        help="print the FP_PHASE_TIMES view DDL and exit")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE,
+                        help="FP_IDs per backfill transaction")
+    parser.add_argument("--fake-rows", metavar="N",
+                        help="backfill a synthetic dataset (benchmark driver) instead of SQL Server")
+    args = parser.parse_args(argv)
+
+    if args.print_view:
+        print(compatibility_view())
+        return
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    metrics.configure(os.getenv("PHASE_EVENTS_METRICS_FILE", "phase_events_metrics.jsonl"))
+    db.configure_pools(
+        connect_timeout=int(os.getenv('DB_CONNECT_TIMEOUT', '15')),
+        query_timeout=int(os.getenv('DB_QUERY_TIMEOUT', '60')),
+        max_size=1,
+        timeout=int(os.getenv('DB_POOL_TIMEOUT', '30')),
+        max_idle=int(os.getenv('DB_POOL_MAX_IDLE', '300')),
+    )
+    if args.fake_rows:
+        from benchmark.datagen import Dataset, parse_scale
+        from benchmark.fake_driver import FakeDatabase
+        database = FakeDatabase(Dataset(parse_scale(args.fake_rows)))
+        for name in db.POOL_DATABASES:
+            db.set_pool(name, db.ConnectionPool(database.connect, name=name))
+
+    try:
+        written = backfill(args.batch_size)
+        logging.info(f"Phase event backfill finished: {written} events")
+    except Exception as e:
+        logging.error(f"An error occurred while backfilling the phase events: {str(e)}")
+        raise
+    finally:
+        db.close_pools()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import math
+from array import array
+from datetime import date, datetime, timedelta
+
+# Layout of the production grid (see MyFrame headers)
+COLUMN_COUNT = 15
+NUMBER_TEXT_COLUMNS = (0, 1)                  # # OP, # PEDIDO (numeric consecutives, shown as text)
+TEXT_COLUMNS = (14,)                          # COMENTARIOS/OBSERVACIONES
+CATEGORY_COLUMNS = (2, 3, 8, 9, 12, 13)       # CODIGO ITEM, DESCRIPCION ITEM, ESTADO OP, COMPANIA, FASE, PLANTA
+DATE_COLUMNS = (4, 5, 6)                  # FECHA REQUERIDA, FECHA ENTREGA PLANTA, FECHA ESTIMADO FIN
+FLOAT_COLUMNS = (7, 11)                   # CANTIDAD PEDIDA, CANTIDAD EN PRODUCCION
+INT_COLUMNS = (10,)                       # FP_ID
+FP_COLUMNS = tuple(range(10, 15))
+
+# Dates are whole minutes since DATE_EPOCH in 32 bits (up to year 10066)
+DATE_EPOCH = datetime(1900, 1, 1)
+MINUTE = timedelta(minutes=1)
+MISSING_MINUTES = 2 ** 32 - 1
+MISSING_INT = -(2 ** 63)
+MISSING_FLOAT = math.nan
+
+
+def format_quantity(value):
+    # 1000.0 -> "1000", 12.5 -> "12.5"
+    text = f"{value:.4f}".rstrip("0").rstrip(".")
+    return text if text != "-0" else "0"
+
+
+# A single grid row backed by a ProductionStore.
+# Behaves like a read-only sequence of display strings (what tksheet and the filters read),
+# while value() exposes the typed value.
+class RowView:
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __len__(self):
+        return COLUMN_COUNT
+
+    def __getitem__(self, col):
+        store = self.store
+        index = self.index
+        if isinstance(col, slice):
+            return [store.display(index, c) for c in range(COLUMN_COUNT)[col]]
+        if col < 0:
+            col += COLUMN_COUNT
+        if not 0 <= col < COLUMN_COUNT:
+            raise IndexError("row column out of range")
+        return store.display(index, col)
+
+    def __iter__(self):
+        store = self.store
+        index = self.index
+        for col in range(COLUMN_COUNT):
+            yield store.display(index, col)
+
+    def __repr__(self):
+        return f"RowView({list(self)!r})"
+
+    def value(self, col):
+        return self.store.value(self.index, col)
+
+    def sort_value(self, col):
+        return self.store.sort_value(self.index, col)
+
+    def export(self):
+        return self.store.export_row(self.index)
+
+    def key(self):
+        return self.store.row_key(self.index)
+
+
+# Columnar, typed storage for the production dataset.
+# Dates are kept as uint32 minutes since DATE_EPOCH, quantities as floats, FP_ID and the
+# numeric consecutives as int64 in `array`s; repeated strings are dictionary-encoded (one
+# shared str per distinct value, 16-bit codes until a column has more than 65535 values).
+# Rows are append-only: rows replaced by a delta are only released, the space is reclaimed
+# by the next full load (see needs_reload()).
+class ProductionStore:
+    def __init__(self):
+        self._numbers = {col: array("q") for col in NUMBER_TEXT_COLUMNS}
+        self._text = {col: [] for col in TEXT_COLUMNS}
+        self._codes = {col: array("H") for col in CATEGORY_COLUMNS}
+        self._dictionary = {col: [""] for col in CATEGORY_COLUMNS}
+        self._lookup = {col: {"": 0} for col in CATEGORY_COLUMNS}
+        self._dates = {col: array("I") for col in DATE_COLUMNS}
+        self._date_only = {col: False for col in DATE_COLUMNS}
+        # Dates that are not whole minutes or out of range: {(index, col): datetime}
+        self._exact_dates = {}
+        self._floats = {col: array("d") for col in FLOAT_COLUMNS}
+        self._ints = {col: array("q") for col in INT_COLUMNS}
+        # Values that do not fit the column type are kept as text: {(index, col): str}
+        self._overflow = {}
+        self._size = 0
+        self._released = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def released(self):
+        return self._released
+
+    def _encode(self, col, value):
+        text = "" if value is None else str(value)
+        code = self._lookup[col].get(text)
+        if code is None:
+            code = len(self._dictionary[col])
+            self._dictionary[col].append(text)
+            self._lookup[col][text] = code
+            if code > 0xFFFF and self._codes[col].typecode == "H":
+                self._codes[col] = array("I", self._codes[col])
+        return code
+
+    def append_raw(self, row):
+        # row: values as returned by the driver (datetime, Decimal, int, str, None)
+        values = list(row[:COLUMN_COUNT])
+        if not any(values[10:]):
+            values[10:] = [None] * 5
+        index = self._size
+        for col in NUMBER_TEXT_COLUMNS:
+            value = values[col]
+            text = "" if value is None else str(value)
+            # Only store as a number when it prints back exactly the same
+            if text.isdigit() and str(int(text)) == text and int(text) < 2 ** 63:
+                self._numbers[col].append(int(text))
+            else:
+                self._numbers[col].append(MISSING_INT)
+                if text:
+                    self._overflow[(index, col)] = text
+        for col in TEXT_COLUMNS:
+            value = values[col]
+            self._text[col].append("" if value is None else str(value))
+        for col in CATEGORY_COLUMNS:
+            self._codes[col].append(self._encode(col, values[col]))
+        for col in DATE_COLUMNS:
+            value = values[col]
+            if value is None:
+                self._dates[col].append(MISSING_MINUTES)
+                continue
+            if not isinstance(value, date):
+                self._dates[col].append(MISSING_MINUTES)
+                self._overflow[(index, col)] = str(value)
+                continue
+            if not isinstance(value, datetime):
+                self._date_only[col] = True
+                value = datetime(value.year, value.month, value.day)
+            minutes, rest = divmod(value - DATE_EPOCH, MINUTE)
+            if rest or not 0 <= minutes < MISSING_MINUTES:
+                self._dates[col].append(MISSING_MINUTES)
+                self._exact_dates[(index, col)] = value
+            else:
+                self._dates[col].append(minutes)
+        for col in FLOAT_COLUMNS:
+            value = values[col]
+            if value is None or value == "":
+                self._floats[col].append(MISSING_FLOAT)
+                continue
+            try:
+                self._floats[col].append(float(value))
+            except (TypeError, ValueError):
+                self._floats[col].append(MISSING_FLOAT)
+                self._overflow[(index, col)] = str(value)
+        for col in INT_COLUMNS:
+            value = values[col]
+            if value is None or value == "":
+                self._ints[col].append(MISSING_INT)
+                continue
+            try:
+                self._ints[col].append(int(value))
+            except (TypeError, ValueError):
+                self._ints[col].append(MISSING_INT)
+                self._overflow[(index, col)] = str(value)
+        self._size += 1
+        return RowView(self, index)
+
+    def value(self, index, col):
+        # Typed value: datetime/date, float, int, str or None
+        if col in NUMBER_TEXT_COLUMNS:
+            number = self._numbers[col][index]
+            if number == MISSING_INT:
+                return self._overflow.get((index, col)) or None
+            return str(number)
+        if col in TEXT_COLUMNS:
+            return self._text[col][index] or None
+        if col in CATEGORY_COLUMNS:
+            return self._dictionary[col][self._codes[col][index]] or None
+        overflow = self._overflow.get((index, col)) if self._overflow else None
+        if overflow is not None:
+            return overflow
+        if col in DATE_COLUMNS:
+            minutes = self._dates[col][index]
+            if minutes == MISSING_MINUTES:
+                value = self._exact_dates.get((index, col)) if self._exact_dates else None
+                if value is None:
+                    return None
+            else:
+                value = DATE_EPOCH + minutes * MINUTE
+            return value.date() if self._date_only[col] else value
+        if col in FLOAT_COLUMNS:
+            number = self._floats[col][index]
+            return None if math.isnan(number) else number
+        number = self._ints[col][index]
+        return None if number == MISSING_INT else number
+
+    def sort_value(self, index, col):
+        # Like value(), but dates stay numbers, seconds since DATE_EPOCH (cheaper to build and compare)
+        if col in DATE_COLUMNS and not (self._overflow and (index, col) in self._overflow):
+            minutes = self._dates[col][index]
+            if minutes != MISSING_MINUTES:
+                return minutes * 60
+            value = self._exact_dates.get((index, col)) if self._exact_dates else None
+            return None if value is None else (value - DATE_EPOCH).total_seconds()
+        return self.value(index, col)
+
+    def display(self, index, col):
+        # Display string, built on demand (only visible cells are ever formatted)
+        if col in NUMBER_TEXT_COLUMNS:
+            number = self._numbers[col][index]
+            return self._overflow.get((index, col), "") if number == MISSING_INT else str(number)
+        if col in TEXT_COLUMNS:
+            return self._text[col][index]
+        if col in CATEGORY_COLUMNS:
+            return self._dictionary[col][self._codes[col][index]]
+        value = self.value(index, col)
+        if value is None:
+            return ""
+        if col in FLOAT_COLUMNS and isinstance(value, float):
+            return format_quantity(value)
+        return str(value)
+
+    def row_key(self, index):
+        # (# OP, company, FP_ID) straight from the arrays; the same row loaded again gets the
+        # same key. Consecutives repeat across companies
+        op = self._numbers[0][index]
+        if op == MISSING_INT:
+            op = self._overflow.get((index, 0), "")
+        fp_id = self._ints[10][index]
+        if fp_id == MISSING_INT:
+            fp_id = self._overflow.get((index, 10), "")
+        return (op, self._dictionary[9][self._codes[9][index]], fp_id)
+
+    def column(self, col):
+        # Raw typed column (array or list) for sorting/aggregation; indexes match RowView indexes
+        if col in NUMBER_TEXT_COLUMNS:
+            return self._numbers[col]
+        if col in TEXT_COLUMNS:
+            return self._text[col]
+        if col in CATEGORY_COLUMNS:
+            return self._codes[col]
+        if col in DATE_COLUMNS:
+            return self._dates[col]
+        if col in FLOAT_COLUMNS:
+            return self._floats[col]
+        return self._ints[col]
+
+    def categories(self, col):
+        return self._dictionary[col]
+
+    def export_row(self, index):
+        # JSON friendly values; the inverse of append_exported()
+        values = []
+        for col in range(COLUMN_COUNT):
+            value = self.value(index, col)
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            elif isinstance(value, date):
+                value = {"date": value.isoformat()}
+            values.append(value)
+        return values
+
+    def append_exported(self, values):
+        values = list(values)
+        for col in DATE_COLUMNS:
+            value = values[col]
+            if isinstance(value, dict) and "date" in value:
+                values[col] = date.fromisoformat(value["date"])
+            elif isinstance(value, str):
+                try:
+                    values[col] = datetime.fromisoformat(value)
+                except ValueError:
+                    pass
+        return self.append_raw(values)
+
+    def release(self, count=1):
+        # Rows dropped from the grid by a delta; their space is reclaimed by the next full load
+        self._released += count
+
+    def needs_reload(self):
+        return self._released > 1000 and self._released * 2 > self._size
+
+
+def build_store(rows):
+    store = ProductionStore()
+    return store, [store.append_raw(row) for row in rows]
+
+
+def child_row(store, op, record):
+    # Tree mode child: the OP and the progress columns 9-14, the ERP columns left blank
+    return store.append_raw((op,) + (None,) * 8 + tuple(record))
+
+
+def join_children(parents, children):
+    # Tree mode parents and their records as flat rows, like the production query returns them.
+    # children is keyed by (company, # OP), see db.fetch_fp_children
+    store = ProductionStore()
+    rows = []
+    for parent in parents:
+        head = tuple(parent.value(col) for col in range(9))
+        for record in children.get((parent[9], parent[0])) or [(parent.value(9),) + (None,) * 5]:
+            rows.append(store.append_raw(head + tuple(record)))
+    return rows
@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import metrics
+from db import SaveConflict
+
+# Shown as FP_ID of a record that is created in the grid but not saved yet
+PENDING_FP_ID = "pendiente"
+
+
+# Local write-ahead journal of record saves (JSON lines, fsync'd on every append).
+# A "save" line is written when the user saves; the flusher adds a "done" or "failed" line once
+# SIIAPP answered, and an "ack" line is added when a failure has been shown to the user.
+# Saves are flushed in journal order, which keeps the edits of a record in order.
+class SaveJournal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._failed = OrderedDict()
+        self._load()
+        self._compact()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for number, line in enumerate(lines, 1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line torn by a crash can only be the last one: that save never returned
+                if number != len(lines):
+                    logging.error(f"Skipping unreadable line {number} of the save journal {self.path}")
+                continue
+            kind, key = record.get("t"), record.get("key")
+            if kind == "save":
+                self._pending[key] = record
+            elif kind == "done":
+                self._pending.pop(key, None)
+            elif kind == "failed":
+                entry = self._pending.pop(key, None)
+                if entry is not None:
+                    self._failed[key] = dict(entry, error=record.get("error"),
+                                             conflict=record.get("conflict", False))
+            elif kind == "ack":
+                self._failed.pop(key, None)
+
+    def _compact(self):
+        # Rewrite the journal with only what is still open: pending saves and unseen failures
+        records = list(self._pending.values())
+        for key, entry in self._failed.items():
+            save = {k: v for k, v in entry.items() if k not in ("error", "conflict")}
+            records.append(save)
+            records.append({"t": "failed", "key": key, "error": entry["error"],
+                            "conflict": entry["conflict"]})
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".journal-", dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _write(self, record):
+        with metrics.timer("journal", "append"):
+            self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def append(self, kind, op, company, fp_id, values, expected=None, user=None):
+        # kind "create" (fp_id None) or "update"; values/expected: {cantidad, fase, planta, comentarios}
+        entry = {"t": "save", "key": uuid.uuid4().hex, "kind": kind, "op": op, "company": company,
+                 "fp_id": fp_id, "values": values, "expected": expected, "user": user,
+                 "queued_at": time.time()}
+        with self._lock:
+            self._write(entry)
+            self._pending[entry["key"]] = entry
+        return entry
+
+    def pending(self):
+        with self._lock:
+            return list(self._pending.values())
+
+    def failures(self):
+        with self._lock:
+            return list(self._failed.values())
+
+    def mark_done(self, key, fp_id):
+        with self._lock:
+            self._write({"t": "done", "key": key, "fp_id": fp_id})
+            self._pending.pop(key, None)
+
+    def mark_failed(self, key, error, conflict=False):
+        with self._lock:
+            self._write({"t": "failed", "key": key, "error": error, "conflict": conflict})
+            entry = self._pending.pop(key, None)
+            if entry is not None:
+                self._failed[key] = dict(entry, error=error, conflict=conflict)
+
+    def acknowledge(self, keys):
+        with self._lock:
+            for key in keys:
+                if self._failed.pop(key, None) is not None:
+                    self._write({"t": "ack", "key": key})
+            if not self._pending and not self._failed:
+                # Everything settled: start the file over
+                self._file.close()
+                self._compact()
+                self._file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# Background thread sending the journaled saves to SIIAPP through a backend (backends.py), in
+# journal order. A transient error (network, busy pool) stops the round and retries later with
+# exponential backoff; any other error marks that save as failed and moves on.
+class JournalFlusher:
+    def __init__(self, journal, backend, on_result, batch_size=50, max_backoff=60):
+        self.journal = journal
+        self.backend = backend
+        # on_result(kind, entry, detail) from the flusher thread: "done", "failed" or "retry"
+        self.on_result = on_result
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self._attempts = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        delay = 0
+        while not self._stop.is_set():
+            if delay is None or delay > 0:
+                self._wake.wait(delay)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                delay = self.flush()
+            except Exception as e:
+                # e.g. the journal file became unwritable: keep the saves and try again later
+                logging.error(f"An error occurred while flushing the save journal: {str(e)}")
+                delay = self.max_backoff
+
+    def flush(self):
+        # One batch; returns the seconds until the next round (None: wait for the next save)
+        batch = self.journal.pending()[:self.batch_size]
+        with metrics.timer("journal", "flush", rows=len(batch)) as m:
+            done = 0
+            for entry in batch:
+                if self._stop.is_set():
+                    return None
+                try:
+                    fp_id = self._apply(entry)
+                except Exception as e:
+                    if self.backend.is_transient(e):
+                        self._attempts += 1
+                        delay = min(self.max_backoff, 2 ** self._attempts)
+                        logging.error(f"An error occurred while flushing saves, retrying in {delay}s: {str(e)}")
+                        self.on_result("retry", entry, delay)
+                        m["saved"] = done
+                        return delay
+                    logging.error(f"An error occurred while saving journaled record: {str(e)}")
+                    self.journal.mark_failed(entry["key"], str(e), isinstance(e, SaveConflict))
+                    self.on_result("failed", entry, str(e))
+                    continue
+                self._attempts = 0
+                self.journal.mark_done(entry["key"], fp_id)
+                self.on_result("done", entry, fp_id)
+                done += 1
+            m["saved"] = done
+        return 0 if self.journal.pending() else None
+
+    def _apply(self, entry):
+        values = entry["values"]
+        if entry["kind"] == "create":
+            return self.backend.create_record(
+                entry["op"], entry["company"], values["cantidad"], values["fase"], values["planta"],
+                values["comentarios"], save_key=entry["key"], user=entry.get("user"))
+        self.backend.update_record(
+            entry["fp_id"], values["cantidad"], values["fase"], values["planta"], values["comentarios"],
+            save_key=entry["key"], expected=entry["expected"], user=entry.get("user"))
+        return entry["fp_id"]
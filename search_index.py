@@ -0,0 +1,158 @@
+import shlex
+
+from db import op_key, op_sort_key
+
+# Columns searched by a bare term: "# OP", "# PEDIDO", "CODIGO ITEM"
+KEY_COLUMNS = (0, 1, 2)
+# Low-cardinality columns indexed by value: ESTADO OP, COMPANIA, FASE DE PRODUCCION, PLANTA
+CATEGORY_COLUMNS = (8, 9, 12, 13)
+# Prefixes accepted in the filter box, e.g. "fase:envasado estado:proceso 1234"
+SEARCH_FIELDS = {
+    "op": 0,
+    "pedido": 1,
+    "item": 2,
+    "estado": 8,
+    "compania": 9,
+    "fase": 12,
+    "planta": 13,
+}
+GRAM_SIZE = 3
+
+
+def parse_query(text):
+    # Returns a list of (column or None, lowercased term); terms are AND-ed
+    try:
+        tokens = shlex.split(text)
+    except ValueError:
+        tokens = text.split()
+    terms = []
+    for token in tokens:
+        field, sep, value = token.partition(":")
+        if sep and field.lower() in SEARCH_FIELDS:
+            if value:
+                terms.append((SEARCH_FIELDS[field.lower()], value.lower()))
+        else:
+            terms.append((None, token.lower()))
+    return terms
+
+
+def _grams(value):
+    return {value[i:i + GRAM_SIZE] for i in range(len(value) - GRAM_SIZE + 1)}
+
+
+# In-memory index over the production rows.
+# Bare terms use a trigram index over the lowercased key columns (verified with a substring
+# check), field terms on categorical columns use a value -> rows map. Rows are identified by
+# id(row), so the index can be patched with add_rows/remove_ops when a delta arrives.
+class SearchIndex:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._data = []
+        self._rows = {}
+        self._order = {}
+        self._keys = {}
+        self._grams = {}
+        self._categories = {col: {} for col in CATEGORY_COLUMNS}
+        self._by_op = {}
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def rebuild(self, data):
+        # data is kept by reference: it must be the list patched by later deltas
+        self.clear()
+        self._data = data
+        self.add_rows(data)
+
+    def add_rows(self, rows):
+        for row in rows:
+            rid = id(row)
+            keys = tuple(str(row[col]).lower() for col in KEY_COLUMNS)
+            self._rows[rid] = row
+            self._keys[rid] = keys
+            self._order[rid] = (op_sort_key(row[0]), self._seq)
+            self._seq += 1
+            self._by_op.setdefault(op_key(row), set()).add(rid)
+            for key in keys:
+                for gram in _grams(key):
+                    self._grams.setdefault(gram, set()).add(rid)
+            for col in CATEGORY_COLUMNS:
+                value = str(row[col]).lower()
+                self._categories[col].setdefault(value, set()).add(rid)
+
+    def remove_ops(self, ops):
+        # ops are (company, # OP) keys, see db.op_key
+        for op in ops:
+            for rid in self._by_op.pop(op, ()):
+                row = self._rows.pop(rid)
+                del self._order[rid]
+                for key in self._keys.pop(rid):
+                    for gram in _grams(key):
+                        postings = self._grams.get(gram)
+                        if postings is not None:
+                            postings.discard(rid)
+                            if not postings:
+                                del self._grams[gram]
+                for col in CATEGORY_COLUMNS:
+                    value = str(row[col]).lower()
+                    postings = self._categories[col].get(value)
+                    if postings is not None:
+                        postings.discard(rid)
+                        if not postings:
+                            del self._categories[col][value]
+
+    def search(self, text):
+        # Returns the matching rows in display order, or None when the query is empty
+        terms = parse_query(text)
+        if not terms:
+            return None
+        result = None
+        # Category terms are cheap and usually selective: apply them first
+        for col, term in sorted(terms, key=lambda t: t[0] not in CATEGORY_COLUMNS):
+            if col in CATEGORY_COLUMNS:
+                hits = set()
+                for value, postings in self._categories[col].items():
+                    if term in value:
+                        hits |= postings
+                result = hits if result is None else result & hits
+            else:
+                result = self._match_key(term, col, result)
+            if not result:
+                return []
+        return self._ordered(result)
+
+    def _match_key(self, term, col, candidates):
+        if len(term) >= GRAM_SIZE:
+            postings = []
+            for gram in _grams(term):
+                gram_postings = self._grams.get(gram)
+                if gram_postings is None:
+                    return set()
+                postings.append(gram_postings)
+            postings.sort(key=len)
+            hits = postings[0] & postings[1] if len(postings) > 1 else set(postings[0])
+            for gram_postings in postings[2:]:
+                hits &= gram_postings
+            if candidates is not None:
+                hits &= candidates
+        else:
+            # Too short for the trigram index: scan the prebuilt lowercased keys
+            hits = candidates if candidates is not None else self._keys.keys()
+
+        keys = self._keys
+        if col is None:
+            return {rid for rid in hits
+                    if term in keys[rid][0] or term in keys[rid][1] or term in keys[rid][2]}
+        pos = KEY_COLUMNS.index(col)
+        return {rid for rid in hits if term in keys[rid][pos]}
+
+    def _ordered(self, rids):
+        if len(rids) * 4 > len(self._rows):
+            # Large result: a pass over the indexed list is cheaper than sorting
+            return [row for row in self._data if id(row) in rids]
+        order = self._order
+        rows = self._rows
+        return [rows[rid] for rid in sorted(rids, key=order.__getitem__)]
@@ -0,0 +1,330 @@
+import argparse
+import gzip
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from dotenv import load_dotenv
+
+import db
+import metrics
+from db import SaveConflict
+from row_store import ProductionStore
+
+# Optional production cache service: runs the grid query once per refresh interval for every
+# desktop client and serves the result over HTTP (see backends.ServiceBackend).
+# Requires fastapi and uvicorn, which the desktop build does not ship.
+
+# Change log entries kept for /production/changes; older clients reload everything
+CHANGE_HISTORY = 200
+# Shared secret the clients send (SERVICE_TOKEN) on every request but /health
+TOKEN_HEADER = "X-Service-Token"
+
+
+def _key_order(key):
+    # (company, # OP) keys in grid order
+    return (db.op_sort_key(key[1]), key[0])
+
+
+def _exporter():
+    # Row factory returning JSON friendly typed rows (row_store export format)
+    store = ProductionStore()
+    return lambda row: store.append_raw(row).export()
+
+
+# Versioned copy of the production query. The first refresh loads everything, later ones only
+# the OPs reported as changed by db.fetch_sync_state. Each refresh that changes something bumps
+# the version and records the OPs it touched, so clients can ask for the changes since theirs.
+# OPs are keyed by (company, # OP) (db.op_key), sent as [company, op] pairs.
+class ProductionCache:
+    def __init__(self, fetch_size=db.DEFAULT_FETCH_SIZE, version_column="", history=CHANGE_HISTORY,
+                 scopes=db.DEFAULT_SCOPES):
+        self.fetch_size = fetch_size
+        self.version_column = version_column
+        self.scopes = list(scopes)
+        # A new id per process: versions of a previous run are never mistaken for current ones
+        self.cache_id = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.refreshed_at = None
+        self.last_error = None
+        self._rows = {}
+        self._sync_state = None
+        self._changes = deque(maxlen=history)
+        self._body = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def etag(self):
+        return f'"{self.cache_id}:{self.version}"'
+
+    def refresh(self):
+        # One database refresh at a time; readers keep being served the previous version
+        with self._refresh_lock:
+            cancel_event = threading.Event()
+            if self._sync_state is None:
+                rows, sync_state = db.fetch_scoped_data(
+                    self.scopes, cancel_event, fetch_size=self.fetch_size,
+                    version_column=self.version_column, row_factory=_exporter())
+                by_op = {}
+                for row in rows:
+                    by_op.setdefault(db.op_key(row), []).append(row)
+                with self._lock:
+                    self._rows = by_op
+                    self._sync_state = sync_state
+                    self.version += 1
+                    # Earlier versions cannot be patched into this one
+                    self._changes.clear()
+                    self._body = None
+            else:
+                touched, removed, changed_rows, sync_state = db.fetch_scoped_delta(
+                    self.scopes, self._sync_state, cancel_event, fetch_size=self.fetch_size,
+                    version_column=self.version_column, row_factory=_exporter())
+                with self._lock:
+                    self._sync_state = sync_state
+                    if touched or removed:
+                        for key in touched | removed:
+                            self._rows.pop(key, None)
+                        for row in changed_rows:
+                            self._rows.setdefault(db.op_key(row), []).append(row)
+                        self.version += 1
+                        self._changes.append((self.version, touched, removed))
+                        self._body = None
+            self.refreshed_at = time.time()
+            self.last_error = None
+
+    def refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            self.last_error = str(e)
+            logging.error(f"An error occurred while refreshing the production cache: {str(e)}")
+
+    def full_body(self):
+        # (etag, gzipped JSON of every row) encoded once per version, outside the lock
+        with self._lock:
+            if self._body is not None:
+                return self._body
+            version, etag, rows = self.version, self.etag, dict(self._rows)
+        with metrics.timer("service", "encode") as m:
+            ordered = [row for key in sorted(rows, key=_key_order) for row in rows[key]]
+            payload = {"cache": self.cache_id, "version": version, "rows": ordered}
+            body = gzip.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"), 5)
+            m["rows"] = len(ordered)
+            m["payload_bytes"] = len(body)
+        with self._lock:
+            if self.version == version:
+                self._body = (etag, body)
+        return etag, body
+
+    def changes_since(self, cache_id, since):
+        # Payload with the rows of the OPs changed after `since`, or None when the client
+        # must reload everything (another process, or older than the change log)
+        with self._lock:
+            if cache_id != self.cache_id or since > self.version:
+                return None
+            entries = [entry for entry in self._changes if entry[0] > since]
+            if len(entries) != self.version - since:
+                return None
+            changed = set()
+            for _, touched, removed in entries:
+                changed |= touched | removed
+            touched = sorted((key for key in changed if key in self._rows), key=_key_order)
+            return {
+                "cache": self.cache_id,
+                "version": self.version,
+                "touched": [list(key) for key in touched],
+                "removed": [list(key) for key in sorted((key for key in changed if key not in self._rows),
+                                                        key=_key_order)],
+                "rows": [row for key in touched for row in self._rows[key]],
+            }
+
+    # Writes go straight to SIIAPP; the refresh right after makes them visible to every client
+    def create_record(self, op_value, it_comp, cantidad_fp, fase_producc, planta, comentarios,
+                      save_key=None, user=None):
+        fp_id = db.create_fp_record(op_value, it_comp, cantidad_fp, fase_producc, planta, comentarios,
+                                    save_key=save_key, user=user)
+        self.refresh_quietly()
+        return int(fp_id)
+
+    def update_record(self, fp_id, cantidad_fp, fase_producc, planta, comentarios, save_key=None,
+                      expected=None, user=None):
+        db.update_fp_record(fp_id, cantidad_fp, fase_producc, planta, comentarios,
+                            save_key=save_key, expected=expected, user=user)
+        self.refresh_quietly()
+
+    def bulk_save(self, creates, updates, fase_producc, planta, comentarios=None, user=None):
+        created = db.bulk_save_fp_records(creates, updates, fase_producc, planta, comentarios, user)
+        self.refresh_quietly()
+        # JSON has no tuple keys: [company, op, fp_id] triples
+        return [[company, op, int(fp_id)] for (company, op), fp_id in created.items()]
+
+
+def create_app(production_cache, token=""):
+    from fastapi import Body, FastAPI, Request, Response
+    from fastapi.responses import JSONResponse
+
+    app = FastAPI(title="SIIAPP_FP production cache")
+
+    @app.middleware("http")
+    async def authenticate(request: Request, call_next):
+        # The desktop login (LDAP) does not reach the service: every client shares one token
+        if request.url.path != "/health":
+            sent = request.headers.get(TOKEN_HEADER, "")
+            if not token or not hmac.compare_digest(sent.encode("utf-8"), token.encode("utf-8")):
+                return JSONResponse({"detail": "Invalid service token"}, status_code=401)
+        return await call_next(request)
+
+    def _ready():
+        if production_cache.version == 0:
+            return JSONResponse({"detail": "Cache not loaded yet"}, status_code=503)
+        return None
+
+    def _user(body):
+        # The token identifies the client application, not the person: the user name it sends is
+        # recorded as asserted by the client
+        user = body.get("user")
+        return f"client:{user}" if user else None
+
+    def _write(action, *args):
+        try:
+            return action(*args)
+        except ValueError as e:
+            return JSONResponse({"detail": str(e)}, status_code=400)
+        except SaveConflict as e:
+            return JSONResponse({"detail": str(e)}, status_code=409)
+        except Exception as e:
+            # Driver errors: the client reports them like a failed local save. Transient ones
+            # (connection, timeout, busy pool) are 503 so journaled saves are retried
+            logging.error(f"An error occurred while saving through the service: {str(e)}")
+            if db.is_transient_error(e):
+                return JSONResponse({"detail": str(e)}, status_code=503)
+            return JSONResponse({"detail": "Database error"}, status_code=500)
+
+    @app.get("/health")
+    def health():
+        return {"cache": production_cache.cache_id, "version": production_cache.version,
+                "refreshed_at": production_cache.refreshed_at, "last_error": production_cache.last_error,
+                "pools": db.pool_stats()}
+
+    @app.get("/production")
+    def production(request: Request):
+        not_ready = _ready()
+        if not_ready is not None:
+            return not_ready
+        etag, body = production_cache.full_body()
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        headers = {"ETag": etag}
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+        else:
+            body = gzip.decompress(body)
+        return Response(body, media_type="application/json", headers=headers)
+
+    @app.get("/production/changes")
+    def changes(cache: str, since: int, request: Request):
+        not_ready = _ready()
+        if not_ready is not None:
+            return not_ready
+        etag = production_cache.etag
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        payload = production_cache.changes_since(cache, since)
+        if payload is None:
+            return JSONResponse({"detail": "Reload the full dataset"}, status_code=410)
+        return JSONResponse(payload, headers={"ETag": f'"{payload["cache"]}:{payload["version"]}"'})
+
+    @app.post("/records")
+    def create(body: dict = Body(...)):
+        result = _write(production_cache.create_record, body["op"], body["company"], body["cantidad"],
+                        body["fase"], body["planta"], body.get("comentarios"), body.get("save_key"),
+                        _user(body))
+        return result if isinstance(result, Response) else {"fp_id": result}
+
+    @app.put("/records/{fp_id}")
+    def update(fp_id: int, body: dict = Body(...)):
+        result = _write(production_cache.update_record, fp_id, body["cantidad"], body["fase"],
+                        body["planta"], body.get("comentarios"), body.get("save_key"),
+                        body.get("expected"), _user(body))
+        return result if isinstance(result, Response) else {"fp_id": fp_id}
+
+    @app.post("/records/bulk")
+    def bulk(body: dict = Body(...)):
+        result = _write(production_cache.bulk_save, [tuple(values) for values in body.get("creates", [])],
+                        [tuple(values) for values in body.get("updates", [])],
+                        body["fase"], body["planta"], body.get("comentarios"), _user(body))
+        return result if isinstance(result, Response) else {"result": result}
+
+    return app
+
+
+def _refresh_loop(cache, interval, stop_event):
+    while True:
+        cache.refresh_quietly()
+        if stop_event.wait(interval):
+            return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SIIAPP_FP production cache service")
+    parser.add_argument("--host", default=os.getenv("SERVICE_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVICE_PORT", "8765")))
+    parser.add_argument("--refresh-seconds", type=float,
+                        default=float(os.getenv("SERVICE_REFRESH_SECONDS", "30")))
+    parser.add_argument("--fake-rows", metavar="N",
+                        help="serve a synthetic dataset (benchmark driver) instead of SQL Server")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    metrics.configure(os.getenv("SERVICE_METRICS_FILE", "service_metrics.jsonl"))
+    token = os.getenv('SERVICE_TOKEN', '')
+    if not token:
+        raise ValueError("SERVICE_TOKEN must be set: the service writes to SIIAPP without the desktop login.")
+    db.configure_pools(
+        connect_timeout=int(os.getenv('DB_CONNECT_TIMEOUT', '15')),
+        query_timeout=int(os.getenv('DB_QUERY_TIMEOUT', '60')),
+        max_size=int(os.getenv('DB_POOL_SIZE', '5')),
+        timeout=int(os.getenv('DB_POOL_TIMEOUT', '30')),
+        max_idle=int(os.getenv('DB_POOL_MAX_IDLE', '300')),
+    )
+    if os.getenv('ERP_MIRROR', '0') == '1':
+        db.use_erp_mirror()
+    phase_events = os.getenv('PHASE_EVENTS', '0')
+    if phase_events not in ("0", "dual", "1"):
+        raise ValueError("PHASE_EVENTS must be 0, dual or 1.")
+    if phase_events != "0":
+        db.use_phase_events(dual=phase_events == "dual")
+    if args.fake_rows:
+        # Local stand-in database: no SQL Server needed to try the service and the clients
+        from benchmark.datagen import Dataset, parse_scale
+        from benchmark.fake_driver import FakeDatabase
+        database = FakeDatabase(Dataset(parse_scale(args.fake_rows)))
+        for name in db.POOL_DATABASES:
+            db.set_pool(name, db.ConnectionPool(database.connect, name=name))
+
+    version_column = os.getenv('FP_PROGRES_VERSION_COLUMN', '')
+    if version_column and not version_column.isidentifier():
+        raise ValueError("FP_PROGRES_VERSION_COLUMN must be a plain column name.")
+    cache = ProductionCache(int(os.getenv('DB_FETCH_SIZE', '1000')), version_column,
+                            scopes=db.parse_scopes(os.getenv('GRID_SCOPES', '')))
+    stop_event = threading.Event()
+    threading.Thread(target=_refresh_loop, args=(cache, args.refresh_seconds, stop_event),
+                     daemon=True).start()
+
+    import uvicorn
+    try:
+        uvicorn.run(create_app(cache, token), host=args.host, port=args.port)
+    finally:
+        stop_event.set()
+        db.close_pools()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# Bump when the layout of the rows or of the sync state changes
+# 2: rows are typed values exported from row_store (dates as ISO strings, quantities as numbers)
+# 3: version-column states keep the per-OP FP_PROGRES record counts
+SNAPSHOT_SCHEMA_VERSION = 3
+
+
+def snapshot_key(*parts):
+    # Identifies the query/schema a snapshot was taken with; any change invalidates the file
+    digest = hashlib.sha256(str(SNAPSHOT_SCHEMA_VERSION).encode("utf-8"))
+    for part in parts:
+        digest.update(b"\0")
+        digest.update(repr(part).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _encode_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {"bytes": bytes(value).hex()}
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and "bytes" in value:
+        return bytes.fromhex(value["bytes"])
+    if isinstance(value, dict) and "datetime" in value:
+        return datetime.fromisoformat(value["datetime"])
+    return value
+
+
+def _encode_state(state):
+    if state is None:
+        return None
+    encoded = {}
+    if "scopes" in state:
+        # Several load scopes: one state each
+        encoded["scopes"] = {key: _encode_state(value) for key, value in state["scopes"].items()}
+    if "ops" in state:
+        encoded["ops"] = state["ops"]
+    if "service" in state:
+        # Service backend: cache id and version of the service dataset
+        encoded["service"] = dict(state["service"])
+    if "fp" in state:
+        encoded["fp"] = {op: list(value) for op, value in state["fp"].items()}
+    if "fp_watermark" in state:
+        encoded["fp_watermark"] = _encode_value(state["fp_watermark"])
+        encoded["fp_changed"] = sorted(state.get("fp_changed", ()))
+        encoded["fp_counts"] = state.get("fp_counts", {})
+    return encoded
+
+
+def _decode_state(encoded):
+    if encoded is None:
+        return None
+    state = {}
+    if "scopes" in encoded:
+        state["scopes"] = {key: _decode_state(value) for key, value in encoded["scopes"].items()}
+    if "ops" in encoded:
+        state["ops"] = encoded["ops"]
+    if "service" in encoded:
+        state["service"] = dict(encoded["service"])
+    if "fp" in encoded:
+        state["fp"] = {op: tuple(value) for op, value in encoded["fp"].items()}
+    if "fp_watermark" in encoded:
+        state["fp_watermark"] = _decode_value(encoded["fp_watermark"])
+        state["fp_changed"] = set(encoded["fp_changed"])
+        state["fp_counts"] = encoded.get("fp_counts", {})
+    return state
+
+
+def write_json_atomic(path, payload, prefix=".snapshot-"):
+    # Gzipped JSON written to a temporary file in the same directory, then swapped in atomically
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=prefix, dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=5) as f:
+                f.write(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def save_snapshot(path, key, rows, sync_state):
+    # rows: row_store.RowView objects
+    payload = {
+        "schema_version": SNAPSHOT_SCHEMA_VERSION,
+        "key": key,
+        "taken_at": time.time(),
+        "sync_state": _encode_state(sync_state),
+        "rows": [row.export() for row in rows],
+    }
+    write_json_atomic(path, payload, prefix=".snapshot-")
+
+
+def discard_snapshot(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def load_snapshot(path, key, max_age=None):
+    # Returns (exported rows, sync_state, taken_at) or None; stale or foreign snapshots are evicted
+    try:
+        with gzip.open(path, "rb") as f:
+            payload = json.loads(f.read().decode("utf-8"))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, EOFError) as e:
+        logging.error(f"Discarding unreadable snapshot {path}: {str(e)}")
+        discard_snapshot(path)
+        return None
+
+    if payload.get("schema_version") != SNAPSHOT_SCHEMA_VERSION or payload.get("key") != key:
+        discard_snapshot(path)
+        return None
+    taken_at = payload.get("taken_at", 0)
+    if max_age is not None and time.time() - taken_at > max_age:
+        discard_snapshot(path)
+        return None
+    return payload["rows"], _decode_state(payload.get("sync_state")), taken_at
+
+
+# Writes snapshots on a background thread. Only the latest submitted dataset is kept,
+# so a burst of refreshes results in a single write.
+class SnapshotWriter:
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self._lock = threading.Lock()
+        self._pending = None
+        self._thread = None
+
+    def submit(self, rows, sync_state):
+        with self._lock:
+            self._pending = (rows, sync_state)
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                pending = self._pending
+                self._pending = None
+                if pending is None:
+                    self._thread = None
+                    return
+            try:
+                save_snapshot(self.path, self.key, *pending)
+            except Exception as e:
+                logging.error(f"An error occurred while writing snapshot: {str(e)}")
@@ -0,0 +1,153 @@
+from collections import OrderedDict
+
+from db import PHASES, op_key, op_sort_key
+from row_store import DATE_COLUMNS, FLOAT_COLUMNS, INT_COLUMNS
+
+# Columns the grid can be grouped by: ESTADO OP, FASE DE PRODUCCION, PLANTA
+GROUP_COLUMNS = (8, 12, 13)
+# Groups shown in a fixed order instead of alphabetically
+GROUP_ORDER = {12: {fase.casefold(): i for i, fase in enumerate(PHASES)}}
+# Orders kept for reuse (each one holds a permutation of the whole dataset)
+MAX_CACHED_ORDERS = 6
+
+TYPED_COLUMNS = DATE_COLUMNS + FLOAT_COLUMNS + INT_COLUMNS
+MISSING = (2,)
+
+
+def sort_key(row, col):
+    # (0, typed value) sorts before (1, text that does not fit the column type); empty cells last
+    value = row.sort_value(col)
+    if value is None:
+        return MISSING
+    if col == 0:
+        return (0, op_sort_key(value))
+    if isinstance(value, (int, float)):
+        return (0, value)
+    return (1 if col in TYPED_COLUMNS else 0, value.casefold())
+
+
+def group_key(row, col):
+    key = sort_key(row, col)
+    order = GROUP_ORDER.get(col)
+    if order is not None and key is not MISSING:
+        position = order.get(key[1])
+        if position is not None:
+            return (0, position)
+        return (1, key[1])
+    return key
+
+
+# Typed sort keys and cached orders over the production rows.
+# Keys are computed once per column on first use; an order (sort spec plus optional group
+# column) is a permutation of the whole dataset, cached so that filters and repeated clicks
+# reuse it: a filter result is ordered by the positions of its rows in the cached permutation.
+# Rows are identified by id(row) and the index is patched with add_rows/remove_ops like SearchIndex.
+class SortIndex:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._data = []
+        self._built = False
+        self._rows = {}
+        self._by_op = {}
+        self._keys = {}
+        self._orders = OrderedDict()
+
+    def rebuild(self, data):
+        # data is kept by reference: it must be the list patched by later deltas.
+        # Nothing is computed until the first sort.
+        self.clear()
+        self._data = data
+
+    def _build(self):
+        if self._built:
+            return
+        self._built = True
+        self._add(self._data)
+
+    def _add(self, rows):
+        for row in rows:
+            rid = id(row)
+            self._rows[rid] = row
+            self._by_op.setdefault(op_key(row), set()).add(rid)
+            for col, keys in self._keys.items():
+                keys[rid] = group_key(row, col[1]) if isinstance(col, tuple) else sort_key(row, col)
+
+    def add_rows(self, rows):
+        if not self._built:
+            return
+        self._add(rows)
+        self._orders.clear()
+
+    def remove_ops(self, ops):
+        # ops are (company, # OP) keys, see db.op_key
+        if not self._built:
+            return
+        for op in ops:
+            for rid in self._by_op.pop(op, ()):
+                del self._rows[rid]
+                for keys in self._keys.values():
+                    keys.pop(rid, None)
+        self._orders.clear()
+
+    def _column_keys(self, col, grouping=False):
+        # {rid: key}; group keys are stored under ("group", col)
+        name = ("group", col) if grouping else col
+        keys = self._keys.get(name)
+        if keys is None:
+            key = group_key if grouping else sort_key
+            keys = {rid: key(row, col) for rid, row in self._rows.items()}
+            self._keys[name] = keys
+        return keys
+
+    def _order(self, spec, group):
+        # Cached (ordered ids, {id: position} or None) for spec ((col, descending), ...) and group
+        name = (tuple(spec), group)
+        cached = self._orders.get(name)
+        if cached is not None:
+            self._orders.move_to_end(name)
+            return cached
+        self._build()
+        # Ties keep the dataset order (# OP, as loaded)
+        order = [id(row) for row in self._data]
+        # Stable sorts from the least to the most significant key
+        for col, descending in reversed(spec):
+            keys = self._column_keys(col)
+            order.sort(key=keys.__getitem__, reverse=descending)
+            if descending:
+                # Empty cells stay at the end in both directions
+                order.sort(key=lambda rid: keys[rid] is MISSING)
+        if group is not None:
+            order.sort(key=self._column_keys(group, grouping=True).__getitem__)
+        cached = [order, None]
+        self._orders[name] = cached
+        if len(self._orders) > MAX_CACHED_ORDERS:
+            self._orders.popitem(last=False)
+        return cached
+
+    def ordered(self, rows, spec, group=None):
+        # rows (a subset of the dataset, or None for all of it) in the requested order
+        cached = self._order(spec, group)
+        order = cached[0]
+        all_rows = self._rows
+        if rows is None:
+            return [all_rows[rid] for rid in order]
+        if len(rows) * 4 > len(order):
+            # Large subset: a pass over the permutation is cheaper than sorting
+            wanted = {id(row) for row in rows}
+            return [all_rows[rid] for rid in order if rid in wanted]
+        if cached[1] is None:
+            cached[1] = {rid: i for i, rid in enumerate(order)}
+        position = cached[1]
+        return sorted(rows, key=lambda row: position[id(row)])
+
+    def groups(self, rows, col):
+        # [(start, count, label)] over rows already ordered by group column col
+        result = []
+        start = 0
+        for i in range(1, len(rows) + 1):
+            if i == len(rows) or rows[i][col] != rows[start][col]:
+                result.append((start, i - start, rows[start][col]))
+                start = i
+        return result
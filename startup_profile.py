@@ -0,0 +1,50 @@
+import importlib
+import logging
+import sys
+import time
+
+# Startup timeline: milestones and lazy imports, relative to the first import of this module
+_T0 = time.perf_counter()
+_marks = []
+_seen = set()
+_imports = []
+
+
+def mark(label):
+    # Only the first time a milestone is reached is recorded
+    if label not in _seen:
+        _seen.add(label)
+        _marks.append((label, time.perf_counter() - _T0))
+
+
+def lazy_import(name):
+    # Import a heavy module on first use and record how long it took
+    module = sys.modules.get(name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        _imports.append((name, time.perf_counter() - start, start - _T0))
+    return module
+
+
+def report():
+    lines = ["Startup profile (seconds since start)"]
+    for label, at in _marks:
+        lines.append(f"  {at:8.3f}  {label}")
+    if _imports:
+        lines.append("Lazy imports (duration, started at)")
+        for name, duration, at in _imports:
+            lines.append(f"  {duration:8.3f}  {name} @ {at:.3f}")
+    return "\n".join(lines)
+
+
+def write_report(path):
+    text = report()
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    except OSError as e:
+        logging.error(f"An error occurred while writing the startup profile: {str(e)}")
+    # The windowed build has no console
+    if sys.stdout is not None:
+        print(text)
@@ -0,0 +1,159 @@
+import functools
+
+import pytest
+from cachetools import TTLCache
+from ldap3 import MOCK_SYNC, OFFLINE_AD_2012_R2, Connection, Server
+from ldap3.core.exceptions import LDAPBindError
+
+import auth
+
+USERS_OU = "OU=Users,DC=corp,DC=local"
+APP_GROUP = "CN=SIIAPP Users,OU=Groups,DC=corp,DC=local"
+ADMINS_GROUP = "CN=Admins,OU=IT,DC=corp,DC=local"
+# Member of SIIAPP Users, but only group members are listed in memberOf
+NESTED_GROUP = "CN=Planta Norte,OU=Groups,DC=corp,DC=local"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def server():
+    # MOCK_SYNC connections on the same Server share its directory
+    server = Server("fake-ad", get_info=OFFLINE_AD_2012_R2)
+    seed = Connection(server, client_strategy=MOCK_SYNC)
+    for name, groups in (("juan", [APP_GROUP]), ("ana", [ADMINS_GROUP]),
+                         ("luis", [NESTED_GROUP]), ("sara", [])):
+        attributes = {"sAMAccountName": name, "userPassword": "secret", "objectClass": "person"}
+        if groups:
+            attributes["memberOf"] = groups
+        seed.strategy.add_entry(f"CN={name},{USERS_OU}", attributes)
+    seed.strategy.add_entry(NESTED_GROUP, {"objectClass": "group", "memberOf": [APP_GROUP]})
+    return server
+
+
+def mock_bind(server, name, password):
+    # auto_bind is not applied by the mock strategy: bind and fail like ntlm_connection does
+    conn = Connection(server, user=f"CN={name},{USERS_OU}", password=password, client_strategy=MOCK_SYNC)
+    if not conn.bind():
+        raise LDAPBindError("invalidCredentials")
+    return conn
+
+
+class MockConnect:
+    # connection_factory binding "CORP\\user" as the user's entry with a simple bind
+    def __init__(self):
+        self.binds = []
+        self.searches = 0
+
+    def __call__(self, server, user, password):
+        self.binds.append(user)
+        name = user.split("\\")[-1]
+        conn = mock_bind(server, name, password)
+        search = conn.search
+
+        def counted_search(*args, **kwargs):
+            self.searches += 1
+            return search(*args, **kwargs)
+
+        conn.search = counted_search
+        return conn
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(auth, "TTLCache", functools.partial(TTLCache, timer=clock))
+    return clock
+
+
+def make_authorizer(server, allowed_groups=("SIIAPP Users",), **kwargs):
+    connect = MockConnect()
+    authorizer = auth.LdapAuthorizer(domain="corp.local", allowed_groups=allowed_groups,
+                                     server=server, connection_factory=connect, **kwargs)
+    return authorizer, connect
+
+
+def test_group_lookup_cached(server, clock):
+    authorizer, connect = make_authorizer(server)
+    assert authorizer.authenticate("juan", "secret")
+    assert authorizer.authenticate("JUAN", "secret")
+    # The password is checked every time, the groups only once
+    assert connect.binds == ["corp.local\\juan", "corp.local\\JUAN"]
+    assert connect.searches == 1
+
+
+def test_cache_expires_after_ttl(server, clock):
+    authorizer, connect = make_authorizer(server, cache_ttl=60)
+    assert authorizer.authenticate("juan", "secret")
+    clock.now = 59
+    assert authorizer.authenticate("juan", "secret")
+    assert connect.searches == 1
+    clock.now = 61
+    assert authorizer.authenticate("juan", "secret")
+    assert connect.searches == 2
+
+
+def test_failed_bind_not_cached(server, clock):
+    authorizer, connect = make_authorizer(server)
+    assert not authorizer.authenticate("juan", "wrong")
+    assert connect.searches == 0
+    assert authorizer.authenticate("juan", "secret")
+    assert connect.searches == 1
+    # A cached membership does not skip the password check
+    assert not authorizer.authenticate("juan", "wrong")
+
+
+def test_empty_password_rejected_without_bind(server, clock):
+    authorizer, connect = make_authorizer(server)
+    assert not authorizer.authenticate("juan", "")
+    assert connect.binds == []
+
+
+def test_group_matched_by_common_name(server, clock):
+    authorizer, _ = make_authorizer(server, allowed_groups=("siiapp users",))
+    assert authorizer.authenticate("juan", "secret")
+    assert not authorizer.authenticate("ana", "secret")
+
+
+def test_group_matched_by_full_dn(server, clock):
+    authorizer, _ = make_authorizer(
+        server, allowed_groups=("cn=siiapp users, ou=groups, dc=corp, dc=local",))
+    assert authorizer.authenticate("juan", "secret")
+    # Same CN in another OU is not the allowed group
+    assert not authorizer.is_allowed_group("CN=SIIAPP Users,OU=Old,DC=corp,DC=local")
+    assert not authorizer.authenticate("ana", "secret")
+
+
+def test_nested_and_unlisted_groups_denied(server, clock):
+    authorizer, _ = make_authorizer(server)
+    # memberOf only lists direct groups: membership through a nested group is not followed
+    assert not authorizer.authenticate("luis", "secret")
+    assert not authorizer.authenticate("sara", "secret")
+    assert not authorizer.authenticate("ana", "secret")
+
+
+def test_allowed_user_skips_group_lookup(server, clock):
+    authorizer, connect = make_authorizer(server, allowed_groups=(), allowed_users=("Sara",))
+    assert authorizer.authenticate("sara", "secret")
+    assert connect.searches == 0
+
+
+def test_unknown_user_not_cached(server, clock):
+    authorizer, _ = make_authorizer(server)
+    conn = mock_bind(server, "juan", "secret")
+    assert not authorizer.is_authorized(conn, "pedro")
+    assert "pedro" not in authorizer._cache
+
+
+def test_split_setting_keeps_group_dns_whole():
+    assert auth._split_setting("juan, ana") == ["juan", "ana"]
+    assert auth._split_setting("CN=FP,OU=Groups,DC=corp,DC=com") == ["CN=FP,OU=Groups,DC=corp,DC=com"]
+    assert auth._split_setting("CN=FP,OU=Groups,DC=corp,DC=com; SIIAPP Users") == [
+        "CN=FP,OU=Groups,DC=corp,DC=com", "SIIAPP Users"]
+    assert auth._split_setting("") == []
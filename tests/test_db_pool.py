@@ -0,0 +1,177 @@
+import threading
+import time
+
+import pytest
+
+import db
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, params=()):
+        self.conn.queries.append(query)
+        if self.conn.broken:
+            raise RuntimeError("connection lost")
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, number):
+        self.number = number
+        self.broken = False
+        self.closed = False
+        self.rollbacks = 0
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        if self.broken:
+            raise RuntimeError("connection lost")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnect:
+    # Connect function handing out numbered fake connections
+    def __init__(self):
+        self.connections = []
+
+    def __call__(self):
+        conn = FakeConnection(len(self.connections))
+        self.connections.append(conn)
+        return conn
+
+
+def make_pool(**kwargs):
+    connect = FakeConnect()
+    return db.ConnectionPool(connect, name="test", **kwargs), connect
+
+
+def test_reuses_idle_connection():
+    pool, connect = make_pool()
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert second is first
+    assert len(connect.connections) == 1
+    # Rolled back each time it goes back to the pool
+    assert first.rollbacks == 2
+    stats = pool.stats()
+    assert stats["checkouts"] == 2 and stats["created"] == 1 and stats["idle"] == 1
+
+
+def test_acquire_times_out_at_max_size():
+    pool, connect = make_pool(max_size=2)
+    held = [pool.acquire(), pool.acquire()]
+    started = time.monotonic()
+    with pytest.raises(db.PoolTimeout):
+        pool.acquire(timeout=0.05)
+    assert time.monotonic() - started >= 0.05
+    assert len(connect.connections) == 2
+    assert pool.stats()["timeouts"] == 1
+    for conn in held:
+        pool.release(conn)
+
+
+def test_acquire_waits_for_release():
+    pool, _ = make_pool(max_size=1)
+    conn = pool.acquire()
+    releaser = threading.Timer(0.05, pool.release, args=(conn,))
+    releaser.start()
+    try:
+        assert pool.acquire(timeout=2) is conn
+    finally:
+        releaser.join()
+    assert pool.stats()["max_wait"] > 0
+
+
+def test_broken_connection_replaced_on_checkout():
+    pool, connect = make_pool()
+    with pool.connection() as conn:
+        pass
+    conn.broken = True
+    with pool.connection() as fresh:
+        pass
+    assert fresh is not conn
+    assert conn.closed
+    assert conn.queries == ["SELECT 1"]
+    assert pool.stats()["reconnects"] == 1
+    assert pool.stats()["size"] == 1
+
+
+def test_idle_connection_recycled_after_max_idle():
+    pool, connect = make_pool(max_idle=0.01)
+    with pool.connection() as conn:
+        pass
+    time.sleep(0.02)
+    with pool.connection() as fresh:
+        pass
+    assert fresh is not conn
+    assert conn.closed
+    # Recycled without a health check
+    assert conn.queries == []
+    assert pool.stats()["recycled"] == 1
+
+
+def test_connection_discarded_when_rollback_fails():
+    pool, connect = make_pool()
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            conn.broken = True
+            raise ValueError("query failed")
+    assert conn.closed
+    stats = pool.stats()
+    assert stats["discarded"] == 1 and stats["size"] == 0 and stats["idle"] == 0
+    with pool.connection() as fresh:
+        pass
+    assert fresh is not conn
+
+
+def test_connection_released_on_exception():
+    pool, _ = make_pool(max_size=1)
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            raise ValueError("query failed")
+    # Rolled back on the error and again before going back to the pool
+    assert conn.rollbacks == 2
+    assert not conn.closed
+    assert pool.stats()["in_use"] == 0
+    assert pool.acquire(timeout=0.05) is conn
+
+
+def test_failed_connect_frees_the_slot():
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("server unavailable")
+        return FakeConnection(len(attempts))
+
+    pool = db.ConnectionPool(connect, max_size=1, name="test")
+    with pytest.raises(RuntimeError):
+        pool.acquire(timeout=0.05)
+    assert pool.stats()["size"] == 0
+    assert pool.acquire(timeout=0.05).number == 2
+
+
+def test_closed_pool_closes_connections():
+    pool, connect = make_pool()
+    with pool.connection():
+        pass
+    pool.close()
+    assert connect.connections[0].closed
+    with pytest.raises(db.PoolTimeout):
+        pool.acquire(timeout=0.05)
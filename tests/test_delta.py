@@ -0,0 +1,86 @@
+import db
+
+
+def grid_row(op, fp_id="", fase="", company="01"):
+    # Formatted production row (db.format_production_row): ERP columns 0-9, progress 10-14
+    return [str(op), "P1", "PT00001", "CREMA", "2024-06-10", "", "", "1000", "Pendiente", company,
+            str(fp_id), "500" if fp_id else "", fase, "01" if fp_id else "", ""]
+
+
+def mirror(data, deleted, inserted):
+    # What a view does with the edits returned by apply_production_delta
+    for i in reversed(deleted):
+        del data[i]
+    for idx, rows in inserted:
+        data[idx:idx] = rows
+    return data
+
+
+def test_diff_sync_state_checksums():
+    previous = {"ops": {"100": 1, "101": 2, "102": 3},
+                "fp": {"100": (10, 1), "102": (30, 1), "103": (40, 1)}}
+    current = {"ops": {"100": 1, "101": 9, "103": 4, "104": 5},
+               "fp": {"100": (11, 1), "103": (40, 1), "104": (50, 2)}}
+    touched, removed = db.diff_sync_state(previous, current)
+    # 100: records changed, 101: ERP columns changed, 103: back in the active set, 104: new
+    assert touched == {"100", "101", "103", "104"}
+    assert removed == {"102"}
+
+
+def test_diff_sync_state_version_column():
+    previous = {"ops": {"100": 1, "101": 2, "102": 3}, "fp_watermark": 5, "fp_changed": set(),
+                "fp_counts": {"100": 1, "101": 2}}
+    current = {"ops": {"100": 1, "101": 2}, "fp_watermark": 8, "fp_changed": {"100", "102"},
+               "fp_counts": {"100": 1, "101": 1}}
+    touched, removed = db.diff_sync_state(previous, current)
+    # 101 lost a record (only the count shows it); 102 changed but left the active set
+    assert touched == {"100", "101"}
+    assert removed == {"102"}
+
+
+def test_apply_delta_replaces_removes_and_reinserts():
+    data = [grid_row(100, 1, "Pesaje"), grid_row(100, 2, "Envasado"), grid_row(101),
+            grid_row(102, 3, "Despacho"), grid_row(104, 4, "Pesaje")]
+    view = list(data)
+    changed = [grid_row(100, 1, "Fabricacion"), grid_row(103, 5, "Pesaje"), grid_row(105),
+               grid_row(101, 6, "Dispensacion")]
+    deleted, inserted = db.apply_production_delta(
+        data, {("01", "100"), ("01", "101"), ("01", "103"), ("01", "105")}, {("01", "102")}, changed)
+    assert [(row[0], row[10], row[12]) for row in data] == [
+        ("100", "1", "Fabricacion"), ("101", "6", "Dispensacion"), ("103", "5", "Pesaje"),
+        ("104", "4", "Pesaje"), ("105", "", "")]
+    assert deleted == [0, 1, 2, 3]
+    assert mirror(view, deleted, inserted) == data
+
+
+def test_apply_delta_keeps_the_other_company():
+    # Consecutives repeat across companies: a change in 02 does not touch the 01 rows of the OP
+    data = [grid_row(100, 1, "Pesaje", "01"), grid_row(100, 7, "Envasado", "02"),
+            grid_row(101, 2, "Pesaje", "01"), grid_row(101, company="02")]
+    view = list(data)
+    changed = [grid_row(100, 7, "Despacho", "02"), grid_row(100, 8, "Pesaje", "02")]
+    deleted, inserted = db.apply_production_delta(
+        data, {("02", "100")}, {("02", "101")}, changed)
+    assert [(row[0], row[9], row[10], row[12]) for row in data] == [
+        ("100", "01", "1", "Pesaje"), ("100", "02", "7", "Despacho"), ("100", "02", "8", "Pesaje"),
+        ("101", "01", "2", "Pesaje")]
+    assert mirror(view, deleted, inserted) == data
+
+
+def test_apply_delta_orders_text_consecutives_last():
+    data = [grid_row(9), grid_row(10), grid_row("A-1")]
+    db.apply_production_delta(data, {("01", "11"), ("01", "A-0")}, set(), [grid_row("A-0"), grid_row(11)])
+    assert [row[0] for row in data] == ["9", "10", "11", "A-0", "A-1"]
+
+
+def test_forget_ops_only_in_the_key_company():
+    state = {"scopes": {"01:EF,PE,EE": {"ops": {"100": 1, "101": 2}, "fp": {}},
+                        "02:EF,PE,EE": {"ops": {"100": 3}, "fp": {}}}}
+    forgotten = db.forget_ops(state, {("02", "100")})
+    assert forgotten["scopes"]["01:EF,PE,EE"]["ops"] == {"100": 1, "101": 2}
+    assert forgotten["scopes"]["02:EF,PE,EE"]["ops"] == {"100": None}
+    touched, _ = db.diff_sync_state(forgotten["scopes"]["02:EF,PE,EE"], state["scopes"]["02:EF,PE,EE"])
+    assert touched == {"100"}
+    # The original state is left as it was
+    assert state["scopes"]["02:EF,PE,EE"]["ops"] == {"100": 3}
+    assert db.forget_ops({"service": {"cache": "x", "version": 1}}, {("01", "100")}) is None
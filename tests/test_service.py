@@ -0,0 +1,136 @@
+import pytest
+
+import db
+import service
+from benchmark.datagen import Dataset
+from benchmark.fake_driver import FakeDatabase
+from db import SaveConflict
+
+TOKEN = "test-token"
+
+
+@pytest.fixture
+def cache():
+    database = FakeDatabase(Dataset(300))
+    for name in db.POOL_DATABASES:
+        db.set_pool(name, db.ConnectionPool(database.connect, name=name))
+    cache = service.ProductionCache(fetch_size=100, history=2)
+    cache.refresh()
+    yield cache
+    db.close_pools()
+
+
+@pytest.fixture
+def client(cache):
+    testclient = pytest.importorskip("fastapi.testclient")
+    return testclient.TestClient(service.create_app(cache, TOKEN), headers={service.TOKEN_HEADER: TOKEN})
+
+
+def saved_record(cache):
+    # (company, # OP) key and FP_ID of an OP with a progress record
+    for key, rows in sorted(cache._rows.items()):
+        if rows[0][10] is not None:
+            return key, rows[0][10]
+    raise AssertionError("no progress record in the dataset")
+
+
+def move_phase(cache, fp_id, fase):
+    cache.update_record(fp_id, "10", fase, "01", "")
+
+
+def test_changes_since_returns_the_changed_op(cache):
+    key, fp_id = saved_record(cache)
+    assert cache.changes_since(cache.cache_id, cache.version) == {
+        "cache": cache.cache_id, "version": 1, "touched": [], "removed": [], "rows": []}
+    move_phase(cache, fp_id, "Despacho")
+    payload = cache.changes_since(cache.cache_id, 1)
+    assert payload["version"] == 2
+    assert payload["touched"] == [list(key)] and payload["removed"] == []
+    assert [row[12] for row in payload["rows"] if row[10] == fp_id] == ["Despacho"]
+    assert all(db.op_key(row) == key for row in payload["rows"])
+
+
+def test_changes_since_rejects_old_or_foreign_versions(cache):
+    _, fp_id = saved_record(cache)
+    for fase in ("Despacho", "Pesaje", "Envasado"):
+        move_phase(cache, fp_id, fase)
+    assert cache.version == 4
+    # Only the last two changes are kept
+    assert cache.changes_since(cache.cache_id, 1) is None
+    assert cache.changes_since(cache.cache_id, 2)["version"] == 4
+    assert cache.changes_since("other-process", 2) is None
+    assert cache.changes_since(cache.cache_id, 5) is None
+
+
+def test_changes_route(client, cache):
+    key, fp_id = saved_record(cache)
+    move_phase(cache, fp_id, "Despacho")
+    response = client.get("/production/changes", params={"cache": cache.cache_id, "since": 1})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == cache.etag
+    assert response.json()["touched"] == [list(key)]
+
+    response = client.get("/production/changes", params={"cache": cache.cache_id, "since": 2},
+                          headers={"If-None-Match": cache.etag})
+    assert response.status_code == 304
+
+
+def test_changes_route_too_old(client, cache):
+    _, fp_id = saved_record(cache)
+    for fase in ("Despacho", "Pesaje", "Envasado"):
+        move_phase(cache, fp_id, fase)
+    response = client.get("/production/changes", params={"cache": cache.cache_id, "since": 1})
+    assert response.status_code == 410
+
+
+@pytest.mark.parametrize("headers", [{}, {service.TOKEN_HEADER: "wrong"}])
+def test_service_token_required(client, headers):
+    client.headers.pop(service.TOKEN_HEADER)
+    response = client.get("/production", headers=headers)
+    assert response.status_code == 401
+    # The health check stays open for monitoring
+    assert client.get("/health").status_code == 200
+
+
+def test_empty_token_rejects_every_client(cache):
+    testclient = pytest.importorskip("fastapi.testclient")
+    client = testclient.TestClient(service.create_app(cache, ""))
+    assert client.get("/production", headers={service.TOKEN_HEADER: ""}).status_code == 401
+
+
+def test_save_validation_error(client, monkeypatch):
+    def reject(*args, **kwargs):
+        raise ValueError("Unknown phase: Limpieza")
+
+    monkeypatch.setattr(db, "create_fp_record", reject)
+    response = client.post("/records", json={"op": "100000", "company": "01", "cantidad": "10",
+                                              "fase": "Limpieza", "planta": "01"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Unknown phase: Limpieza"
+
+
+def test_save_conflict(client, cache, monkeypatch):
+    def conflict(*args, **kwargs):
+        raise SaveConflict("Record 7 was changed by someone else")
+
+    monkeypatch.setattr(db, "update_fp_record", conflict)
+    response = client.put("/records/7", json={"cantidad": "10", "fase": "Pesaje", "planta": "01",
+                                              "expected": {"fase": "Envasado"}})
+    assert response.status_code == 409
+    # Nothing was saved: the cache keeps its version
+    assert cache.version == 1
+
+
+def test_save_database_errors(client, monkeypatch):
+    errors = iter([db.PoolTimeout("No connection available"), RuntimeError("constraint violated")])
+
+    def fail(*args, **kwargs):
+        raise next(errors)
+
+    monkeypatch.setattr(db, "update_fp_record", fail)
+    body = {"cantidad": "10", "fase": "Pesaje", "planta": "01"}
+    # Transient errors are retried by journaled saves, the others are not
+    assert client.put("/records/7", json=body).status_code == 503
+    response = client.put("/records/7", json=body)
+    assert response.status_code == 500
+    assert response.json()["detail"] == "Database error"